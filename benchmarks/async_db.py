@@ -0,0 +1,76 @@
+"""Measures how much the AsyncMemeData lets the handlers overlap the database queries with the Telegram API calls.
+Each simulated handler reads the votes of a post, waits for a fake API call and reads the votes again.
+Only reads are made, on the database in the settings.
+Run it from the root of the project with python3 -m benchmarks.async_db
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules.data.async_db_manager import AsyncDbManager
+from modules.data.async_meme_data import AsyncMemeData
+from modules.data.meme_data import MemeData
+
+
+def sync_handler(post_id: int, api_latency: float):
+    """Handler that blocks its worker thread for the whole update
+
+    Args:
+        post_id (int): id of the post read
+        api_latency (float): seconds of the fake Telegram API call
+    """
+    MemeData.get_admin_list_votes(post_id, 0, True)
+    time.sleep(api_latency)
+    MemeData.get_user_id(post_id, 0)
+
+
+async def async_handler(post_id: int, api_latency: float):
+    """Handler that awaits both the database and the fake Telegram API call
+
+    Args:
+        post_id (int): id of the post read
+        api_latency (float): seconds of the fake Telegram API call
+    """
+    await AsyncMemeData.get_admin_list_votes(post_id, 0, True)
+    await asyncio.sleep(api_latency)
+    await AsyncMemeData.get_user_id(post_id, 0)
+
+
+async def run_async(args: argparse.Namespace) -> float:
+    """Runs all the handlers concurrently in the event loop
+
+    Args:
+        args (argparse.Namespace): parameters of the workload
+
+    Returns:
+        float: seconds needed
+    """
+    start = time.perf_counter()
+    await asyncio.gather(*[async_handler(post_id, args.api_latency) for post_id in range(args.updates)])
+    return time.perf_counter() - start
+
+
+def main():
+    """Main function
+    """
+    parser = argparse.ArgumentParser(description="Compares the sync and the async database access of the handlers")
+    parser.add_argument("--updates", type=int, default=200, help="number of updates handled")
+    parser.add_argument("--workers", type=int, default=4, help="threads running the sync handlers")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds of each fake Telegram API call")
+    args = parser.parse_args()
+    MemeData.init()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as workers:  # like the workers of the dispatcher
+        list(workers.map(lambda post_id: sync_handler(post_id, args.api_latency), range(args.updates)))
+    sync_seconds = time.perf_counter() - start
+    async_seconds = asyncio.run(run_async(args))
+    AsyncDbManager.shutdown()
+
+    print(f"{'runtime':<8}{'seconds':>10}{'updates/s':>12}")
+    print(f"{'sync':<8}{sync_seconds:>10.2f}{args.updates / sync_seconds:>12.0f}")
+    print(f"{'async':<8}{async_seconds:>10.2f}{args.updates / async_seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
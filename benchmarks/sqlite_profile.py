@@ -0,0 +1,135 @@
+"""Compares the sqlite profiles on the vote workload: many users voting concurrently on a few published posts.
+Run it from the root of the project with python3 -m benchmarks.sqlite_profile
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from modules.data.data_reader import config_map, read_file
+from modules.data.db_manager import DbManager
+
+PROFILES = {
+    'default': {},
+    'wal': {'journal_mode': "wal"},
+    'configured': config_map['data'].get('sqlite', {}),
+}
+
+
+def create_db(path: str, n_posts: int):
+    """Creates the database with the schema of the bot and the published posts
+
+    Args:
+        path (str): path of the database
+        n_posts (int): number of published posts
+    """
+    conn = sqlite3.connect(path)
+    for file_name in sorted(os.listdir(os.path.join("data", "db", "migrations"))):
+        for query in read_file("data", "db", "migrations", file_name).split("-----"):
+            conn.execute(query)
+    conn.executemany("INSERT INTO published_meme (channel_id, c_message_id) VALUES (?, ?)",
+                     [(-1, message_id) for message_id in range(n_posts)])
+    conn.executemany("INSERT INTO vote_tally (channel_id, c_message_id) VALUES (?, ?)",
+                     [(-1, message_id) for message_id in range(n_posts)])
+    conn.commit()
+    conn.close()
+
+
+def vote(conn: sqlite3.Connection, user_id: int, c_message_id: int, is_upvote: bool):
+    """Adds or changes the vote of the user and updates the tally of the post, like MemeData.set_user_vote
+
+    Args:
+        conn (sqlite3.Connection): connection used
+        user_id (int): id of the user
+        c_message_id (int): id of the post
+        is_upvote (bool): whether it is an upvote or a downvote
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT INTO votes (user_id, c_message_id, channel_id, is_upvote) VALUES (?, ?, -1, ?)"
+                     " ON CONFLICT (user_id, c_message_id, channel_id) DO UPDATE SET is_upvote = excluded.is_upvote",
+                     (user_id, c_message_id, is_upvote))
+        conn.execute("UPDATE vote_tally SET up = up + ?, down = down + ? WHERE c_message_id = ? and channel_id = -1",
+                     (int(is_upvote), int(not is_upvote), c_message_id))
+        conn.execute("SELECT up, down FROM vote_tally WHERE c_message_id = ? and channel_id = -1", (c_message_id, )).fetchall()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def run_profile(profile: dict, args: argparse.Namespace) -> dict:
+    """Runs the workload on a new database, with the pragmas of the profile
+
+    Args:
+        profile (dict): pragmas applied to each connection
+        args (argparse.Namespace): parameters of the workload
+
+    Returns:
+        dict: {votes, errors, seconds, votes_per_second, p99_ms}
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench.db")
+    create_db(path, args.posts)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        DbManager.apply_sqlite_profile(conn, profile)
+        for _ in range(args.votes):
+            start = time.perf_counter()
+            try:
+                vote(conn, rng.randrange(args.users), rng.randrange(args.posts), rng.random() < 0.7)
+            except sqlite3.OperationalError:  # e.g. database is locked
+                with lock:
+                    errors.append(1)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(seed, )) for seed in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    for file_name in os.listdir(directory):
+        os.remove(os.path.join(directory, file_name))
+    os.rmdir(directory)
+    latencies.sort()
+    return {
+        'votes': len(latencies),
+        'errors': len(errors),
+        'seconds': seconds,
+        'votes_per_second': len(latencies) / seconds,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0
+    }
+
+
+def main():
+    """Main function
+    """
+    parser = argparse.ArgumentParser(description="Compares the sqlite profiles on the vote workload")
+    parser.add_argument("--threads", type=int, default=8, help="number of threads voting at the same time")
+    parser.add_argument("--votes", type=int, default=500, help="votes cast by each thread")
+    parser.add_argument("--posts", type=int, default=20, help="number of published posts")
+    parser.add_argument("--users", type=int, default=1000, help="number of distinct users")
+    args = parser.parse_args()
+
+    print(f"{'profile':<12}{'votes':>8}{'errors':>8}{'seconds':>10}{'votes/s':>10}{'p99 ms':>10}")
+    for name, profile in PROFILES.items():
+        result = run_profile(profile, args)
+        print(f"{name:<12}{result['votes']:>8}{result['errors']:>8}{result['seconds']:>10.2f}"
+              f"{result['votes_per_second']:>10.0f}{result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
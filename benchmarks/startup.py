@@ -0,0 +1,145 @@
+"""Measures how long the bot takes to start: the time spent importing its modules, and the time from the launch
+of the process to the first update handled. Each run is a new python process, so nothing is cached between runs.
+Run it from the root of the project with python3 -m benchmarks.startup
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# update handled by the child process: the /rules command sent in a private chat
+FIRST_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'text': "/rules",
+        'entities': [{
+            'type': "bot_command",
+            'offset': 0,
+            'length': 6
+        }],
+        'chat': {
+            'id': 1,
+            'type': "private"
+        },
+        'from': {
+            'id': 1,
+            'is_bot': False,
+            'first_name': "bench"
+        }
+    }
+}
+
+
+class FakeRequest():
+    """Replaces the connection to Telegram: every request succeeds immediately, getMe, getMyCommands and sendMessage
+    return what Telegram would. The methods called are saved in sent
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def post(self, url: str, data: dict = None, timeout: float = None):  # pylint: disable=unused-argument
+        """Answers the request as Telegram would
+
+        Args:
+            url (str): url of the method
+            data (dict, optional): parameters of the method. Defaults to None.
+            timeout (float, optional): timeout of the request. Defaults to None.
+
+        Returns:
+            Union[bool, dict]: result of the method
+        """
+        method = url.rsplit("/", 1)[1]
+        self.sent.append(method)
+        if method == "getMe":
+            return {'id': 123, 'is_bot': True, 'first_name': "benchmark", 'username': "benchmark_bot"}
+        if method == "getMyCommands":
+            return []
+        if method == "sendMessage":
+            return {'message_id': 2, 'date': 0, 'chat': {'id': data['chat_id'], 'type': "private"}, 'text': data['text']}
+        return True
+
+    def stop(self):
+        """Nothing to close"""
+
+
+def first_update():
+    """Runs in the child process: starts the bot like main does, without connecting to Telegram,
+    handles FIRST_UPDATE and prints the time it was handled, and the database drivers imported
+    """
+    from queue import Queue  # pylint: disable=import-outside-toplevel
+    from telegram import Bot, Update  # pylint: disable=import-outside-toplevel
+    from telegram.ext import Dispatcher  # pylint: disable=import-outside-toplevel
+    import main  # pylint: disable=import-outside-toplevel
+
+    main.MemeData.init()
+    main.markdown.load()
+    request = FakeRequest()
+    bot = Bot("123:benchmark", request=request)
+    dispatcher = Dispatcher(bot, Queue(), workers=0, use_context=True)
+    main.add_handlers(dispatcher)
+    dispatcher.process_update(Update.de_json(FIRST_UPDATE, bot))
+    if "sendMessage" not in request.sent:
+        raise RuntimeError("The update has not been handled")
+    print(time.time(), flush=True)
+    modules = [name for name in ("psycopg2", "sqlite3") if name in sys.modules]
+    print(",".join(modules), flush=True)
+
+
+def import_time() -> list:
+    """Imports main in a new process with -X importtime
+
+    Returns:
+        list: (cumulative microseconds, module) of main and of each module it imports directly, slowest first
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2  # each level of nesting is indented by two spaces
+        if name.strip() == "main" or depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)
+
+
+def main():
+    """Main function
+    """
+    parser = argparse.ArgumentParser(description="Measures the startup time of the bot")
+    parser.add_argument("--runs", type=int, default=5, help="number of processes started")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports shown")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        first_update()
+        return
+
+    imports = import_time()
+    print(f"{'import':<40}{'cumulative ms':>15}")
+    for cumulative, name in imports[:args.top]:
+        print(f"{name:<40}{cumulative / 1000:>15.1f}")
+
+    seconds = []
+    for _ in range(args.runs):
+        start = time.time()
+        result = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"],
+                                capture_output=True,
+                                text=True,
+                                check=True)
+        handled_at, modules = result.stdout.splitlines()[-2:]
+        seconds.append(float(handled_at) - start)
+    print(f"\ntime to first update: median {statistics.median(seconds) * 1000:.0f} ms, "
+          f"min {min(seconds) * 1000:.0f} ms over {args.runs} runs")
+    print(f"database drivers imported: {modules or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
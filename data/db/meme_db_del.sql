@@ -1,4 +1,10 @@
 /*Used to delete everything from the database*/
+DROP TABLE IF EXISTS schema_version
+-----
+DROP TABLE IF EXISTS vote_tally
+-----
+DROP TABLE IF EXISTS admin_vote_tally
+-----
 DROP TABLE IF EXISTS votes
 -----
 DROP TABLE IF EXISTS credited_users
@@ -11,6 +17,8 @@ DROP TABLE IF EXISTS published_meme
 -----
 DROP TABLE IF EXISTS banned_users
 -----
+DROP TABLE IF EXISTS post_author
+-----
 DROP TABLE IF EXISTS command_list
 -----
 DROP TABLE IF EXISTS log_message
\ No newline at end of file
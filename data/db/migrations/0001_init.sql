@@ -1,4 +1,4 @@
-/*Used to instantiate the database the first time*/
+/*Used to instantiate the database the first time. Use the - 5 times to separate statements*/
 CREATE TABLE IF NOT EXISTS pending_meme
 (
   user_id BIGINT NOT NULL,
@@ -46,6 +46,26 @@ CREATE TABLE IF NOT EXISTS banned_users
   user_id BIGINT NOT NULL,
   PRIMARY KEY (user_id)
 );
+-----
+CREATE TABLE IF NOT EXISTS vote_tally
+(
+  channel_id BIGINT NOT NULL,
+  c_message_id BIGINT NOT NULL,
+  up INTEGER NOT NULL DEFAULT 0,
+  down INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (c_message_id, channel_id),
+  FOREIGN KEY (c_message_id, channel_id) REFERENCES published_meme (c_message_id, channel_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+-----
+CREATE TABLE IF NOT EXISTS admin_vote_tally
+(
+  group_id BIGINT NOT NULL,
+  g_message_id BIGINT NOT NULL,
+  approve INTEGER NOT NULL DEFAULT 0,
+  reject INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (g_message_id, group_id),
+  FOREIGN KEY (g_message_id, group_id) REFERENCES pending_meme (g_message_id, group_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
 /*
 CREATE VIEW approved AS
     SELECT COUNT(is_upvote) as number, a_group_id, a_message_id 
@@ -0,0 +1,6 @@
+/*Indexes used to look up the pending posts of a user and to count the votes of a post*/
+CREATE INDEX IF NOT EXISTS pending_meme_user_id_idx ON pending_meme (user_id);
+-----
+CREATE INDEX IF NOT EXISTS admin_votes_post_idx ON admin_votes (g_message_id, group_id, is_upvote, admin_id);
+-----
+CREATE INDEX IF NOT EXISTS votes_post_idx ON votes (c_message_id, channel_id, is_upvote);
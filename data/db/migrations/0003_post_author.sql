@@ -0,0 +1,11 @@
+/*Author of each post published in the channel, until its forward in the comment group is received*/
+CREATE TABLE IF NOT EXISTS post_author
+(
+  channel_id BIGINT NOT NULL,
+  c_message_id BIGINT NOT NULL,
+  user_id BIGINT NOT NULL,
+  created_at BIGINT NOT NULL,
+  PRIMARY KEY (channel_id, c_message_id)
+);
+-----
+CREATE INDEX IF NOT EXISTS post_author_created_at_idx ON post_author (created_at);
@@ -3,17 +3,28 @@
 # libs
 import os
 import warnings
+from queue import Queue
 # telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler,\
-     Filters, Dispatcher, DispatcherHandlerStop
+from telegram import Bot, Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, \
+     Filters, Dispatcher, DispatcherHandlerStop, JobQueue, TypeHandler, CallbackContext
+from telegram.utils.request import Request
 # debug
 from modules.debug.log_manager import log_message
 # data
 from modules.data.data_reader import config_map
+from modules.data.markdown_registry import markdown
+from modules.data.meme_data import MemeData
+from modules.data.settings import settings
+from modules.debug.query_stats import query_stats
 # commands
-from modules.handlers.command_handlers import STATE, start_cmd, help_cmd, settings_cmd, post_cmd, ban_cmd, reply_cmd,\
+from modules.handlers.command_handlers import STATE, start_cmd, help_cmd, settings_cmd, post_cmd, ban_cmd, reply_cmd, \
     post_msg, rules_cmd, sban_cmd, cancel_cmd, forwarded_post_msg
-from modules.handlers.callback_handlers import meme_callback
+from modules.handlers.callback_handlers import meme_callback, kb_refresher
+from modules.utils.profile_cache import profile_cache
+# runtime
+from modules.utils.concurrent_dispatcher import ConcurrentDispatcher
+from modules.utils.scheduled_bot import ScheduledBot
 # endregion
 
 
@@ -27,12 +38,44 @@ def stop():
     raise DispatcherHandlerStop
 
 
+def cleanup_job(context: CallbackContext):  # pylint: disable=unused-argument
+    """Deletes the data that is no longer needed, like the authors of the posts whose forward never arrived
+
+    Args:
+        context (CallbackContext): context passed by the job queue
+    """
+    MemeData.post_authors.cleanup()
+
+
+def apply_settings(changed: set):
+    """Applies the new settings to the objects created when the bot started
+
+    Args:
+        changed (set): names of the changed settings, like meme.n_votes
+    """
+    if "data.cache_max_age" in changed:
+        MemeData.banned_users.max_age = MemeData.credited_users.max_age = config_map['data'].get('cache_max_age', 0)
+    if "data.markdown_check_interval" in changed:
+        markdown.check_interval = config_map['data'].get('markdown_check_interval', 5)
+    if "data.post_author_ttl" in changed:
+        MemeData.post_authors.ttl = config_map['data'].get('post_author_ttl', 86400)
+    if "data.profile_cache_ttl" in changed:
+        profile_cache.ttl = config_map['data'].get('profile_cache_ttl', 3600)
+    if "debug.slow_query_threshold" in changed:
+        query_stats.slow_query_threshold = config_map['debug'].get('slow_query_threshold', 0)
+    if "meme.kb_refresh_window" in changed:
+        kb_refresher.window = config_map['meme'].get('kb_refresh_window', 1)
+
+
 def add_handlers(dp: Dispatcher):
     """Add all the needed handlers to the dipatcher
 
     Args:
         dp (Dispatcher): supplyed dispacther
     """
+    # keep the profiles of the users up to date, so that their names can be shown without asking Telegram
+    dp.add_handler(TypeHandler(Update, profile_cache.remember), -1)
+
     if config_map['debug']['local_log']:  # add MessageHandler only if log_message is enabled
         dp.add_handler(MessageHandler(Filters.all, log_message), 1)
 
@@ -65,13 +108,74 @@ def add_handlers(dp: Dispatcher):
         dp.add_handler(MessageHandler(Filters.forwarded, forwarded_post_msg))
 
 
+def create_bot(con_pool_size: int) -> Bot:
+    """Creates the bot. If outbound.enabled is true, its requests are queued by priority and sent
+    within the rate limits of Telegram by a ScheduledBot
+
+    Args:
+        con_pool_size (int): connections to the Telegram API needed by the threads using the bot
+
+    Returns:
+        Bot: the bot
+    """
+    request_kwargs = {'read_timeout': 20, 'connect_timeout': 20}
+    con_pool_size += profile_cache.workers  # the missing profiles are asked to Telegram in parallel
+    outbound_config = config_map.get('outbound', {})
+    if not outbound_config.get('enabled', False):
+        return Bot(config_map['token'], request=Request(con_pool_size=con_pool_size, **request_kwargs))
+
+    senders = outbound_config.get('senders', 8)
+    return ScheduledBot(config_map['token'],
+                        request=Request(con_pool_size=con_pool_size + senders, **request_kwargs),
+                        global_rate=outbound_config.get('global_rate', 30),
+                        chat_rate=outbound_config.get('chat_rate', 1),
+                        chat_burst=outbound_config.get('chat_burst', 3),
+                        group_rate=outbound_config.get('group_rate', 20 / 60),
+                        group_burst=outbound_config.get('group_burst', 20),
+                        max_retries=outbound_config.get('max_retries', 3),
+                        senders=senders)
+
+
+def create_updater() -> Updater:
+    """Creates the updater. If runtime.concurrency is greater than 1, the updates are handled concurrently
+    by a ConcurrentDispatcher, otherwise one at a time by the standard dispatcher
+
+    Returns:
+        Updater: the updater of the bot
+    """
+    runtime_config = config_map.get('runtime', {})
+    concurrency = runtime_config.get('concurrency', 1)
+    workers = runtime_config.get('workers', 4)
+    if concurrency <= 1:
+        return Updater(bot=create_bot(workers + 4), workers=workers, use_context=True)
+
+    # each update handled at the same time may need its own connection to the Telegram API
+    bot = create_bot(concurrency + workers + 4)
+    job_queue = JobQueue()
+    dispatcher = ConcurrentDispatcher(bot,
+                                      Queue(),
+                                      workers=workers,
+                                      job_queue=job_queue,
+                                      concurrency=concurrency,
+                                      max_pending=runtime_config.get('max_pending', 1000))
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
 def main():
     """Main function
     """
 
     PORT = int(os.environ.get('PORT', 5000))
-    updater = Updater(config_map['token'], request_kwargs={'read_timeout': 20, 'connect_timeout': 20}, use_context=True)
+    MemeData.init()
+    markdown.load()  # the texts of the commands are read once, and then only if they change
+    # the settings are reloaded when the file changes or on SIGHUP. Most of them are applied without a restart
+    settings.subscribe(apply_settings)
+    settings.reload_on_sighup()
+    settings.watch(interval=config_map.get('runtime', {}).get('settings_check_interval', 5))
+    updater = create_updater()
     add_handlers(updater.dispatcher)
+    updater.job_queue.run_repeating(cleanup_job, interval=3600, first=60)
 
     if config_map['webhook']['enabled']:
         updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=config_map['token'])
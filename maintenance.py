@@ -0,0 +1,69 @@
+"""Maintenance utility used to repair the data of the bot while it is offline"""
+import argparse
+import csv
+import json
+import sys
+from modules.data.meme_data import MemeData
+from modules.debug.log_manager import read_message_log
+
+
+def rebuild_tally(args: argparse.Namespace):  # pylint: disable=unused-argument
+    """Recomputes the tallies of all the posts from their votes
+
+    Args:
+        args (argparse.Namespace): the args passed by the user
+    """
+    MemeData.init()
+    n_posts = MemeData.rebuild_vote_tally()
+    print(f"Rebuilt the tally of {n_posts} posts")
+
+
+def export_log(args: argparse.Namespace):
+    """Prints the messages in the json message log, one at a time, so that the output can be piped
+
+    Args:
+        args (argparse.Namespace): the args passed by the user
+    """
+    records = read_message_log(chat_id=args.chat, user_id=args.user, since=args.since)
+    if args.csv:
+        fields = ("date", "message_id", "chat_id", "chat_type", "chat_title", "user_id", "user_name", "first_name",
+                  "last_name", "text")
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def create_argparser() -> argparse.ArgumentParser:
+    """Generates the appropriate argparser
+
+    Returns:
+        argparse.ArgumentParser: the argparser used to parse the arguments
+    """
+    parser = argparse.ArgumentParser(description="Maintenance utility for the data of the bot", allow_abbrev=True)
+    subparsers = parser.add_subparsers(title="commands", dest="command", required=True)
+
+    tally_parser = subparsers.add_parser("rebuild_tally", help="recompute the vote tallies from the votes")
+    tally_parser.set_defaults(func=rebuild_tally)
+
+    export_parser = subparsers.add_parser("export_log", help="print the messages saved in the json message log")
+    export_parser.add_argument("--chat", type=int, help="only the messages of this chat")
+    export_parser.add_argument("--user", type=int, help="only the messages of this user")
+    export_parser.add_argument("--since", type=int, help="only the messages sent after this unix timestamp")
+    export_parser.add_argument("--csv", action="store_true", help="print csv instead of json lines")
+    export_parser.set_defaults(func=export_log)
+    return parser
+
+
+def main():
+    """Main function
+    """
+    parser = create_argparser()
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
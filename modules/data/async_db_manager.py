@@ -0,0 +1,129 @@
+"""Awaitable version of the DbManager, for handlers running in an asyncio event loop"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, AsyncIterator, Callable
+from modules.data.data_reader import config_map
+from modules.data.db_manager import DbManager, DbTransaction
+
+# blocking methods of the DbManager that can be awaited as they are
+DB_MANAGER_METHODS = ("query_from_file", "query_from_string", "migrate", "select_from", "fetch_value", "fetch_column",
+                      "count_from", "insert_into", "upsert_into", "delete_from", "execute_many", "insert_many",
+                      "delete_many")
+
+
+def awaitable(func: Callable) -> Callable:
+    """Wraps the blocking function, so that it runs in the executor of the AsyncDbManager and can be awaited
+
+    Args:
+        func (Callable): blocking function
+
+    Returns:
+        Callable: coroutine function with the same arguments and result
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await AsyncDbManager.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+class AsyncDbManager():
+    """Runs the queries of the DbManager in a bounded pool of threads, so that the event loop is never blocked.
+    Each method has the same arguments, result and error handling of the DbManager method with the same name.
+    The number of threads (data.async_workers) should not be greater than the size of the connection pool,
+    otherwise the extra threads only wait for a connection
+    """
+    __executor = None
+    __executor_lock = threading.Lock()
+
+    @staticmethod
+    def get_executor() -> ThreadPoolExecutor:
+        """Gets the executor that runs the queries, creating it the first time
+
+        Returns:
+            ThreadPoolExecutor: executor of the queries
+        """
+        if AsyncDbManager.__executor is None:
+            with AsyncDbManager.__executor_lock:
+                if AsyncDbManager.__executor is None:
+                    AsyncDbManager.__executor = ThreadPoolExecutor(
+                        max_workers=config_map['data'].get('async_workers', 5), thread_name_prefix="async_db")
+        return AsyncDbManager.__executor
+
+    @staticmethod
+    def shutdown(wait: bool = True):
+        """Stops the executor. A new one is created if other queries are awaited
+
+        Args:
+            wait (bool, optional): whether to wait for the queries already submitted. Defaults to True.
+        """
+        with AsyncDbManager.__executor_lock:
+            executor, AsyncDbManager.__executor = AsyncDbManager.__executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    @staticmethod
+    async def run(func: Callable, *args, **kwargs) -> Any:
+        """Runs the blocking function in the executor
+
+        Args:
+            func (Callable): blocking function
+            args: positional arguments of the function
+            kwargs: keyword arguments of the function
+
+        Returns:
+            Any: result of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(AsyncDbManager.get_executor(), functools.partial(func, *args, **kwargs))
+
+    @staticmethod
+    async def run_in_transaction(func: Callable[[DbTransaction], Any], exclusive: bool = True) -> Any:
+        """Runs the function in a single transaction, on a single thread of the executor.
+        The transaction is committed when the function returns, or rolled back if it raises an exception
+
+        Args:
+            func (Callable[[DbTransaction], Any]): blocking function that receives the transaction
+            exclusive (bool, optional): see DbManager.transaction. Defaults to True.
+
+        Returns:
+            Any: result of the function
+        """
+
+        def transaction():
+            with DbManager.transaction(exclusive=exclusive) as tr:
+                return func(tr)
+
+        return await AsyncDbManager.run(transaction)
+
+    @staticmethod
+    async def iter_select(*args, batch_size: int = None, **kwargs) -> AsyncIterator:
+        """Yields the rows of DbManager.iter_select, fetching each batch in the executor
+
+        Args:
+            args: positional arguments of DbManager.iter_select
+            batch_size (int, optional): number of rows fetched at once. Defaults to the batch_size in the settings.
+            kwargs: keyword arguments of DbManager.iter_select
+
+        Yields:
+            AsyncIterator: rows from the select
+        """
+        batch_size = batch_size or config_map['data'].get('batch_size', 1000)
+        rows = DbManager.iter_select(*args, batch_size=batch_size, **kwargs)
+        try:
+            while True:
+                batch = await AsyncDbManager.run(lambda: list(islice(rows, batch_size)))
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        finally:
+            await AsyncDbManager.run(rows.close)
+
+
+for method_name in DB_MANAGER_METHODS:
+    setattr(AsyncDbManager, method_name, staticmethod(awaitable(getattr(DbManager, method_name))))
@@ -0,0 +1,20 @@
+"""Awaitable version of the MemeData, for handlers running in an asyncio event loop"""
+from modules.data.async_db_manager import awaitable
+from modules.data.meme_data import MemeData
+
+# methods of the MemeData that can be awaited. They run in the executor of the AsyncDbManager
+MEME_DATA_METHODS = ("insert_pending_post", "set_admin_vote", "get_admin_list_votes", "get_pending_votes",
+                     "remove_pending_meme", "insert_published_post", "set_user_vote", "get_published_votes",
+                     "rebuild_vote_tally", "get_user_id", "is_banned", "is_pending", "ban_user", "sban_user",
+                     "become_anonym", "become_credited", "is_credited", "load_caches")
+
+
+class AsyncMemeData():
+    """Class that exposes the methods of the MemeData as coroutines, with the same arguments and results.
+    The queries run in the bounded executor of the AsyncDbManager, so that a handler can await the database
+    while the event loop keeps serving the other updates. See AsyncDbManager for anything else
+    """
+
+
+for method_name in MEME_DATA_METHODS:
+    setattr(AsyncMemeData, method_name, staticmethod(awaitable(getattr(MemeData, method_name))))
@@ -42,5 +42,112 @@ def read_md(file_name: str) -> str:
     return read_file("data", "markdown", file_name + ".md")
 
 
-with open(get_abs_path("config", "settings.yaml"), 'r') as yaml_config:
-    config_map = yaml.load(yaml_config, Loader=yaml.SafeLoader)
+class ConfigError(ValueError):
+    """Raised when the settings are not valid"""
+
+
+# type of the settings that must always be present. The other settings are optional and have a default value
+CONFIG_SCHEMA = {
+    'data': {
+        'db_url': str,
+        'remote': bool
+    },
+    'debug': {
+        'local_log': bool
+    },
+    'meme': {
+        'channel_group_id': int,
+        'channel_id': int,
+        'comments': bool,
+        'group_id': int,
+        'n_votes': int,
+        'reset_on_load': bool
+    },
+    'token': str,
+    'webhook': {
+        'enabled': bool,
+        'url': str
+    }
+}
+# settings that can be left empty (null) when they are not used, like the url of the database when remote is false.
+# An empty value is read as an empty string
+NULLABLE_SETTINGS = ("data.db_url", "webhook.url")
+# environment variables that, if set, replace the value of a setting
+CONFIG_ENV_OVERLAYS = {
+    'DATABASE_URL': ('data', 'db_url'),
+    'TOKEN': ('token', ),
+    'GROUP_ID': ('meme', 'group_id'),
+    'CHANNEL_ID': ('meme', 'channel_id'),
+    'CHANNEL_GROUP_ID': ('meme', 'channel_group_id'),
+    'WEB_URL': ('webhook', 'url')
+}
+
+
+def load_config(*root_file_path: str) -> dict:
+    r"""Reads the settings from the yaml file, replaces the ones set in the environment and validates them
+
+    Args:
+        root_file_path (\*str): path of the settings file from the root project directory
+
+    Raises:
+        ConfigError: the settings are not valid
+
+    Returns:
+        dict: the settings
+    """
+    with open(get_abs_path(*root_file_path), 'r') as yaml_config:
+        config = yaml.load(yaml_config, Loader=yaml.SafeLoader)
+    if not isinstance(config, dict):
+        raise ConfigError(f"{os.path.join(*root_file_path)} does not contain any setting")
+
+    for variable, keys in CONFIG_ENV_OVERLAYS.items():
+        value = os.environ.get(variable)
+        if value is not None:
+            section = config
+            for key in keys[:-1]:
+                section = section.setdefault(key, {})
+            section[keys[-1]] = value
+
+    errors = validate_config(config, CONFIG_SCHEMA)
+    if config.get('meme', {}).get('n_votes', 1) < 1:
+        errors.append("meme.n_votes must be at least 1")
+    if errors:
+        raise ConfigError("Invalid settings: " + "; ".join(errors))
+    return config
+
+
+def validate_config(config: dict, schema: dict, prefix: str = "") -> list:
+    """Checks that the settings have the types of the schema. The strings read from the environment \
+    are converted to the type of the schema, and the empty NULLABLE_SETTINGS to empty strings
+
+    Args:
+        config (dict): settings to check, converted in place
+        schema (dict): type of each setting, or schema of each section
+        prefix (str, optional): name of the section being checked. Defaults to "".
+
+    Returns:
+        list: description of each error found
+    """
+    errors = []
+    for key, expected in schema.items():
+        name = prefix + key
+        if key in config and config[key] is None and name in NULLABLE_SETTINGS:
+            config[key] = ""
+        if key not in config:
+            errors.append(f"{name} is missing")
+        elif isinstance(expected, dict):
+            if isinstance(config[key], dict):
+                errors += validate_config(config[key], expected, name + ".")
+            else:
+                errors.append(f"{name} must be a section")
+        elif isinstance(config[key], str) and expected is not str:  # e.g. set by an environment variable
+            try:
+                config[key] = config[key].lower() in ("1", "true", "yes", "on") if expected is bool else expected(config[key])
+            except ValueError:
+                errors.append(f"{name} must be {expected.__name__}, not {config[key]!r}")
+        elif type(config[key]) is not expected:  # pylint: disable=unidiomatic-typecheck
+            errors.append(f"{name} must be {expected.__name__}, not {type(config[key]).__name__}")
+    return errors
+
+
+config_map = load_config("config", "settings.yaml")
@@ -1,11 +1,19 @@
 """Handles the management of databases"""
 import os
+import re
 import logging
-from typing import Tuple
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Tuple, Union
 import sqlite3
-import psycopg2
-import psycopg2.extras
 from modules.data.data_reader import get_abs_path, read_file, config_map
+from modules.data.db_pool import ConnectionPool, ThreadLocalPool, BoundedPool
+from modules.debug.query_stats import query_stats
 
 logger = logging.getLogger(__name__)
 
@@ -20,35 +28,370 @@ def dict_factory(cursor: sqlite3.Cursor, row: sqlite3.Row) -> dict:
     Returns:
         dict: structure of the database used used by the cursor
     """
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    return dict(zip([col[0] for col in cursor.description], row))
+
+
+@lru_cache(maxsize=256)
+def namedtuple_class(columns: Tuple[str]) -> type:
+    """Creates the namedtuple class of the rows with the specified columns, once for each set of columns
+
+    Args:
+        columns (Tuple[str]): names of the columns
+
+    Returns:
+        type: namedtuple class. Invalid column names are replaced by their position
+    """
+    return namedtuple("Row", columns, rename=True)
+
+
+def namedtuple_factory(cursor: sqlite3.Cursor, row: tuple) -> tuple:
+    """Makes so that each row is a namedtuple with column names as fields
+
+    Args:
+        cursor (sqlite3.Cursor): cursor generated by the database
+        row (tuple): row of the database
+
+    Returns:
+        tuple: namedtuple with the values of the row
+    """
+    return namedtuple_class(tuple(col[0] for col in cursor.description))._make(row)
+
+
+def chunks(iterable: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    """Splits the iterable in lists of at most size elements, without consuming it all at once
+
+    Args:
+        iterable (Iterable[tuple]): elements to split
+        size (int): maximum number of elements of each list
+
+    Yields:
+        Iterator[List[tuple]]: consecutive lists of elements
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+# how each row is returned by the selects: dict (default), tuple, row (sqlite3.Row or DictRow) or namedtuple
+ROW_MODES = ("dict", "tuple", "row", "namedtuple")
+SQLITE_PRAGMAS = ("busy_timeout", "journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store", "foreign_keys")
+
+
+def sqlite_row_factory(row_mode: str):
+    """Gets the sqlite row_factory that returns the rows in the requested mode
+
+    Args:
+        row_mode (str): type of the rows returned, one of ROW_MODES
+
+    Returns:
+        the row_factory, or None for plain tuples
+    """
+    if row_mode not in ROW_MODES:
+        raise ValueError(f"Unknown row mode: {row_mode}")
+    return {"dict": dict_factory, "tuple": None, "row": sqlite3.Row, "namedtuple": namedtuple_factory}[row_mode]
+
+
+psycopg2 = None  # postgres driver, imported by load_psycopg2 only if the remote database is used
+DISCONNECT_ERRORS = ()  # errors after which a connection is discarded. Set when the driver is imported
+
+
+def load_psycopg2():
+    """Imports the postgres driver the first time it is needed, so that the bot doesn't pay for it
+    when it uses the local database
+
+    Returns:
+        module: the psycopg2 package, with extras and extensions
+    """
+    global psycopg2, DISCONNECT_ERRORS  # pylint: disable=global-statement
+    if psycopg2 is None:
+        import psycopg2.extensions  # pylint: disable=import-outside-toplevel,redefined-outer-name
+        import psycopg2.extras  # pylint: disable=import-outside-toplevel
+        DISCONNECT_ERRORS = (psycopg2.InterfaceError, psycopg2.OperationalError)
+    return psycopg2
+
+
+def postgres_cursor_factory(row_mode: str) -> type:
+    """Gets the psycopg2 cursor class that returns the rows in the requested mode
+
+    Args:
+        row_mode (str): type of the rows returned, one of ROW_MODES
+
+    Returns:
+        type: cursor class. The DictCursor is used for both dict and row
+    """
+    if row_mode not in ROW_MODES:
+        raise ValueError(f"Unknown row mode: {row_mode}")
+    load_psycopg2()
+    return {
+        "dict": psycopg2.extras.DictCursor,
+        "tuple": psycopg2.extensions.cursor,
+        "row": psycopg2.extras.DictCursor,
+        "namedtuple": psycopg2.extras.NamedTupleCursor
+    }[row_mode]
 
 
 class DbManager():
     """Class that handles the management of databases
     """
     use_remote_db = config_map['data']['remote']
+    __pools = {}
+    __pools_lock = threading.Lock()
 
     @staticmethod
-    def get_db() -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
-        """Creates the connection to the database. It can be sqlite or postgres
+    def connect() -> Union[sqlite3.Connection, "psycopg2.connection"]:
+        """Opens a new connection to the database. It can be sqlite or postgres
 
         Returns:
-            Tuple[sqlite3.Connection, sqlite3.Cursor]: sqlite database connection and cursor
-            Tuple[psycopg2.Connection, psycopg2.Cursor]psycopg2.connection: postgres database connection and cursor
+            Union[sqlite3.Connection, psycopg2.connection]: new database connection
         """
         if DbManager.use_remote_db:  # connect to the remote db
-            db_path = os.environ.get("DATABASE_URL", config_map['data']['db_url'])
-            conn = psycopg2.connect(db_path, sslmode='require')
-            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            db_path = config_map['data']['db_url']  # DATABASE_URL, if set, replaces it
+            conn = load_psycopg2().connect(db_path, sslmode='require')
         else:  # connect to the local db
             db_path = get_abs_path("data", "db", "sqlite.db")
-            conn = sqlite3.connect(db_path)
+            conn = sqlite3.connect(db_path, check_same_thread=False)
             conn.row_factory = dict_factory
-            cur = conn.cursor()
-        return conn, cur
+            DbManager.apply_sqlite_profile(conn, config_map['data'].get('sqlite', {}))
+        return conn
+
+    @staticmethod
+    def apply_sqlite_profile(conn: sqlite3.Connection, profile: dict):
+        """Sets the pragmas of the profile on the sqlite connection.
+        Supported keys are busy_timeout, journal_mode, synchronous, mmap_size, cache_size, temp_store and foreign_keys
+
+        Args:
+            conn (sqlite3.Connection): connection to configure
+            profile (dict): value of each pragma. Missing pragmas keep the sqlite default
+        """
+        # busy_timeout comes first, so that changing the journal_mode can wait for the other connections
+        for pragma in SQLITE_PRAGMAS:
+            value = profile.get(pragma)
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = "ON" if value else "OFF"
+            if not re.fullmatch(r"-?\w+", str(value)):
+                raise ValueError(f"Invalid value for the sqlite pragma {pragma}: {value}")
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+    @staticmethod
+    def get_db() -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+        """Creates a new connection to the database, outside of the pool. It can be sqlite or postgres.
+        The caller is responsible for closing it
+
+        Returns:
+            Tuple[sqlite3.Connection, sqlite3.Cursor]: sqlite database connection and cursor
+            Tuple[psycopg2.Connection, psycopg2.Cursor]psycopg2.connection: postgres database connection and cursor
+        """
+        conn = DbManager.connect()
+        return conn, DbManager.__cursor(conn)
+
+    @staticmethod
+    def get_pool() -> ConnectionPool:
+        """Gets the connection pool of the database currently in use, creating it the first time.
+        Sqlite uses a long-lived connection for each thread, postgres a bounded pool shared by all threads
+
+        Returns:
+            ConnectionPool: pool of the current database
+        """
+        remote = DbManager.use_remote_db
+        pool = DbManager.__pools.get(remote)
+        if pool is None:
+            with DbManager.__pools_lock:
+                pool = DbManager.__pools.get(remote)
+                if pool is None:
+                    if remote:
+                        pool_config = config_map['data'].get('pool', {})
+                        pool = BoundedPool(connect=DbManager.connect,
+                                           check=DbManager.__is_alive,
+                                           max_size=pool_config.get('max_size', 5),
+                                           max_idle=pool_config.get('max_idle', 300),
+                                           max_lifetime=pool_config.get('max_lifetime', 3600),
+                                           timeout=pool_config.get('timeout', 10))
+                    else:
+                        pool = ThreadLocalPool(connect=DbManager.connect)
+                    DbManager.__pools[remote] = pool
+        return pool
+
+    @staticmethod
+    def close_pools():
+        """Closes all the pooled connections. They will be reopened on demand"""
+        with DbManager.__pools_lock:
+            pools = list(DbManager.__pools.values())
+            DbManager.__pools.clear()
+        for pool in pools:
+            pool.close_all()
+
+    @staticmethod
+    def pool_stats() -> dict:
+        """Gets the checkout statistics of the pool of the database currently in use
+
+        Returns:
+            dict: {checkouts, created, discarded, waits, total_wait, avg_wait, max_wait[, size, idle]}
+        """
+        return DbManager.get_pool().stats()
+
+    @staticmethod
+    def iter_select(table_name: str,
+                    select: str = "*",
+                    where: str = "",
+                    where_args: tuple = None,
+                    row_mode: str = "dict",
+                    batch_size: int = None,
+                    cancel: threading.Event = None) -> Iterator:
+        """Yields the rows of SELECT select FROM table_name [WHERE where (with where_args)] a batch at a time,
+        so that only batch_size rows are in memory at once.
+        Sqlite reads them with a dedicated connection, postgres with a server-side cursor that keeps
+        a pooled connection busy until the iteration ends. Closing the generator, or setting cancel,
+        stops the query and frees the connection. Unlike select_from, errors are raised
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str, optional): columns considered for the query. Defaults to "*".
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+            row_mode (str, optional): type of the rows returned, one of ROW_MODES. Defaults to "dict".
+            batch_size (int, optional): number of rows fetched at once. Defaults to the batch_size in the settings.
+            cancel (threading.Event, optional): event that stops the iteration before the next batch. Defaults to None.
+
+        Yields:
+            Iterator: rows from the select
+        """
+        batch_size = batch_size or config_map['data'].get('batch_size', 1000)
+        query = f"SELECT {select} FROM {table_name}"
+        if where:
+            query += f" WHERE {where}"
+
+        if DbManager.use_remote_db:
+            with DbManager.get_connection() as (conn, _):
+                # a named cursor lives on the server, and sends the rows only when they are fetched
+                cur = conn.cursor(name=f"iter_select_{uuid.uuid4().hex}", cursor_factory=postgres_cursor_factory(row_mode))
+                try:
+                    yield from DbManager.__iter_batches(cur, query, where_args, batch_size, cancel, remote=True)
+                finally:
+                    cur.close()
+        else:  # a connection of its own, so that the queries run while iterating don't reset the cursor
+            conn = DbManager.connect()
+            try:
+                cur = conn.cursor()
+                cur.row_factory = sqlite_row_factory(row_mode)
+                yield from DbManager.__iter_batches(cur, query, where_args, batch_size, cancel, remote=False)
+            finally:
+                conn.close()
+
+    @staticmethod
+    def __iter_batches(cur: sqlite3.Cursor,
+                       query: str,
+                       args: tuple,
+                       batch_size: int,
+                       cancel: threading.Event,
+                       remote: bool) -> Iterator:
+        """Executes the query and yields its rows, fetching batch_size rows at a time
+
+        Args:
+            cur (sqlite3.Cursor): cursor used
+            query (str): query to execute, with %s placeholders for the args
+            args (tuple): args used in the query
+            batch_size (int): number of rows fetched at once
+            cancel (threading.Event): event that stops the iteration before the next batch
+            remote (bool): whether the cursor is of the remote (postgres) database
+
+        Yields:
+            Iterator: rows from the query
+        """
+        elapsed = 0.0
+        n_rows = 0
+        try:
+            start = time.perf_counter()
+            cur.execute(query if remote else query.replace("%s", "?"), args or ())
+            rows = cur.fetchmany(batch_size)
+            elapsed += time.perf_counter() - start
+            while rows:
+                n_rows += len(rows)
+                yield from rows
+                if cancel is not None and cancel.is_set():
+                    return
+                start = time.perf_counter()
+                rows = cur.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+        finally:
+            query_stats.record_query(query, args, elapsed, n_rows)
+
+    @staticmethod
+    def query_stats() -> dict:
+        """Gets the latency of the queries run so far, grouped by statement shape, and of the connection checkouts
+
+        Returns:
+            dict: {queries: {shape: {count, total_time, avg_time, max_time, rows, buckets}}, acquire: {...}}
+        """
+        return query_stats.snapshot()
+
+    @staticmethod
+    @contextmanager
+    def get_connection() -> Iterator[Tuple[sqlite3.Connection, sqlite3.Cursor]]:
+        """Borrows a connection from the pool, returning it when the with block ends.
+        Any transaction not committed by then is rolled back
+
+        Yields:
+            Iterator[Tuple[sqlite3.Connection, sqlite3.Cursor]]: database connection and cursor
+        """
+        pool = DbManager.get_pool()
+        start = time.perf_counter()
+        conn = pool.acquire()
+        query_stats.record_acquire(time.perf_counter() - start)
+        discard = False
+        try:
+            cur = DbManager.__cursor(conn)
+        except Exception:
+            pool.release(conn, discard=True)
+            raise
+        try:
+            yield conn, cur
+        except DISCONNECT_ERRORS:  # empty if the postgres driver has not been imported
+            discard = True
+            raise
+        finally:
+            try:
+                cur.close()
+            except Exception:  # pylint: disable=broad-except
+                discard = True
+            pool.release(conn, discard=discard)
+
+    @staticmethod
+    def __cursor(conn: Union[sqlite3.Connection, "psycopg2.connection"]) -> sqlite3.Cursor:
+        """Creates the cursor, so that each row is returned as a dictionary
+
+        Args:
+            conn (Union[sqlite3.Connection, psycopg2.connection]): database connection
+
+        Returns:
+            sqlite3.Cursor: cursor of the connection
+        """
+        if isinstance(conn, sqlite3.Connection):
+            return conn.cursor()
+        return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    @staticmethod
+    def __is_alive(conn: "psycopg2.connection") -> bool:
+        """Checks that the postgres connection can still be used
+
+        Args:
+            conn (psycopg2.connection): connection to check
+
+        Returns:
+            bool: whether the connection is alive
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
 
     @staticmethod
     def query_from_file(*file_path: str):
@@ -58,13 +401,48 @@ class DbManager():
         Args:
             file_path (str): path of the text file containing the queries
         """
-        conn, cur = DbManager.get_db()
         queries = read_file(*file_path).split("-----")
-        for query in queries:
-            cur.execute(query)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with DbManager.get_connection() as (conn, cur):
+            for query in queries:
+                cur.execute(query)
+            conn.commit()
+
+    @staticmethod
+    def migrate(*dir_path: str) -> int:
+        """Applies, in order, all the migrations in the specified directory that have not been applied yet.
+        Each migration is a file named <version>_<name>.sql, with the queries separated by a ----- string.
+        The applied versions are stored in the schema_version table
+
+        Args:
+            dir_path (str): path of the directory containing the migrations
+
+        Returns:
+            int: number of migrations applied
+        """
+        migrations = {}
+        for file_name in os.listdir(get_abs_path(*dir_path)):
+            match = re.match(r"^(\d+)_\w+\.sql$", file_name)
+            if match:
+                migrations[int(match.group(1))] = file_name
+
+        with DbManager.transaction(exclusive=False) as tr:  # if the schema is current, no DDL is run
+            if tr.table_exists("schema_version"):
+                applied = set(tr.fetch_column(table_name="schema_version", select="version"))
+            else:
+                tr.execute("CREATE TABLE IF NOT EXISTS schema_version\
+                            (version INTEGER NOT NULL, name VARCHAR(255) NOT NULL, PRIMARY KEY (version))")
+                applied = set()
+
+        n_applied = 0
+        for version in sorted(set(migrations) - applied):
+            file_name = migrations[version]
+            with DbManager.transaction() as tr:  # each migration is applied entirely or not at all
+                for query in read_file(*dir_path, file_name).split("-----"):
+                    tr.cur.execute(query)
+                tr.insert_into(table_name="schema_version", columns=("version", "name"), values=(version, file_name))
+            logger.info("Applied migration %s", file_name)
+            n_applied += 1
+        return n_applied
 
     @staticmethod
     def query_from_string(*queries: str):
@@ -74,16 +452,44 @@ class DbManager():
         Args:
             queries (str): tuple of queries
         """
-        conn, cur = DbManager.get_db()
-        for query in queries:
-            cur.execute(query)
+        with DbManager.get_connection() as (conn, cur):
+            for query in queries:
+                cur.execute(query)
+            conn.commit()
+
+    @staticmethod
+    @contextmanager
+    def transaction(exclusive: bool = True) -> Iterator["DbTransaction"]:
+        """Runs all the queries of the with block on the same connection, in a single transaction.
+        The transaction is committed when the block ends, or rolled back if an exception is raised
+
+        Args:
+            exclusive (bool, optional): sqlite only: whether to lock the database for writing as soon as the \
+                transaction begins, so that reads and the following writes can't interleave with other transactions. \
+                Defaults to True.
 
-        conn.commit()
-        cur.close()
-        conn.close()
+        Yields:
+            Iterator[DbTransaction]: transaction used to run the queries
+        """
+        with DbManager.get_connection() as (conn, cur):
+            if exclusive and not DbManager.use_remote_db:
+                cur.execute("BEGIN IMMEDIATE")
+            tr = DbTransaction(cur, DbManager.use_remote_db)
+            try:
+                yield tr
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                tr.close()
 
     @staticmethod
-    def select_from(table_name: str, select: str = "*", where: str = "", where_args: tuple = None) -> list:
+    def select_from(table_name: str,
+                    select: str = "*",
+                    where: str = "",
+                    where_args: tuple = None,
+                    row_mode: str = "dict") -> list:
         """Returns the result of a SELECT select FROM table_name [WHERE where (with where_args)]
 
         Args:
@@ -91,36 +497,66 @@ class DbManager():
             select (str, optional): columns considered for the query. Defaults to "*".
             where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
             where_args (tuple, optional): args used in the where clause. Defaults to None.
+            row_mode (str, optional): type of the rows returned, one of ROW_MODES. Defaults to "dict".
 
         Returns:
             list: rows from the select
         """
-        conn, cur = DbManager.get_db()
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.select_from(table_name=table_name,
+                                      select=select,
+                                      where=where,
+                                      where_args=where_args,
+                                      row_mode=row_mode)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return []
 
-        if not DbManager.use_remote_db:
-            where = where.replace("%s", "?")
+    @staticmethod
+    def fetch_value(table_name: str, select: str, where: str = "", where_args: tuple = None, default: Any = None) -> Any:
+        """Returns the first column of the first row of SELECT select FROM table_name [WHERE where (with where_args)]
 
-        if where:
-            if where_args:
-                try:
-                    cur.execute(f"SELECT {select} FROM {table_name} WHERE {where}", where_args)
-                except sqlite3.Error as e:
-                    logger.error(str(e))
-            else:
-                try:
-                    cur.execute(f"SELECT {select} FROM {table_name} WHERE {where}")
-                except sqlite3.Error as e:
-                    logger.error(str(e))
-        else:
-            try:
-                cur.execute(f"SELECT {select} FROM {table_name}")
-            except sqlite3.Error as e:
-                logger.error(str(e))
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str): column, or expression, to get
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+            default (Any, optional): value returned if there are no rows. Defaults to None.
 
-        query_result = cur.fetchall()
-        cur.close()
-        conn.close()
-        return query_result
+        Returns:
+            Any: value of the first row, or default
+        """
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.fetch_value(table_name=table_name,
+                                      select=select,
+                                      where=where,
+                                      where_args=where_args,
+                                      default=default)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return default
+
+    @staticmethod
+    def fetch_column(table_name: str, select: str, where: str = "", where_args: tuple = None) -> list:
+        """Returns the first column of all the rows of SELECT select FROM table_name [WHERE where (with where_args)]
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str): column, or expression, to get
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+
+        Returns:
+            list: value of each row
+        """
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.fetch_column(table_name=table_name, select=select, where=where, where_args=where_args)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return []
 
     @staticmethod
     def count_from(table_name: str, select: str = "*", where: str = "", where_args: tuple = None) -> int:
@@ -135,32 +571,12 @@ class DbManager():
         Returns:
             int: number of rows
         """
-        conn, cur = DbManager.get_db()
-
-        if not DbManager.use_remote_db:
-            where = where.replace("%s", "?")
-
-        if where:
-            if where_args:
-                try:
-                    cur.execute(f"SELECT COUNT({select}) as number FROM {table_name} WHERE {where}", where_args)
-                except sqlite3.Error as e:
-                    logger.error(str(e))
-            else:
-                try:
-                    cur.execute(f"SELECT COUNT({select}) as number FROM {table_name} WHERE {where}")
-                except sqlite3.Error as e:
-                    logger.error(str(e))
-        else:
-            try:
-                cur.execute(f"SELECT COUNT({select}) as number FROM {table_name}")
-            except sqlite3.Error as e:
-                logger.error(str(e))
-
-        query_result = cur.fetchall()
-        cur.close()
-        conn.close()
-        return query_result[0]['number']
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.count_from(table_name=table_name, select=select, where=where, where_args=where_args)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return 0
 
     @staticmethod
     def insert_into(table_name: str, values: tuple, columns: tuple = ""):
@@ -171,24 +587,45 @@ class DbManager():
             values (tuple): values to be inserted
             columns (tuple, optional): columns that will be inserted, as a tuple of strings. Defaults to None.
         """
-        conn, cur = DbManager.get_db()
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                tr.insert_into(table_name=table_name, values=values, columns=columns)
+        except sqlite3.Error as e:
+            logger.error(str(e))
 
-        if DbManager.use_remote_db:
-            placeholders = ", ".join(["%s" for _ in values])
-        else:
-            placeholders = ", ".join(["?" for _ in values])
+    @staticmethod
+    def upsert_into(table_name: str,
+                    values: tuple,
+                    columns: tuple,
+                    conflict_columns: tuple,
+                    update_columns: tuple,
+                    update_where: str = "") -> int:
+        """Inserts the specified values in the database or, if a row with the same conflict_columns already exists, \
+        updates its update_columns with the new values
 
-        if columns:
-            columns = "(" + ", ".join(columns) + ")"
+        Args:
+            table_name (str): name of the table used in the INSERT INTO
+            values (tuple): values to be inserted
+            columns (tuple): columns that will be inserted, as a tuple of strings
+            conflict_columns (tuple): columns of the unique constraint that may be violated
+            update_columns (tuple): columns to update with the new values if the row already exists
+            update_where (str, optional): condition the existing row must satisfy to be updated. \
+                The new values can be referenced with excluded.column. Defaults to "".
 
+        Returns:
+            int: number of rows inserted or updated
+        """
         try:
-            cur.execute(f"INSERT INTO {table_name} {columns} VALUES ({placeholders})", values)
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.upsert_into(table_name=table_name,
+                                      values=values,
+                                      columns=columns,
+                                      conflict_columns=conflict_columns,
+                                      update_columns=update_columns,
+                                      update_where=update_where)
         except sqlite3.Error as e:
-            print("[error] select_start_from_where: " + str(e))
-
-        conn.commit()
-        cur.close()
-        conn.close()
+            logger.error(str(e))
+        return 0
 
     @staticmethod
     def delete_from(table_name: str, where: str = "", where_args: tuple = None):
@@ -200,28 +637,476 @@ class DbManager():
             where (str, optional): where clause, with %s placeholders for the where args. Defaults to "".
             where_args (tuple, optional): args used in the where clause. Defaults to None.
         """
-        conn, cur = DbManager.get_db()
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                tr.delete_from(table_name=table_name, where=where, where_args=where_args)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+
+    @staticmethod
+    def execute_many(query: str, args_list: Iterable[tuple], batch_size: int = None) -> int:
+        """Executes the query once for each tuple of args, in a single transaction
+
+        Args:
+            query (str): query to execute, with %s placeholders for the args
+            args_list (Iterable[tuple]): tuples of args
+            batch_size (int, optional): number of tuples sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows affected by all the queries
+        """
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.execute_many(query=query, args_list=args_list, batch_size=batch_size)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return 0
+
+    @staticmethod
+    def insert_many(table_name: str, values_list: Iterable[tuple], columns: tuple = "", batch_size: int = None) -> int:
+        """Inserts all the rows in the database, in a single transaction
+
+        Args:
+            table_name (str): name of the table used in the INSERT INTO
+            values_list (Iterable[tuple]): rows to be inserted
+            columns (tuple, optional): columns that will be inserted, as a tuple of strings. Defaults to None.
+            batch_size (int, optional): number of rows sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows inserted
+        """
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.insert_many(table_name=table_name, values_list=values_list, columns=columns, batch_size=batch_size)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return 0
+
+    @staticmethod
+    def delete_many(table_name: str, columns: tuple, values_list: Iterable[tuple], batch_size: int = None) -> int:
+        """Deletes all the rows whose columns are equal to one of the tuples of values, in a single transaction
+
+        Args:
+            table_name (str): name of the table used in the DELETE FROM
+            columns (tuple): columns compared with the values, as a tuple of strings
+            values_list (Iterable[tuple]): values of the rows to delete
+            batch_size (int, optional): number of tuples sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows deleted
+        """
+        try:
+            with DbManager.transaction(exclusive=False) as tr:
+                return tr.delete_many(table_name=table_name, columns=columns, values_list=values_list, batch_size=batch_size)
+        except sqlite3.Error as e:
+            logger.error(str(e))
+        return 0
+
+
+class DbTransaction():
+    """Runs queries on a single connection, as part of the same transaction.
+    Obtained with DbManager.transaction(). The queries use %s placeholders regardless of the database.
+    Unlike the DbManager, errors are not caught, so that the whole transaction can be rolled back
+
+    Args:
+        cur (sqlite3.Cursor): cursor of the connection used by the transaction
+        remote (bool): whether the connection is to the remote (postgres) database
+    """
+
+    def __init__(self, cur: sqlite3.Cursor, remote: bool):
+        self.cur = cur
+        self.remote = remote
+        # whether INSERT, UPDATE and DELETE support the RETURNING clause
+        self.returning = remote or sqlite3.sqlite_version_info >= (3, 35, 0)
+        self.__cursors = {}  # row_mode -> cursor on the same connection, created when first needed
+
+    def close(self):
+        """Closes the cursors opened for the row modes other than dict. The main cursor is left open"""
+        for cur in self.__cursors.values():
+            cur.close()
+        self.__cursors = {}
+
+    def execute(self, query: str, args: tuple = None) -> int:
+        """Executes the query
+
+        Args:
+            query (str): query to execute, with %s placeholders for the args
+            args (tuple, optional): args used in the query. Defaults to None.
+
+        Returns:
+            int: number of rows affected by the query
+        """
+        start = time.perf_counter()
+        self.__execute(query, args)
+        query_stats.record_query(query, args, time.perf_counter() - start, self.cur.rowcount)
+        return self.cur.rowcount
+
+    def execute_many(self, query: str, args_list: Iterable[tuple], batch_size: int = None) -> int:
+        """Executes the query once for each tuple of args
+
+        Args:
+            query (str): query to execute, with %s placeholders for the args
+            args_list (Iterable[tuple]): tuples of args
+            batch_size (int, optional): number of tuples sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows affected by all the queries
+        """
+        sql = query if self.remote else query.replace("%s", "?")
+        n_rows = 0
+        for chunk in chunks(args_list, self.__batch_size(batch_size)):
+            start = time.perf_counter()
+            self.cur.executemany(sql, chunk)
+            query_stats.record_query(query, chunk, time.perf_counter() - start, self.cur.rowcount)
+            n_rows += self.cur.rowcount
+        return n_rows
+
+    def insert_many(self, table_name: str, values_list: Iterable[tuple], columns: tuple = "", batch_size: int = None) -> int:
+        """Inserts all the rows in the database.
+        On postgres each batch is sent as a single multi-row INSERT
+
+        Args:
+            table_name (str): name of the table used in the INSERT INTO
+            values_list (Iterable[tuple]): rows to be inserted
+            columns (tuple, optional): columns that will be inserted, as a tuple of strings. Defaults to None.
+            batch_size (int, optional): number of rows sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows inserted
+        """
+        if columns:
+            columns = "(" + ", ".join(columns) + ")"
+        if not self.remote:
+            n_rows = 0
+            for chunk in chunks(values_list, self.__batch_size(batch_size)):
+                placeholders = ", ".join(["%s" for _ in chunk[0]])
+                n_rows += self.execute_many(f"INSERT INTO {table_name} {columns} VALUES ({placeholders})", chunk, len(chunk))
+            return n_rows
+        return self.__execute_values(f"INSERT INTO {table_name} {columns} VALUES %s", values_list, batch_size)
+
+    def delete_many(self, table_name: str, columns: tuple, values_list: Iterable[tuple], batch_size: int = None) -> int:
+        """Deletes all the rows whose columns are equal to one of the tuples of values.
+        On postgres each batch is sent as a single DELETE ... WHERE (columns) IN (VALUES ...)
+
+        Args:
+            table_name (str): name of the table used in the DELETE FROM
+            columns (tuple): columns compared with the values, as a tuple of strings
+            values_list (Iterable[tuple]): values of the rows to delete
+            batch_size (int, optional): number of tuples sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows deleted
+        """
+        if not self.remote:
+            where = " and ".join([f"{column} = %s" for column in columns])
+            return self.execute_many(f"DELETE FROM {table_name} WHERE {where}", values_list, batch_size)
+        return self.__execute_values(f"DELETE FROM {table_name} WHERE ({', '.join(columns)}) IN (VALUES %s)",
+                                     values_list, batch_size)
+
+    def __execute_values(self, query: str, values_list: Iterable[tuple], batch_size: int = None) -> int:
+        """Postgres only: executes the query once for each batch of values, expanded in place of its single %s
+
+        Args:
+            query (str): query with a single %s placeholder for the list of values
+            values_list (Iterable[tuple]): values used in the query
+            batch_size (int, optional): number of tuples sent to the database at once. \
+                Defaults to the batch_size in the settings.
+
+        Returns:
+            int: number of rows affected by all the queries
+        """
+        n_rows = 0
+        for chunk in chunks(values_list, self.__batch_size(batch_size)):
+            start = time.perf_counter()
+            psycopg2.extras.execute_values(self.cur, query, chunk, page_size=len(chunk))
+            query_stats.record_query(query, chunk, time.perf_counter() - start, self.cur.rowcount)
+            n_rows += self.cur.rowcount
+        return n_rows
+
+    @staticmethod
+    def __batch_size(batch_size: int = None) -> int:
+        """Gets the number of rows sent to the database at once by the bulk operations
+
+        Args:
+            batch_size (int, optional): requested batch size. Defaults to None.
+
+        Returns:
+            int: the requested batch size, or the one in the settings if None
+        """
+        return batch_size or config_map['data'].get('batch_size', 1000)
+
+    def __execute(self, query: str, args: tuple = None, cur: sqlite3.Cursor = None):
+        """Executes the query, without recording its timing
+
+        Args:
+            query (str): query to execute, with %s placeholders for the args
+            args (tuple, optional): args used in the query. Defaults to None.
+            cur (sqlite3.Cursor, optional): cursor used. Defaults to the main cursor of the transaction.
+        """
+        if cur is None:
+            cur = self.cur
+        if not self.remote:
+            query = query.replace("%s", "?")
+        if args:
+            cur.execute(query, args)
+        else:
+            cur.execute(query)
+
+    def fetchall(self, row_mode: str = "dict") -> list:
+        """Fetches the rows produced by the last query
+
+        Args:
+            row_mode (str, optional): type of the rows returned, one of ROW_MODES. Defaults to "dict".
+
+        Returns:
+            list: rows of the last query
+        """
+        if row_mode == "dict":
+            return self.cur.fetchall()
+        if self.remote:  # the rows have already been created by the DictCursor
+            rows = self.cur.fetchall()
+            if row_mode == "tuple":
+                return [tuple(row) for row in rows]
+            if row_mode == "namedtuple":
+                row_class = namedtuple_class(tuple(col[0] for col in self.cur.description))
+                return [row_class._make(row) for row in rows]
+            return rows
+        self.cur.row_factory = sqlite_row_factory(row_mode)
+        try:
+            return self.cur.fetchall()
+        finally:
+            self.cur.row_factory = dict_factory
+
+    def select_from(self,
+                    table_name: str,
+                    select: str = "*",
+                    where: str = "",
+                    where_args: tuple = None,
+                    for_update: bool = False,
+                    row_mode: str = "dict") -> list:
+        """Returns the result of a SELECT select FROM table_name [WHERE where (with where_args)]
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str, optional): columns considered for the query. Defaults to "*".
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+            for_update (bool, optional): postgres only: whether to lock the selected rows until the end \
+                of the transaction. Defaults to False.
+            row_mode (str, optional): type of the rows returned, one of ROW_MODES. Defaults to "dict".
+
+        Returns:
+            list: rows from the select
+        """
+        query = self.__select_query(table_name, select, where, for_update)
+        cur = self.__cursor(row_mode)
+        start = time.perf_counter()
+        self.__execute(query, where_args, cur)
+        rows = cur.fetchall()
+        query_stats.record_query(query, where_args, time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetch_value(self,
+                    table_name: str,
+                    select: str,
+                    where: str = "",
+                    where_args: tuple = None,
+                    for_update: bool = False,
+                    default: Any = None) -> Any:
+        """Returns the first column of the first row of SELECT select FROM table_name [WHERE where (with where_args)]
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str): column, or expression, to get
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+            for_update (bool, optional): postgres only: whether to lock the selected rows until the end \
+                of the transaction. Defaults to False.
+            default (Any, optional): value returned if there are no rows. Defaults to None.
+
+        Returns:
+            Any: value of the first row, or default
+        """
+        query = self.__select_query(table_name, select, where, for_update)
+        cur = self.__cursor("tuple")
+        start = time.perf_counter()
+        self.__execute(query, where_args, cur)
+        row = cur.fetchone()
+        query_stats.record_query(query, where_args, time.perf_counter() - start, int(row is not None))
+        return row[0] if row is not None else default
+
+    def fetch_column(self,
+                     table_name: str,
+                     select: str,
+                     where: str = "",
+                     where_args: tuple = None,
+                     for_update: bool = False) -> list:
+        """Returns the first column of all the rows of SELECT select FROM table_name [WHERE where (with where_args)]
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str): column, or expression, to get
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+            for_update (bool, optional): postgres only: whether to lock the selected rows until the end \
+                of the transaction. Defaults to False.
+
+        Returns:
+            list: value of each row
+        """
+        return [row[0] for row in self.select_from(table_name=table_name,
+                                                   select=select,
+                                                   where=where,
+                                                   where_args=where_args,
+                                                   for_update=for_update,
+                                                   row_mode="tuple")]
+
+    def count_from(self, table_name: str, select: str = "*", where: str = "", where_args: tuple = None) -> int:
+        """Returns the number of rows from SELECT COUNT(*) FROM table_name WHERE where
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str, optional): columns considered for the query. Defaults to "*".
+            where (str, optional): where clause, with %s placeholders for the where_args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+
+        Returns:
+            int: number of rows
+        """
+        return self.fetch_value(table_name=table_name, select=f"COUNT({select})", where=where, where_args=where_args)
+
+    def table_exists(self, table_name: str) -> bool:
+        """Checks whether the table exists, without running any DDL
+
+        Args:
+            table_name (str): name of the table
 
-        if not DbManager.use_remote_db:
-            where = where.replace("%s", "?")
+        Returns:
+            bool: whether the table exists
+        """
+        if self.remote:
+            return self.count_from(table_name="information_schema.tables",
+                                   where="table_schema = current_schema() and table_name = %s",
+                                   where_args=(table_name, )) > 0
+        return self.count_from(table_name="sqlite_master", where="type = 'table' and name = %s",
+                               where_args=(table_name, )) > 0
 
+    def __select_query(self, table_name: str, select: str, where: str, for_update: bool) -> str:
+        """Builds the query SELECT select FROM table_name [WHERE where] [FOR UPDATE]
+
+        Args:
+            table_name (str): name of the table used in the FROM
+            select (str): columns considered for the query
+            where (str): where clause, with %s placeholders
+            for_update (bool): postgres only: whether to lock the selected rows
+
+        Returns:
+            str: the query
+        """
+        query = f"SELECT {select} FROM {table_name}"
         if where:
-            if where_args:
-                try:
-                    cur.execute(f"DELETE FROM {table_name} WHERE {where}", where_args)
-                except sqlite3.Error as e:
-                    logger.error(str(e))
+            query += f" WHERE {where}"
+        if for_update and self.remote:
+            query += " FOR UPDATE"
+        return query
+
+    def __cursor(self, row_mode: str) -> sqlite3.Cursor:
+        """Gets the cursor that returns the rows in the requested mode, creating it the first time
+
+        Args:
+            row_mode (str): type of the rows returned, one of ROW_MODES
+
+        Returns:
+            sqlite3.Cursor: cursor on the connection of the transaction
+        """
+        if self.remote:
+            cursor_factory = postgres_cursor_factory(row_mode)
+            if cursor_factory is psycopg2.extras.DictCursor:
+                return self.cur
+        else:
+            row_factory = sqlite_row_factory(row_mode)
+            if row_factory is dict_factory:
+                return self.cur
+        cur = self.__cursors.get(row_mode)
+        if cur is None:
+            if self.remote:
+                cur = self.cur.connection.cursor(cursor_factory=cursor_factory)
             else:
-                try:
-                    cur.execute(f"DELETE FROM {table_name} WHERE {where}")
-                except sqlite3.Error as e:
-                    logger.error(str(e))
+                cur = self.cur.connection.cursor()
+                cur.row_factory = row_factory
+            self.__cursors[row_mode] = cur
+        return cur
+
+    def insert_into(self, table_name: str, values: tuple, columns: tuple = "") -> int:
+        """Inserts the specified values in the database
+
+        Args:
+            table_name (str): name of the table used in the INSERT INTO
+            values (tuple): values to be inserted
+            columns (tuple, optional): columns that will be inserted, as a tuple of strings. Defaults to None.
+
+        Returns:
+            int: number of rows inserted
+        """
+        placeholders = ", ".join(["%s" for _ in values])
+        if columns:
+            columns = "(" + ", ".join(columns) + ")"
+        return self.execute(f"INSERT INTO {table_name} {columns} VALUES ({placeholders})", values)
+
+    def upsert_into(self,
+                    table_name: str,
+                    values: tuple,
+                    columns: tuple,
+                    conflict_columns: tuple,
+                    update_columns: tuple,
+                    update_where: str = "") -> int:
+        """Inserts the specified values in the database or, if a row with the same conflict_columns already exists, \
+        updates its update_columns with the new values. Requires sqlite 3.24+
+
+        Args:
+            table_name (str): name of the table used in the INSERT INTO
+            values (tuple): values to be inserted
+            columns (tuple): columns that will be inserted, as a tuple of strings
+            conflict_columns (tuple): columns of the unique constraint that may be violated
+            update_columns (tuple): columns to update with the new values if the row already exists. \
+                If empty, the existing row is left untouched
+            update_where (str, optional): condition the existing row must satisfy to be updated. \
+                The new values can be referenced with excluded.column. Defaults to "".
+
+        Returns:
+            int: number of rows inserted or updated
+        """
+        placeholders = ", ".join(["%s" for _ in values])
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"\
+                f" ON CONFLICT ({', '.join(conflict_columns)})"
+        if update_columns:
+            update = ", ".join([f"{column} = excluded.{column}" for column in update_columns])
+            query += f" DO UPDATE SET {update}"
+            if update_where:
+                query += f" WHERE {update_where}"
         else:
-            try:
-                cur.execute(f"DELETE FROM {table_name}")
-            except sqlite3.Error as e:
-                logger.error(str(e))
+            query += " DO NOTHING"
+        return self.execute(query, values)
 
-        conn.commit()
-        cur.close()
-        conn.close()
+    def delete_from(self, table_name: str, where: str = "", where_args: tuple = None) -> int:
+        """Deletes the rows from the specified table, where the condition, when set, is satisfied
+        Execute "DELETE FROM table_name [WHERE where (with where_args)]"
+
+        Args:
+            table_name (str): name of the table used in the DELETE FROM
+            where (str, optional): where clause, with %s placeholders for the where args. Defaults to "".
+            where_args (tuple, optional): args used in the where clause. Defaults to None.
+
+        Returns:
+            int: number of rows deleted
+        """
+        query = f"DELETE FROM {table_name}"
+        if where:
+            query += f" WHERE {where}"
+        return self.execute(query, where_args)
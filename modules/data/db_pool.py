@@ -0,0 +1,324 @@
+"""Pools of long-lived connections used by the DbManager"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool():
+    """Base class of the connection pools.
+    Keeps track of the checkouts and of the time spent waiting for a connection
+
+    Args:
+        connect (Callable[[], Any]): function that opens a new connection
+    """
+
+    def __init__(self, connect: Callable[[], Any]):
+        self._connect = connect
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def acquire(self) -> Any:
+        """Gets a connection from the pool
+
+        Returns:
+            Any: connection to the database
+        """
+        raise NotImplementedError
+
+    def release(self, conn: Any, discard: bool = False):
+        """Gives the connection back to the pool
+
+        Args:
+            conn (Any): connection previously obtained with acquire
+            discard (bool, optional): whether the connection is broken and should be closed. Defaults to False.
+        """
+        raise NotImplementedError
+
+    def close_all(self):
+        """Closes all the connections held by the pool"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Gets the statistics of the pool
+
+        Returns:
+            dict: {checkouts, created, discarded, waits, total_wait, avg_wait, max_wait}
+        """
+        with self._stats_lock:
+            return {
+                'checkouts': self._checkouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'waits': self._waits,
+                'total_wait': self._total_wait,
+                'avg_wait': self._total_wait / self._checkouts if self._checkouts else 0.0,
+                'max_wait': self._max_wait
+            }
+
+    def _new_connection(self) -> Any:
+        """Opens a new connection, updating the statistics
+
+        Returns:
+            Any: new connection
+        """
+        conn = self._connect()
+        with self._stats_lock:
+            self._created += 1
+        return conn
+
+    def _close_connection(self, conn: Any):
+        """Closes the connection, ignoring any error, updating the statistics
+
+        Args:
+            conn (Any): connection to close
+        """
+        try:
+            conn.close()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Error while closing a connection: %s", e)
+        with self._stats_lock:
+            self._discarded += 1
+
+    def _record_checkout(self, wait: float):
+        """Updates the statistics after a checkout
+
+        Args:
+            wait (float): seconds spent waiting for the connection
+        """
+        with self._stats_lock:
+            self._checkouts += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            if wait > 0.001:
+                self._waits += 1
+
+    @staticmethod
+    def _reset(conn: Any) -> bool:
+        """Ends any transaction left open on the connection
+
+        Args:
+            conn (Any): connection to reset
+
+        Returns:
+            bool: whether the connection is still usable
+        """
+        try:
+            conn.rollback()
+        except Exception:  # pylint: disable=broad-except
+            return False
+        return True
+
+
+class ThreadLocalPool(ConnectionPool):
+    """Keeps a single long-lived connection for each thread. Used for sqlite,
+    where opening a connection is cheap but still needs a system call and a schema read.
+    The same thread can acquire the connection again before releasing it (e.g. a DbManager call inside
+    a transaction): it is reset, or closed, only when the outermost checkout is released
+
+    Args:
+        connect (Callable[[], Any]): function that opens a new connection
+    """
+
+    def __init__(self, connect: Callable[[], Any]):
+        super().__init__(connect)
+        self._local = threading.local()  # conn of the thread, depth of its checkouts not yet released, discard
+        self._connections: Dict[int, Any] = {}  # id -> open connection. Those removed are closed when released
+        self._in_use: Set[int] = set()  # ids of the connections checked out
+
+    def acquire(self) -> Any:
+        start = time.monotonic()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            conn = getattr(self._local, "conn", None)
+            with self._stats_lock:
+                if conn is not None and self._connections.get(id(conn)) is conn:
+                    self._in_use.add(id(conn))
+                else:  # never opened, or closed by close_all
+                    conn = None
+            if conn is None:
+                conn = self._new_connection()
+                self._local.conn = conn
+                with self._stats_lock:
+                    self._connections[id(conn)] = conn
+                    self._in_use.add(id(conn))
+        self._local.depth = depth + 1
+        self._record_checkout(time.monotonic() - start)
+        return self._local.conn
+
+    def release(self, conn: Any, discard: bool = False):
+        self._local.discard = discard or getattr(self._local, "discard", False)
+        self._local.depth -= 1
+        if self._local.depth > 0:  # an outer checkout of the same thread is still using the connection
+            return
+        discard, self._local.discard = self._local.discard, False
+        with self._stats_lock:
+            self._in_use.discard(id(conn))
+            closed = self._connections.get(id(conn)) is not conn
+        if closed or discard or not self._reset(conn):
+            self._local.conn = None
+            with self._stats_lock:
+                if self._connections.get(id(conn)) is conn:
+                    del self._connections[id(conn)]
+            self._close_connection(conn)
+
+    def close_all(self):
+        with self._stats_lock:
+            idle = [conn for key, conn in self._connections.items() if key not in self._in_use]
+            # the connections still in use are no longer tracked, so they are closed when released
+            self._connections = {}
+        for conn in idle:
+            self._close_connection(conn)
+
+
+class BoundedPool(ConnectionPool):
+    """Keeps at most max_size connections open, shared among all threads. Used for postgres,
+    where each new connection requires a full TLS handshake
+
+    Args:
+        connect (Callable[[], Any]): function that opens a new connection
+        check (Callable[[Any], bool]): function that returns whether a connection is still alive
+        max_size (int, optional): maximum number of connections open at the same time. Defaults to 5.
+        max_idle (float, optional): seconds after which an unused connection is closed. Defaults to 300.
+        max_lifetime (float, optional): seconds after which a connection is closed, regardless of its use. Defaults to 3600.
+        timeout (float, optional): seconds to wait for a free connection before giving up. Defaults to 10.
+        check_after (float, optional): seconds of inactivity after which a connection is checked before use. Defaults to 30.
+    """
+
+    def __init__(self,
+                 connect: Callable[[], Any],
+                 check: Callable[[Any], bool],
+                 max_size: int = 5,
+                 max_idle: float = 300,
+                 max_lifetime: float = 3600,
+                 timeout: float = 10,
+                 check_after: float = 30):
+        super().__init__(connect)
+        self._check = check
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.check_after = check_after
+        self._cond = threading.Condition()
+        self._idle: List[list] = []  # [conn, created_at, last_used], the most recent at the end
+        self._created_at = {}
+        self._size = 0
+
+    def acquire(self) -> Any:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            expired = []
+            try:
+                with self._cond:
+                    conn, stale = self._pop_idle(deadline, expired)
+            finally:  # closing and checking a connection are round trips to the server, done outside the lock
+                for old in expired:
+                    self._close_connection(old)
+            if conn is None:  # a slot has been reserved for a new connection
+                break
+            if not stale or self._check(conn):
+                self._record_checkout(time.monotonic() - start)
+                return conn
+            self._discard(conn)
+
+        try:  # open the connection outside the lock, so other threads can still release theirs
+            conn = self._new_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created_at[id(conn)] = time.monotonic()
+        self._record_checkout(time.monotonic() - start)
+        return conn
+
+    def release(self, conn: Any, discard: bool = False):
+        now = time.monotonic()
+        expired = now - self._created_at.get(id(conn), now) > self.max_lifetime
+        if discard or expired or getattr(conn, "closed", False) or not self._reset(conn):
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append([conn, self._created_at.get(id(conn), now), now])
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._cond:
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def _pop_idle(self, deadline: float, expired: List[Any]) -> Tuple[Optional[Any], bool]:
+        """Gets the most recently used connection that has not expired, removing the expired ones from the pool.
+        If there is none, reserves a slot for a new connection, waiting for one until the deadline.
+        Must be called holding the lock
+
+        Args:
+            deadline (float): time.monotonic() after which the wait is abandoned
+            expired (List[Any]): list where the expired connections are added, to be closed after releasing the lock
+
+        Raises:
+            TimeoutError: no connection became available before the deadline
+
+        Returns:
+            Tuple[Optional[Any], bool]: the connection, or None if a slot was reserved,
+            and whether it has been unused long enough to be checked before use
+        """
+        while True:
+            now = time.monotonic()
+            # connections unused for too long are at the beginning of the list
+            while self._idle and now - self._idle[0][2] > self.max_idle:
+                self._expire(self._idle.pop(0)[0], expired)
+            while self._idle:
+                conn, created_at, last_used = self._idle.pop()
+                if now - created_at <= self.max_lifetime:
+                    return conn, now - last_used > self.check_after
+                self._expire(conn, expired)
+            if self._size < self.max_size:
+                self._size += 1
+                return None, False
+            remaining = deadline - now
+            if remaining <= 0:
+                raise TimeoutError(f"No database connection available after {self.timeout}s")
+            self._cond.wait(remaining)
+
+    def _expire(self, conn: Any, expired: List[Any]):
+        """Frees the slot of an expired connection, leaving it to be closed by the caller.
+        Must be called holding the lock
+
+        Args:
+            conn (Any): expired connection
+            expired (List[Any]): list of the connections to close
+        """
+        self._created_at.pop(id(conn), None)
+        self._size -= 1
+        self._cond.notify()
+        expired.append(conn)
+
+    def _discard(self, conn: Any):
+        """Closes the connection and frees its slot in the pool
+
+        Args:
+            conn (Any): connection to discard
+        """
+        self._created_at.pop(id(conn), None)
+        self._close_connection(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
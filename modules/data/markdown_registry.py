@@ -0,0 +1,109 @@
+"""In-memory copy of the markdown files sent by the commands"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+from modules.data.data_reader import config_map, get_abs_path
+
+logger = logging.getLogger(__name__)
+
+
+class MarkdownRegistry():
+    """Keeps the contents of all the markdown files of a directory in memory, ready to be sent,
+    so that the commands don't read them from disk every time.
+    A file changed on disk is read again the next time it is used, as long as check_interval seconds
+    have passed since the last check of its modification time, so the texts can be edited without restarting the bot.
+    If a file is deleted or can no longer be read, its last contents are still sent
+
+    Args:
+        dir_path (Tuple[str]): path of the directory, from the root of the project. Defaults to data/markdown.
+        check_interval (float, optional): seconds between two checks of the same file. \
+            0 checks every time, a negative value never. Defaults to 5.
+    """
+
+    def __init__(self, dir_path: Tuple[str] = ("data", "markdown"), check_interval: float = 5):
+        self.dir_path = get_abs_path(*dir_path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._texts: Dict[str, Tuple[str, float, float]] = {}  # name -> (text, mtime, time of the last check)
+        self.reloads = 0
+
+    def load(self) -> int:
+        """Reads all the markdown files of the directory, replacing the ones already in memory
+
+        Returns:
+            int: number of files read
+        """
+        texts = {}
+        for file_name in os.listdir(self.dir_path):
+            name, extension = os.path.splitext(file_name)
+            if extension == ".md":
+                texts[name] = self._read(name)
+        with self._lock:
+            self._texts = texts
+        return len(texts)
+
+    def get(self, name: str) -> str:
+        """Gets the contents of the markdown file, reading it again if it has changed
+
+        Args:
+            name (str): name of the file, without the .md extension
+
+        Raises:
+            OSError: the file has never been read and cannot be read now
+
+        Returns:
+            str: contents of the file
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._texts.get(name)
+        if entry is not None and (self.check_interval < 0 or now - entry[2] < self.check_interval):
+            return entry[0]
+
+        if entry is None:
+            entry = self._read(name)
+            changed = False
+        else:
+            try:
+                changed = os.stat(self._path(name)).st_mtime != entry[1]
+                entry = self._read(name) if changed else (entry[0], entry[1], now)
+            except OSError as e:
+                logger.warning("Could not read %s, using the text read before: %s", self._path(name), e)
+                changed = False
+                entry = (entry[0], entry[1], now)
+        with self._lock:
+            self._texts[name] = entry
+            if changed:
+                self.reloads += 1
+        return entry[0]
+
+    def _read(self, name: str) -> Tuple[str, float, float]:
+        """Reads the markdown file
+
+        Args:
+            name (str): name of the file, without the .md extension
+
+        Returns:
+            Tuple[str, float, float]: contents of the file, its modification time and the current time
+        """
+        path = self._path(name)
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as in_file:
+            text = in_file.read().strip()
+        return text, mtime, time.monotonic()
+
+    def _path(self, name: str) -> str:
+        """Gets the path of the markdown file
+
+        Args:
+            name (str): name of the file, without the .md extension
+
+        Returns:
+            str: path of the file
+        """
+        return os.path.join(self.dir_path, name + ".md")
+
+
+markdown = MarkdownRegistry(check_interval=config_map['data'].get('markdown_check_interval', 5))
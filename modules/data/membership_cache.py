@@ -0,0 +1,137 @@
+"""In-memory copy of the tables that only list user ids, like banned_users and credited_users"""
+import threading
+import time
+from typing import Callable, List, Optional, Set
+from modules.data.db_manager import DbManager
+
+
+class MembershipCache():
+    """Keeps all the user_ids of a table in memory, so that checking whether a user is in it doesn't need a query.
+    Changes made through the cache are written to the database before updating the cache (write-through):
+    if the write fails, the error is raised and the cache is left unchanged.
+
+    Changes made by other processes are not seen until the cache is invalidated.
+    Use subscribe to be notified of every local change (e.g. to publish it to the other processes),
+    and invalidate when a change made elsewhere is received.
+
+    Args:
+        table_name (str): table that contains the user_id column
+        max_age (float, optional): seconds after which the cache is reloaded from the database. \
+            0 means never. Defaults to 0.
+    """
+
+    def __init__(self, table_name: str, max_age: float = 0):
+        self.table_name = table_name
+        self.max_age = max_age
+        self._ids: Optional[Set[int]] = None
+        self._loaded_at = 0.0
+        self._lock = threading.RLock()
+        self._listeners: List[Callable[[str, int, bool], None]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Loads all the user_ids from the database, replacing the current content of the cache"""
+        with self._lock:
+            self._ids = set(DbManager.fetch_column(table_name=self.table_name, select="user_id"))
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Discards the content of the cache. It will be reloaded from the database the next time it is used"""
+        with self._lock:
+            self._ids = None
+
+    def subscribe(self, callback: Callable[[str, int, bool], None]):
+        """Registers a function that will be called after every change made through the cache
+
+        Args:
+            callback (Callable[[str, int, bool], None]): function called with the name of the table, \
+                the user_id and whether it has been added (True) or removed (False)
+        """
+        self._listeners.append(callback)
+
+    def contains(self, user_id: int) -> bool:
+        """Checks if the user is in the table
+
+        Args:
+            user_id (int): id of the user to check
+
+        Returns:
+            bool: whether the user is in the table
+        """
+        with self._lock:
+            if self._is_stale():
+                self.misses += 1
+                self.load()
+            else:
+                self.hits += 1
+            return user_id in self._ids
+
+    def add(self, user_id: int) -> bool:
+        """Adds the user to the table, if it wasn't already there
+
+        Args:
+            user_id (int): id of the user to add
+
+        Raises:
+            sqlite3.Error: the user could not be added to the database (psycopg2.Error on postgres)
+
+        Returns:
+            bool: whether the user was already in the table
+        """
+        with self._lock:
+            if self.contains(user_id):
+                return True
+            with DbManager.transaction(exclusive=False) as tr:
+                tr.insert_into(table_name=self.table_name, columns=("user_id", ), values=(user_id, ))
+            self._ids.add(user_id)
+        self._notify(user_id, True)
+        return False
+
+    def remove(self, user_id: int) -> bool:
+        """Removes the user from the table, if it was there
+
+        Args:
+            user_id (int): id of the user to remove
+
+        Raises:
+            sqlite3.Error: the user could not be removed from the database (psycopg2.Error on postgres)
+
+        Returns:
+            bool: whether the user was in the table
+        """
+        with self._lock:
+            if not self.contains(user_id):
+                return False
+            with DbManager.transaction(exclusive=False) as tr:
+                tr.delete_from(table_name=self.table_name, where="user_id = %s", where_args=(user_id, ))
+            self._ids.discard(user_id)
+        self._notify(user_id, False)
+        return True
+
+    def stats(self) -> dict:
+        """Gets the statistics of the cache
+
+        Returns:
+            dict: {size, hits, misses}
+        """
+        with self._lock:
+            return {'size': len(self._ids) if self._ids is not None else 0, 'hits': self.hits, 'misses': self.misses}
+
+    def _is_stale(self) -> bool:
+        """Checks whether the cache has to be (re)loaded from the database
+
+        Returns:
+            bool: whether the cache is not loaded or too old
+        """
+        return self._ids is None or (self.max_age > 0 and time.monotonic() - self._loaded_at > self.max_age)
+
+    def _notify(self, user_id: int, added: bool):
+        """Calls all the subscribed functions
+
+        Args:
+            user_id (int): id of the user that changed
+            added (bool): whether the user has been added or removed
+        """
+        for callback in self._listeners:
+            callback(self.table_name, user_id, added)
@@ -1,18 +1,89 @@
 """Data management for the meme bot"""
+import logging
+import threading
 from typing import Optional, Tuple
 from telegram import Message
-from modules.data.db_manager import DbManager
-from modules.data.data_reader import config_map
-
-if config_map['meme']['reset_on_load']:
-    DbManager.query_from_file("data", "db", "meme_db_del.sql")
-DbManager.query_from_file("data", "db", "meme_db_init.sql")
+from modules.data.db_manager import DbManager, DbTransaction
+from modules.data.membership_cache import MembershipCache
+from modules.data.post_author_store import PostAuthorStore
+from modules.data.vote_buffer import VoteBuffer
+from modules.data.data_reader import config_map, get_abs_path
+
+logger = logging.getLogger(__name__)
+
+# tables that keep the number of positive and negative votes of each post, updated at every vote
+TALLIES = {
+    'votes': {
+        'table': "vote_tally",
+        'columns': ("c_message_id", "channel_id"),
+        'yes': "up",
+        'no': "down",
+        'posts': "published_meme"
+    },
+    'admin_votes': {
+        'table': "admin_vote_tally",
+        'columns': ("g_message_id", "group_id"),
+        'yes': "approve",
+        'no': "reject",
+        'posts': "pending_meme"
+    }
+}
 
 
 # region db management
 class MemeData():
     """Class that handles the management of persistent data fetch or manipulation in the meme bot
     """
+    banned_users = MembershipCache("banned_users", max_age=config_map['data'].get('cache_max_age', 0))
+    credited_users = MembershipCache("credited_users", max_age=config_map['data'].get('cache_max_age', 0))
+    post_authors = PostAuthorStore(ttl=config_map['data'].get('post_author_ttl', 86400),
+                                   max_size=config_map['data'].get('post_author_cache_size', 1000))
+    vote_buffer = None  # write-behind buffer of the votes, if enabled
+    initialized = False
+    __init_lock = threading.Lock()
+
+    @staticmethod
+    def init():
+        """Prepares the database and the in-memory data. Must be called once before using the MemeData.
+        Calling it again does nothing. If the schema is already current, no DDL is run
+        """
+        with MemeData.__init_lock:
+            if MemeData.initialized:
+                return
+            if config_map['meme']['reset_on_load']:
+                DbManager.query_from_file("data", "db", "meme_db_del.sql")
+            n_applied = DbManager.migrate("data", "db", "migrations")
+            logger.info("Database ready, %d migrations applied", n_applied)
+
+            MemeData.load_caches()
+            if config_map['data'].get('write_behind', {}).get('enabled', False):
+                write_behind_config = config_map['data']['write_behind']
+                MemeData.vote_buffer = VoteBuffer(flush_interval=write_behind_config.get('flush_interval', 1),
+                                                  flush_size=write_behind_config.get('flush_size', 500),
+                                                  journal_path=get_abs_path(write_behind_config['journal'])
+                                                  if write_behind_config.get('journal') else None)
+                MemeData.vote_buffer.start()
+            MemeData.initialized = True
+
+    @staticmethod
+    def load_caches():
+        """Loads in memory the users that are banned and credited"""
+        MemeData.banned_users.load()
+        MemeData.credited_users.load()
+
+    @staticmethod
+    def cache_stats() -> dict:
+        """Gets the statistics of the in-memory caches
+
+        Returns:
+            dict: {banned_users: {size, hits, misses}, credited_users: {...}, post_authors: {...}}
+        """
+        return {
+            'banned_users': MemeData.banned_users.stats(),
+            'credited_users': MemeData.credited_users.stats(),
+            'post_authors': MemeData.post_authors.stats()
+        }
+
     @staticmethod
     def insert_pending_post(user_message: Message, admin_message: Message):
         """Insert a new post in the table of pending posts
@@ -26,12 +97,16 @@ class MemeData():
         g_message_id = admin_message.message_id
         group_id = admin_message.chat_id
 
-        DbManager.insert_into(table_name="pending_meme",
-                              columns=("user_id", "u_message_id", "g_message_id", "group_id"),
-                              values=(user_id, u_message_id, g_message_id, group_id))
+        with DbManager.transaction() as tr:
+            tr.insert_into(table_name="pending_meme",
+                           columns=("user_id", "u_message_id", "g_message_id", "group_id"),
+                           values=(user_id, u_message_id, g_message_id, group_id))
+            tr.insert_into(table_name="admin_vote_tally",
+                           columns=("g_message_id", "group_id", "approve", "reject"),
+                           values=(g_message_id, group_id, 0, 0))
 
     @staticmethod
-    def set_admin_vote(admin_id: int, g_message_id: int, group_id: int, approval: bool) -> int:
+    def set_admin_vote(admin_id: int, g_message_id: int, group_id: int, approval: bool) -> Tuple[int, int]:
         """Adds the vote of the admin on a specific post, or update the existing vote, if needed
 
         Args:
@@ -41,45 +116,28 @@ class MemeData():
             approval (bool): whether the vote is approval or reject
 
         Returns:
-            int: number of similar votes (all the approve or the reject), or -1 if the vote wasn't updated
+            Tuple[int, int]: number of approve and reject votes, or (-1, -1) if the vote wasn't updated
         """
-        vote = MemeData.__get_admin_vote(admin_id, g_message_id, group_id)
-        if vote is None:  # there isn't a vote yet
-            DbManager.insert_into(table_name="admin_votes",
-                                  columns=("admin_id", "g_message_id", "group_id", "is_upvote"),
-                                  values=(admin_id, g_message_id, group_id, approval))
-            number_of_votes = MemeData.get_pending_votes(g_message_id, group_id, approval)
-        elif bool(vote) != approval:  # the vote was different from the approval
-            DbManager.query_from_string(f"UPDATE admin_votes SET is_upvote = {approval}\
-                                    WHERE admin_id = '{admin_id}'\
-                                        and g_message_id = '{g_message_id}'\
-                                        and group_id = '{group_id}'")
-            number_of_votes = MemeData.get_pending_votes(g_message_id, group_id, approval)
-        else:
-            return -1
-        return number_of_votes
-
-    @staticmethod
-    def __get_admin_vote(admin_id: int, g_message_id: int, group_id: int) -> Optional[bool]:
-        """Gets the vote of a specific admin on a pending post
-
-        Args:
-            admin_id (int): id of the admin that voted
-            g_message_id (int): id of the post in question in the group
-            group_id (int): id of the admin group
-
-        Returns:
-            Optional[bool]: a bool representing the vote or None if a vote was not yet made
-        """
-        vote = DbManager.select_from(select="is_upvote",
-                                     table_name="admin_votes",
-                                     where="admin_id = %s and g_message_id = %s and group_id = %s",
-                                     where_args=(admin_id, g_message_id, group_id))
-
-        if len(vote) == 0:  # the vote is not present
-            return None
-
-        return vote[0]['is_upvote']
+        with DbManager.transaction() as tr:
+            # lock the pending post, so that the votes of different admins are counted one at a time
+            tr.fetch_value(select="user_id",
+                           table_name="pending_meme",
+                           where="g_message_id = %s and group_id = %s",
+                           where_args=(g_message_id, group_id),
+                           for_update=True)
+            if tr.execute("UPDATE admin_votes SET is_upvote = %s\
+                           WHERE admin_id = %s and g_message_id = %s and group_id = %s and is_upvote <> %s",
+                          (approval, admin_id, g_message_id, group_id, approval)):  # the vote was different from the approval
+                delta = (1, -1)
+            elif tr.upsert_into(table_name="admin_votes",
+                                columns=("admin_id", "g_message_id", "group_id", "is_upvote"),
+                                values=(admin_id, g_message_id, group_id, approval),
+                                conflict_columns=("admin_id", "g_message_id", "group_id"),
+                                update_columns=()):  # there isn't a vote yet
+                delta = (1, 0)
+            else:  # the admin repeated the same vote
+                return -1, -1
+            return MemeData.__get_tally("admin_votes", (g_message_id, group_id), tr, *MemeData.__orient(delta, approval))
 
     @staticmethod
     def get_admin_list_votes(g_message_id: int, group_id: int, approve: bool) -> Tuple[str]:
@@ -93,15 +151,15 @@ class MemeData():
         Returns:
             Optional[bool]: a bool representing the vote or None if a vote was not yet made
         """
-        votes = DbManager.select_from(select="admin_id",
-                                     table_name="admin_votes",
-                                     where="g_message_id = %s and group_id = %s and is_upvote = %s",
-                                     where_args=(g_message_id, group_id, approve))
+        votes = DbManager.fetch_column(select="admin_id",
+                                       table_name="admin_votes",
+                                       where="g_message_id = %s and group_id = %s and is_upvote = %s",
+                                       where_args=(g_message_id, group_id, approve))
 
         if len(votes) == 0:  # the vote is not present
             return None
 
-        return tuple([vote['admin_id'] for vote in votes])
+        return tuple(votes)
 
     @staticmethod
     def get_pending_votes(g_message_id: int, group_id: int, vote: bool) -> int:
@@ -115,9 +173,8 @@ class MemeData():
         Returns:
             int: number of votes
         """
-        return DbManager.count_from(table_name="admin_votes",
-                                    where="g_message_id = %s and group_id = %s and is_upvote = %s",
-                                    where_args=(g_message_id, group_id, vote))
+        with DbManager.transaction(exclusive=False) as tr:
+            return MemeData.__get_tally("admin_votes", (g_message_id, group_id), tr)[0 if vote else 1]
 
     @staticmethod
     def remove_pending_meme(g_message_id: int, group_id: int):
@@ -127,12 +184,11 @@ class MemeData():
             g_message_id (int): id of the no longer pending post in the group
             group_id (int): id of the admin group
         """
-        DbManager.delete_from(table_name="pending_meme",
-                              where="g_message_id = %s and group_id = %s",
-                              where_args=(g_message_id, group_id))
-        DbManager.delete_from(table_name="admin_votes",
-                              where="g_message_id = %s and group_id = %s",
-                              where_args=(g_message_id, group_id))
+        with DbManager.transaction() as tr:
+            for table_name in ("pending_meme", "admin_votes", "admin_vote_tally"):
+                tr.delete_from(table_name=table_name,
+                               where="g_message_id = %s and group_id = %s",
+                               where_args=(g_message_id, group_id))
 
     @staticmethod
     def insert_published_post(channel_message: Message):
@@ -143,13 +199,19 @@ class MemeData():
         """
         c_message_id = channel_message.message_id
         channel_id = channel_message.chat_id
-        DbManager.insert_into(table_name="published_meme",
-                              columns=("channel_id", "c_message_id"),
-                              values=(channel_id, c_message_id))
+        with DbManager.transaction() as tr:
+            tr.insert_into(table_name="published_meme",
+                           columns=("channel_id", "c_message_id"),
+                           values=(channel_id, c_message_id))
+            tr.insert_into(table_name="vote_tally",
+                           columns=("c_message_id", "channel_id", "up", "down"),
+                           values=(c_message_id, channel_id, 0, 0))
 
     @staticmethod
-    def set_user_vote(user_id: int, c_message_id: int, channel_id: int, vote: bool) -> Tuple[int, bool]:
-        """Adds the vote of the user on a specific post, or update the existing vote, if needed
+    def set_user_vote(user_id: int, c_message_id: int, channel_id: int, vote: bool) -> Tuple[int, int, bool]:
+        """Adds the vote of the user on a specific post, or update the existing vote, if needed.
+        If the user repeats the same vote, it is removed instead.
+        The tally is updated by the same query that reads the current vote, then the vote is upserted or deleted
 
         Args:
             user_id (int): id of the user that voted
@@ -158,65 +220,158 @@ class MemeData():
             vote (bool): whether it is an upvote or a downvote
 
         Returns:
-            Tuple[int, bool]: number of similar votes (all the upvotes or the downvotes), or -1 if the vote wasn't updated, \
-                whether or not the vote was added or removed
+            Tuple[int, int, bool]: number of upvotes and downvotes, whether or not the vote was added or removed
         """
-        current_vote = MemeData.__get_user_vote(user_id, c_message_id, channel_id)
-        vote_added = True
-        if current_vote is None:  # there isn't a vote yet
-            DbManager.insert_into(table_name="votes",
-                                  columns=("user_id", "c_message_id", "channel_id", "is_upvote"),
-                                  values=(user_id, c_message_id, channel_id, vote))
-        elif bool(current_vote) != vote:  # the old vote was different from the new vote
-            DbManager.query_from_string(f"UPDATE votes SET is_upvote = {vote}\
-                                        WHERE user_id = '{user_id}'\
-                                        and c_message_id = '{c_message_id}'\
-                                        and channel_id = '{channel_id}'")
-        else:  # the user wants to remove his vote
-            DbManager.delete_from(table_name="votes",
-                                  where="user_id = %s and c_message_id = %s and channel_id = %s",
-                                  where_args=(user_id, c_message_id, channel_id))
-            vote_added = False
-
-        number_of_votes = MemeData.get_published_votes(c_message_id, channel_id, vote)
-        return number_of_votes, vote_added
+        if MemeData.vote_buffer is not None:
+            return MemeData.vote_buffer.vote(user_id, c_message_id, channel_id, vote)
+
+        where_vote = "user_id = %s and c_message_id = %s and channel_id = %s"
+        vote_key = (user_id, c_message_id, channel_id)
+        # change of the tally if the vote is removed, changed or added
+        removed, changed, added = (MemeData.__orient(delta, vote) for delta in ((-1, 0), (1, -1), (1, 0)))
+        with DbManager.transaction() as tr:
+            rows = []
+            if tr.returning:  # a single query reads the current vote of the user and updates the tally accordingly
+                current_vote = f"(SELECT is_upvote FROM votes WHERE {where_vote})"
+                tr.execute(
+                    f"UPDATE vote_tally\
+                      SET up = up + CASE {current_vote} WHEN %s THEN %s WHEN %s THEN %s ELSE %s END,\
+                        down = down + CASE {current_vote} WHEN %s THEN %s WHEN %s THEN %s ELSE %s END\
+                      WHERE c_message_id = %s and channel_id = %s\
+                      RETURNING up, down, {current_vote}",
+                    vote_key + (vote, removed[0], not vote, changed[0], added[0]) +
+                    vote_key + (vote, removed[1], not vote, changed[1], added[1]) +
+                    (c_message_id, channel_id) + vote_key)
+                rows = tr.fetchall(row_mode="tuple")
+            if rows:
+                n_upvotes, n_downvotes, current_vote = rows[0]
+            else:  # the post has no tally yet, or the database does not support RETURNING
+                current_vote = tr.fetch_value(table_name="votes", select="is_upvote", where=where_vote, where_args=vote_key)
+
+            vote_added = current_vote is None or bool(current_vote) != vote
+            if vote_added:  # there isn't a vote yet, or the old vote was different from the new vote
+                tr.upsert_into(table_name="votes",
+                               columns=("user_id", "c_message_id", "channel_id", "is_upvote"),
+                               values=vote_key + (vote, ),
+                               conflict_columns=("user_id", "c_message_id", "channel_id"),
+                               update_columns=("is_upvote", ))
+            else:  # the user wants to remove his vote
+                tr.delete_from(table_name="votes", where=where_vote, where_args=vote_key)
+
+            if not rows:
+                delta = added if current_vote is None else changed if vote_added else removed
+                n_upvotes, n_downvotes = MemeData.__get_tally("votes", (c_message_id, channel_id), tr, *delta)
+        return n_upvotes, n_downvotes, vote_added
 
     @staticmethod
-    def __get_user_vote(user_id: int, c_message_id: int, channel_id: int) -> Optional[bool]:
-        """Gets the vote of a specific user on a published post
+    def get_published_votes(c_message_id: int, channel_id: int, vote: bool) -> int:
+        """Gets all the votes of a specific kind (upvote or downvote) on a published post
 
         Args:
-            user_id (int): id of the user that voted
             c_message_id (int): id of the post in question in the channel
             channel_id (int): id of the channel
+            vote (bool): whether you look for upvotes or downvotes
 
         Returns:
-            Optional[bool]: a bool representing the vote or None if a vote was not yet made
+            int: number of votes
         """
-        vote = DbManager.select_from(select="is_upvote",
-                                     table_name="votes",
-                                     where="user_id = %s and c_message_id = %s and channel_id = %s",
-                                     where_args=(user_id, c_message_id, channel_id))
+        if MemeData.vote_buffer is not None:
+            tally = MemeData.vote_buffer.get_tally(c_message_id, channel_id)
+            if tally is not None:
+                return tally[0 if vote else 1]
+        with DbManager.transaction(exclusive=False) as tr:
+            return MemeData.__get_tally("votes", (c_message_id, channel_id), tr)[0 if vote else 1]
 
-        if len(vote) == 0:  # the vote is not present
-            return None
-        return vote[0]['is_upvote']
+    @staticmethod
+    def rebuild_vote_tally() -> int:
+        """Recomputes the tallies of all the published and pending posts from their votes.
+        Used to repair the tallies if they ever get out of sync
+
+        Returns:
+            int: number of posts whose tally has been rebuilt
+        """
+        n_posts = 0
+        with DbManager.transaction() as tr:
+            for votes_table, tally in TALLIES.items():
+                columns = ", ".join(tally['columns'])
+                join = " and ".join([f"p.{column} = v.{column}" for column in tally['columns']])
+                tr.delete_from(table_name=tally['table'])
+                n_posts += tr.execute(
+                    f"INSERT INTO {tally['table']} ({columns}, {tally['yes']}, {tally['no']})\
+                      SELECT {', '.join([f'p.{column}' for column in tally['columns']])},\
+                        COUNT(CASE WHEN v.is_upvote = %s THEN 1 END), COUNT(CASE WHEN v.is_upvote = %s THEN 1 END)\
+                      FROM {tally['posts']} p LEFT JOIN {votes_table} v ON {join}\
+                      GROUP BY {', '.join([f'p.{column}' for column in tally['columns']])}", (True, False))
+        return n_posts
 
     @staticmethod
-    def get_published_votes(c_message_id: int, channel_id: int, vote: bool) -> int:
-        """Gets all the votes of a specific kind (upvote or downvote) on a published post
+    def __orient(delta: Tuple[int, int], vote: bool) -> Tuple[int, int]:
+        """Converts the change of the votes of the same kind and of the opposite kind of the vote
+        in the change of the positive and negative votes
 
         Args:
-            c_message_id (int): id of the post in question in the channel
-            channel_id (int): id of the channel
-            vote (bool): whether you look for upvotes or downvotes
+            delta (Tuple[int, int]): change of the votes of the same kind and of the opposite kind
+            vote (bool): whether the vote is positive or negative
 
         Returns:
-            int: number of votes
+            Tuple[int, int]: change of the positive and negative votes
+        """
+        return delta if vote else delta[::-1]
+
+    @staticmethod
+    def __get_tally(votes_table: str,
+                    where_args: tuple,
+                    db: DbTransaction,
+                    delta_yes: int = 0,
+                    delta_no: int = 0) -> Tuple[int, int]:
+        """Gets the number of positive and negative votes of a post from its tally, after applying the changes, if any.
+        If the post has no tally yet, it is created by counting its votes
+
+        Args:
+            votes_table (str): table that contains the votes (votes | admin_votes)
+            where_args (tuple): id of the post and id of the chat
+            db (DbTransaction): transaction used to run the queries
+            delta_yes (int, optional): change of the positive votes. Defaults to 0.
+            delta_no (int, optional): change of the negative votes. Defaults to 0.
+
+        Returns:
+            Tuple[int, int]: number of positive and negative votes
         """
-        return DbManager.count_from(table_name="votes",
-                                    where="c_message_id = %s and channel_id = %s and is_upvote = %s",
-                                    where_args=(c_message_id, channel_id, vote))
+        tally = TALLIES[votes_table]
+        where = " and ".join([f"{column} = %s" for column in tally['columns']])
+        select = f"{tally['yes']}, {tally['no']}"
+        rows = None
+        if delta_yes or delta_no:
+            query = f"UPDATE {tally['table']} SET {tally['yes']} = {tally['yes']} + %s, {tally['no']} = {tally['no']} + %s\
+                      WHERE {where}"
+            if db.returning:  # get the new tally with the same query
+                db.execute(query + f" RETURNING {select}", (delta_yes, delta_no) + where_args)
+                rows = db.fetchall(row_mode="tuple")
+            elif not db.execute(query, (delta_yes, delta_no) + where_args):
+                rows = []
+        if rows is None:
+            rows = db.select_from(select=select,
+                                  table_name=tally['table'],
+                                  where=where,
+                                  where_args=where_args,
+                                  row_mode="tuple")
+        if rows:
+            return rows[0][0], rows[0][1]
+
+        # the post was created before the tallies were introduced: count its votes once
+        count = db.select_from(select="COUNT(CASE WHEN is_upvote = %s THEN 1 END),\
+                                       COUNT(CASE WHEN is_upvote = %s THEN 1 END)",
+                               table_name=votes_table,
+                               where=where,
+                               where_args=(True, False) + where_args,
+                               row_mode="tuple")
+        n_yes, n_no = count[0]
+        db.upsert_into(table_name=tally['table'],
+                       columns=tally['columns'] + (tally['yes'], tally['no']),
+                       values=where_args + (n_yes, n_no),
+                       conflict_columns=tally['columns'],
+                       update_columns=(tally['yes'], tally['no']))
+        return n_yes, n_no
 
     @staticmethod
     def get_user_id(g_message_id: int, group_id: int) -> Optional[int]:
@@ -229,13 +384,10 @@ class MemeData():
         Returns:
             Optional[int]: user_id, if found
         """
-        list_user_id = DbManager.select_from(select="user_id",
-                                             table_name="pending_meme",
-                                             where="g_message_id = %s and group_id = %s",
-                                             where_args=(g_message_id, group_id))
-        if list_user_id:
-            return list_user_id[0]['user_id']
-        return None
+        return DbManager.fetch_value(select="user_id",
+                                     table_name="pending_meme",
+                                     where="g_message_id = %s and group_id = %s",
+                                     where_args=(g_message_id, group_id))
 
     @staticmethod
     def is_banned(user_id: int) -> bool:
@@ -247,7 +399,7 @@ class MemeData():
         Returns:
             bool: whether the user is banned or not
         """
-        return DbManager.count_from(table_name="banned_users", where="user_id = %s", where_args=(user_id, )) > 0
+        return MemeData.banned_users.contains(user_id)
 
     @staticmethod
     def is_pending(user_id: int) -> bool:
@@ -268,7 +420,7 @@ class MemeData():
         Args:
             user_id (int): id of the user to ban
         """
-        DbManager.insert_into(table_name="banned_users", columns=("user_id", ), values=(user_id, ))
+        MemeData.banned_users.add(user_id)
 
     @staticmethod
     def sban_user(user_id: int) -> bool:
@@ -280,10 +432,11 @@ class MemeData():
         Returns:
             bool: whether the user was present in the banned list before the sban or not
         """
-        out = DbManager.count_from(table_name="banned_users", where="user_id = %s", where_args=(user_id, ))
-        if out > 0:
-            DbManager.delete_from(table_name="banned_users", where="user_id = %s", where_args=(user_id, ))
-        return out
+        try:
+            user_id = int(user_id)
+        except ValueError:  # not a valid user_id, so it can't be in the banned list
+            return False
+        return MemeData.banned_users.remove(user_id)
 
     @staticmethod
     def become_anonym(user_id: int) -> bool:
@@ -295,10 +448,7 @@ class MemeData():
         Returns:
             bool: whether the user was already anonym
         """
-        already_anonym = not MemeData.is_credited(user_id)
-        if not already_anonym:
-            DbManager.delete_from(table_name="credited_users", where="user_id = %s", where_args=(user_id, ))
-        return already_anonym
+        return not MemeData.credited_users.remove(user_id)
 
     @staticmethod
     def become_credited(user_id: int) -> bool:
@@ -310,10 +460,7 @@ class MemeData():
         Returns:
             bool: whether the user was already credited
         """
-        already_credited = MemeData.is_credited(user_id)
-        if not already_credited:
-            DbManager.insert_into(table_name="credited_users", columns=("user_id", ), values=(user_id, ))
-        return already_credited
+        return MemeData.credited_users.add(user_id)
 
     @staticmethod
     def is_credited(user_id: int) -> bool:
@@ -325,4 +472,4 @@ class MemeData():
         Returns:
             bool: whether the user is to be credited or not
         """
-        return DbManager.count_from(table_name="credited_users", where="user_id = %s", where_args=(user_id, )) == 1
+        return MemeData.credited_users.contains(user_id)
@@ -0,0 +1,106 @@
+"""Author of each post published in the channel, kept until the post is forwarded to the comment group"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from modules.data.db_manager import DbManager
+
+
+class PostAuthorStore():
+    """Remembers who wrote each post published in the channel, so that the author can be credited
+    when Telegram forwards the post to the comment group.
+    The mappings are saved in the post_author table, so that they survive a restart, and the most recent ones
+    are also kept in memory, so that the forward doesn't need a query.
+    A mapping whose forward never arrives expires after ttl seconds and is deleted by cleanup.
+    Since the forward may be handled while the post is still being published, pop can wait for the author to be put.
+
+    Args:
+        ttl (float, optional): seconds after which a mapping is discarded. Defaults to 86400.
+        max_size (int, optional): maximum number of mappings kept in memory. Defaults to 1000.
+    """
+
+    def __init__(self, ttl: float = 86400, max_size: int = 1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Condition()
+        self._authors = OrderedDict()  # (channel_id, c_message_id) -> (user_id, created_at), oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, channel_id: int, c_message_id: int, user_id: int):
+        """Saves the author of the post
+
+        Args:
+            channel_id (int): id of the channel
+            c_message_id (int): id of the post in the channel
+            user_id (int): id of the user who wrote the post
+        """
+        created_at = int(time.time())
+        DbManager.upsert_into(table_name="post_author",
+                              columns=("channel_id", "c_message_id", "user_id", "created_at"),
+                              values=(channel_id, c_message_id, user_id, created_at),
+                              conflict_columns=("channel_id", "c_message_id"),
+                              update_columns=("user_id", "created_at"))
+        with self._lock:
+            self._authors[(channel_id, c_message_id)] = (user_id, created_at)
+            self._authors.move_to_end((channel_id, c_message_id))
+            while len(self._authors) > self.max_size:  # the oldest mapping is still in the database
+                self._authors.popitem(last=False)
+            self._lock.notify_all()
+
+    def pop(self, channel_id: int, c_message_id: int, wait: float = 0) -> Optional[int]:
+        """Gets the author of the post and forgets it
+
+        Args:
+            channel_id (int): id of the channel
+            c_message_id (int): id of the post in the channel
+            wait (float, optional): seconds to wait for the author to be put, if it is not known yet. Defaults to 0.
+
+        Returns:
+            Optional[int]: id of the user who wrote the post, or None if it is unknown or expired
+        """
+        min_created_at = int(time.time() - self.ttl)
+        deadline = time.monotonic() + wait
+        with self._lock:
+            entry = self._authors.pop((channel_id, c_message_id), None)
+            while entry is None and time.monotonic() < deadline:  # the post may still be being published
+                self._lock.wait(deadline - time.monotonic())
+                entry = self._authors.pop((channel_id, c_message_id), None)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:  # not in memory: it may have been saved before a restart
+            user_id = DbManager.fetch_value(table_name="post_author",
+                                            select="user_id",
+                                            where="channel_id = %s and c_message_id = %s and created_at >= %s",
+                                            where_args=(channel_id, c_message_id, min_created_at))
+        else:
+            user_id = entry[0] if entry[1] >= min_created_at else None
+        DbManager.delete_from(table_name="post_author",
+                              where="channel_id = %s and c_message_id = %s",
+                              where_args=(channel_id, c_message_id))
+        return user_id
+
+    def cleanup(self) -> int:
+        """Deletes the mappings that have expired
+
+        Returns:
+            int: number of mappings deleted from the database
+        """
+        min_created_at = int(time.time() - self.ttl)
+        with self._lock:
+            while self._authors and next(iter(self._authors.values()))[1] < min_created_at:
+                self._authors.popitem(last=False)
+        with DbManager.transaction(exclusive=False) as tr:
+            return tr.delete_from(table_name="post_author", where="created_at < %s", where_args=(min_created_at, ))
+
+    def stats(self) -> dict:
+        """Gets the statistics of the store
+
+        Returns:
+            dict: {size, hits, misses}
+        """
+        with self._lock:
+            return {'size': len(self._authors), 'hits': self.hits, 'misses': self.misses}
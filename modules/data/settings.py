@@ -0,0 +1,179 @@
+"""Attribute access to the settings, and their reload while the bot is running"""
+import logging
+import os
+import signal
+import threading
+from typing import Any, Callable, List, Set
+from modules.data.data_reader import config_map, get_abs_path, load_config, ConfigError
+
+logger = logging.getLogger(__name__)
+
+# settings that are only read when the bot starts: changing them requires a restart
+RESTART_KEYS = ("token", "data.db_url", "data.remote", "data.pool", "data.sqlite", "data.write_behind", "runtime",
+                "outbound", "webhook")
+
+
+class Section():
+    """Read-only view of a section of the settings, whose values can be read as attributes
+    (settings.meme.n_votes instead of config_map['meme']['n_votes']). It always shows the current values
+
+    Args:
+        get_values (Callable[[], dict]): function that returns the current values of the section
+    """
+
+    def __init__(self, get_values: Callable[[], dict]):
+        self._get_values = get_values
+
+    def __getattr__(self, name: str) -> Any:
+        values = self._get_values()
+        if name not in values:
+            raise AttributeError(f"No setting named {name}")
+        if isinstance(values[name], dict):
+            return Section(lambda: self._get_values()[name])
+        return values[name]
+
+    def __getitem__(self, name: str) -> Any:
+        return self._get_values()[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._get_values()
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """Gets the value of the setting, or default if it is not set
+
+        Args:
+            name (str): name of the setting
+            default (Any, optional): value returned if the setting is not set. Defaults to None.
+
+        Returns:
+            Any: value of the setting
+        """
+        return self._get_values().get(name, default)
+
+
+class Settings(Section):
+    """Settings of the bot. The values are the ones in config_map, which is updated in place when they are reloaded,
+    so the code reading config_map directly sees the new values too.
+    A reload reads the file again and, only if the new settings are valid, replaces each changed section at once.
+    The functions registered with subscribe are then told which settings have changed
+
+    Args:
+        root_file_path (str): path of the settings file from the root project directory
+    """
+
+    def __init__(self, *root_file_path: str):
+        super().__init__(lambda: config_map)
+        self.root_file_path = root_file_path
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._mtime = self._get_mtime()
+        self._watcher = None
+        self.reloads = 0
+
+    def subscribe(self, callback: Callable[[Set[str]], None]):
+        """Registers a function that will be called after every reload that changed some settings
+
+        Args:
+            callback (Callable[[Set[str]], None]): function called with the names of the changed settings, \
+                like meme.n_votes
+        """
+        self._listeners.append(callback)
+
+    def reload(self) -> Set[str]:
+        """Reads the settings file again. If the new settings are not valid, the current ones are kept
+
+        Returns:
+            Set[str]: names of the settings that have changed
+        """
+        with self._lock:
+            self._mtime = self._get_mtime()
+            try:
+                new_config = load_config(*self.root_file_path)
+            except (ConfigError, OSError, ValueError) as e:
+                logger.error("Settings not reloaded: %s", e)
+                return set()
+
+            changed = self.diff(config_map, new_config)
+            for key in set(config_map) | set(new_config):  # each section is replaced by a single assignment
+                if key not in new_config:
+                    del config_map[key]
+                elif config_map.get(key) != new_config[key]:
+                    config_map[key] = new_config[key]
+            self.reloads += 1
+
+        if changed:
+            self._notify(changed)
+        return changed
+
+    def _notify(self, changed: Set[str]):
+        """Logs the changed settings and calls the subscribed functions
+
+        Args:
+            changed (Set[str]): names of the settings that have changed
+        """
+        needs_restart = sorted(name for name in changed if name.startswith(RESTART_KEYS))
+        if needs_restart:
+            logger.warning("These settings will only be applied after a restart: %s", ", ".join(needs_restart))
+        logger.info("Settings reloaded, changed: %s", ", ".join(sorted(changed)))
+        for callback in self._listeners:
+            try:
+                callback(changed)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error while applying the new settings")
+
+    def watch(self, interval: float = 5):
+        """Reloads the settings whenever the file changes, checking its modification time every interval seconds
+
+        Args:
+            interval (float, optional): seconds between two checks. Defaults to 5.
+        """
+        if self._watcher is not None:
+            return
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                if self._get_mtime() != self._mtime:
+                    self.reload()
+
+        self._watcher = threading.Thread(target=run, name="settings_watcher", daemon=True)
+        self._watcher.start()
+
+    def reload_on_sighup(self):
+        """Reloads the settings when the process receives SIGHUP. Must be called from the main thread"""
+        if hasattr(signal, "SIGHUP"):  # not available on windows
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.reload).start())
+
+    @staticmethod
+    def diff(old: dict, new: dict, prefix: str = "") -> Set[str]:
+        """Finds the settings that are different between the two versions
+
+        Args:
+            old (dict): old settings
+            new (dict): new settings
+            prefix (str, optional): name of the section being compared. Defaults to "".
+
+        Returns:
+            Set[str]: names of the changed settings, like meme.n_votes
+        """
+        changed = set()
+        for key in set(old) | set(new):
+            if isinstance(old.get(key), dict) and isinstance(new.get(key), dict):
+                changed |= Settings.diff(old[key], new[key], f"{prefix}{key}.")
+            elif old.get(key) != new.get(key) or (key in old) != (key in new):
+                changed.add(f"{prefix}{key}")
+        return changed
+
+    def _get_mtime(self) -> float:
+        """Gets the modification time of the settings file
+
+        Returns:
+            float: modification time, or 0 if the file can't be read
+        """
+        try:
+            return os.stat(get_abs_path(*self.root_file_path)).st_mtime
+        except OSError:
+            return 0
+
+
+settings = Settings("config", "settings.yaml")
@@ -0,0 +1,360 @@
+"""Write-behind buffer for the votes of the users on the published posts"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from modules.data.db_manager import DbManager
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer():
+    """Applies the votes of the users to an in-memory copy of the posts, so that the new tally is known immediately,
+    and writes only the final state of each changed vote to the database, in batches.
+
+    Each vote is appended to a journal and synced to disk before being acknowledged, so that the votes not yet flushed
+    can be recovered if the bot crashes. The journal is replayed when the buffer starts.
+
+    Args:
+        flush_interval (float, optional): seconds between two flushes. Defaults to 1.
+        flush_size (int, optional): number of changed votes that triggers a flush before the interval. Defaults to 500.
+        journal_path (str, optional): file used as journal. If None, the votes are not journaled. Defaults to None.
+        max_posts (int, optional): maximum number of posts kept in memory. Posts with votes not yet flushed \
+            are never removed. Defaults to 1000.
+    """
+
+    def __init__(self,
+                 flush_interval: float = 1,
+                 flush_size: int = 500,
+                 journal_path: Optional[str] = None,
+                 max_posts: int = 1000):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.journal_path = journal_path
+        self.max_posts = max_posts
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._posts = OrderedDict()  # (c_message_id, channel_id) -> {'votes': {user_id: bool}, 'up': int, 'down': int}
+        self._dirty = {}  # (user_id, c_message_id, channel_id) -> new vote, or None if it has been removed
+        self._in_flight = {}  # votes being written by the current flush
+        self._flush_generation = 0  # incremented at the end of each flush
+        self._journal = None
+        self._flushing_paths = []  # journals whose votes are not in the database yet
+        self._wake_up = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.flushed_votes = 0
+
+    def start(self):
+        """Replays the journal left by a previous run, if any, and starts flushing periodically"""
+        if self.journal_path:
+            self._replay_journal()
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="vote_buffer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the periodic flush and writes all the pending votes to the database"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wake_up.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def vote(self, user_id: int, c_message_id: int, channel_id: int, vote: bool) -> Tuple[int, int, bool]:
+        """Adds the vote of the user on a specific post, or update the existing vote, if needed.
+        If the user repeats the same vote, it is removed instead
+
+        Args:
+            user_id (int): id of the user that voted
+            c_message_id (int): id of the post in question in the channel
+            channel_id (int): id of the channel
+            vote (bool): whether it is an upvote or a downvote
+
+        Returns:
+            Tuple[int, int, bool]: number of upvotes and downvotes, whether or not the vote was added or removed
+        """
+        while True:
+            post = self._get_post(c_message_id, channel_id)
+            with self._lock:
+                if self._posts.get((c_message_id, channel_id)) is post:  # it may have been evicted in the meantime
+                    return self._apply_vote(post, user_id, c_message_id, channel_id, vote)
+
+    def _apply_vote(self, post: dict, user_id: int, c_message_id: int, channel_id: int,
+                    vote: bool) -> Tuple[int, int, bool]:
+        """Applies the vote to the in-memory copy of the post and journals it. Must be called holding the lock
+
+        Args:
+            post (dict): in-memory copy of the post
+            user_id (int): id of the user that voted
+            c_message_id (int): id of the post in question in the channel
+            channel_id (int): id of the channel
+            vote (bool): whether it is an upvote or a downvote
+
+        Returns:
+            Tuple[int, int, bool]: number of upvotes and downvotes, whether or not the vote was added or removed
+        """
+        current_vote = post['votes'].get(user_id)
+        if current_vote is not None:
+            post['up' if current_vote else 'down'] -= 1
+        if current_vote == vote:  # the user wants to remove his vote
+            new_vote = None
+            del post['votes'][user_id]
+        else:  # there isn't a vote yet, or the old vote was different from the new vote
+            new_vote = vote
+            post['votes'][user_id] = vote
+            post['up' if vote else 'down'] += 1
+
+        self._write_journal(user_id, c_message_id, channel_id, new_vote)
+        self._dirty[(user_id, c_message_id, channel_id)] = new_vote
+        if len(self._dirty) >= self.flush_size:
+            self._wake_up.set()
+        return post['up'], post['down'], new_vote is not None
+
+    def get_tally(self, c_message_id: int, channel_id: int) -> Optional[Tuple[int, int]]:
+        """Gets the number of upvotes and downvotes of the post, if it is in memory
+
+        Args:
+            c_message_id (int): id of the post in question in the channel
+            channel_id (int): id of the channel
+
+        Returns:
+            Optional[Tuple[int, int]]: number of upvotes and downvotes, or None if the post is not in memory
+        """
+        with self._lock:
+            post = self._posts.get((c_message_id, channel_id))
+            return (post['up'], post['down']) if post is not None else None
+
+    def flush(self) -> int:
+        """Writes all the changed votes and the tallies of their posts to the database, in a single transaction
+
+        Returns:
+            int: number of votes written
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                self._rotate_journal()
+                dirty, self._dirty = self._dirty, {}
+                self._in_flight = dirty
+                tallies = {}
+                for _, c_message_id, channel_id in dirty:
+                    tallies[(c_message_id, channel_id)] = self.get_tally(c_message_id, channel_id)
+                flushing_paths = list(self._flushing_paths)
+
+            try:
+                self._write(dirty, tallies)
+            except Exception:
+                with self._lock:  # put back the votes, unless they have been changed in the meantime
+                    for key, new_vote in dirty.items():
+                        self._dirty.setdefault(key, new_vote)
+                logger.exception("Could not flush %d votes, they will be retried", len(dirty))
+                return 0
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+                    self._flush_generation += 1
+
+            for path in flushing_paths:  # all the votes of these journals are in the database now
+                self._flushing_paths.remove(path)
+                try:
+                    os.remove(path)
+                except OSError as e:  # it would only be replayed again, the votes are already in the database
+                    logger.warning("Could not remove the flushed journal %s: %s", path, e)
+            self.flushes += 1
+            self.flushed_votes += len(dirty)
+            return len(dirty)
+
+    def stats(self) -> dict:
+        """Gets the statistics of the buffer
+
+        Returns:
+            dict: {posts, pending, flushes, flushed_votes}
+        """
+        with self._lock:
+            return {
+                'posts': len(self._posts),
+                'pending': len(self._dirty),
+                'flushes': self.flushes,
+                'flushed_votes': self.flushed_votes
+            }
+
+    def _run(self):
+        """Flushes the buffer every flush_interval seconds, or sooner if too many votes are pending"""
+        while not self._stopped.is_set():
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            if not self._stopped.is_set():
+                try:
+                    self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Error while flushing the votes")
+
+    def _get_post(self, c_message_id: int, channel_id: int) -> dict:
+        """Gets the in-memory copy of the post, loading its votes from the database the first time.
+        The database is read without holding the lock, so the votes on the other posts are not delayed.
+        The votes not yet flushed are applied on top of the ones read
+
+        Args:
+            c_message_id (int): id of the post in question in the channel
+            channel_id (int): id of the channel
+
+        Returns:
+            dict: {votes, up, down}
+        """
+        key = (c_message_id, channel_id)
+        while True:
+            with self._lock:
+                post = self._posts.get(key)
+                if post is not None:
+                    self._posts.move_to_end(key)
+                    return post
+                generation = self._flush_generation
+
+            rows = DbManager.select_from(select="user_id, is_upvote",
+                                         table_name="votes",
+                                         where="c_message_id = %s and channel_id = %s",
+                                         where_args=key,
+                                         row_mode="tuple")
+
+            with self._lock:
+                if key in self._posts:  # loaded by another thread in the meantime
+                    continue
+                if generation != self._flush_generation:  # a flush has ended, the rows read may be outdated
+                    continue
+                votes = {user_id: bool(is_upvote) for user_id, is_upvote in rows}
+                for pending in (self._in_flight, self._dirty):
+                    for (user_id, vote_c_message_id, vote_channel_id), new_vote in pending.items():
+                        if (vote_c_message_id, vote_channel_id) != key:
+                            continue
+                        if new_vote is None:
+                            votes.pop(user_id, None)
+                        else:
+                            votes[user_id] = new_vote
+                n_upvotes = sum(votes.values())
+                post = {'votes': votes, 'up': n_upvotes, 'down': len(votes) - n_upvotes}
+                self._posts[key] = post
+                self._evict(keep=key)
+                return post
+
+    def _evict(self, keep: Tuple[int, int]):
+        """Removes the least recently used posts that have no pending votes, until there are at most max_posts.
+        Must be called holding the lock
+
+        Args:
+            keep (Tuple[int, int]): (c_message_id, channel_id) of the post just loaded, which is never removed
+        """
+        if len(self._posts) <= self.max_posts:
+            return
+        pending_posts = {(c_message_id, channel_id) for _, c_message_id, channel_id in [*self._dirty, *self._in_flight]}
+        for key in list(self._posts):
+            if len(self._posts) <= self.max_posts:
+                break
+            if key not in pending_posts and key != keep:
+                del self._posts[key]
+
+    def _write(self, dirty: dict, tallies: dict):
+        """Writes the votes and the tallies to the database
+
+        Args:
+            dirty (dict): new vote of each (user_id, c_message_id, channel_id), or None if it has been removed
+            tallies (dict): number of upvotes and downvotes of each (c_message_id, channel_id), \
+                or None if the post is no longer in memory
+        """
+        removed = [key for key, new_vote in dirty.items() if new_vote is None]
+        changed = [key + (new_vote, ) for key, new_vote in dirty.items() if new_vote is not None]
+        with DbManager.transaction() as tr:
+            tr.delete_many(table_name="votes", columns=("user_id", "c_message_id", "channel_id"), values_list=removed)
+            tr.execute_many(
+                "INSERT INTO votes (user_id, c_message_id, channel_id, is_upvote) VALUES (%s, %s, %s, %s)\
+                 ON CONFLICT (user_id, c_message_id, channel_id) DO UPDATE SET is_upvote = excluded.is_upvote", changed)
+            tally_rows = []
+            for (c_message_id, channel_id), tally in tallies.items():
+                if tally is None:  # the post is no longer in memory (e.g. votes recovered from the journal)
+                    tally = tr.select_from(select="COUNT(CASE WHEN is_upvote = %s THEN 1 END),\
+                                                   COUNT(CASE WHEN is_upvote = %s THEN 1 END)",
+                                           table_name="votes",
+                                           where="c_message_id = %s and channel_id = %s",
+                                           where_args=(True, False, c_message_id, channel_id),
+                                           row_mode="tuple")[0]
+                tally_rows.append((c_message_id, channel_id) + tuple(tally))
+            tr.execute_many(
+                "INSERT INTO vote_tally (c_message_id, channel_id, up, down) VALUES (%s, %s, %s, %s)\
+                 ON CONFLICT (c_message_id, channel_id) DO UPDATE SET up = excluded.up, down = excluded.down", tally_rows)
+
+    def _write_journal(self, user_id: int, c_message_id: int, channel_id: int, new_vote: Optional[bool]):
+        """Appends the vote to the journal. Must be called holding the lock
+
+        Args:
+            user_id (int): id of the user that voted
+            c_message_id (int): id of the post in question in the channel
+            channel_id (int): id of the channel
+            new_vote (Optional[bool]): new vote, or None if it has been removed
+        """
+        if self._journal is not None:
+            self._journal.write(json.dumps([user_id, c_message_id, channel_id, new_vote]) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _rotate_journal(self):
+        """Moves the journal aside while its votes are being flushed, and starts a new one.
+        If it can't be moved, its votes stay in the current journal. Must be called holding the lock
+        """
+        if self._journal is None:
+            return
+        self._journal.close()
+        try:
+            self._flushing_paths.append(self._move_journal())
+        finally:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _move_journal(self) -> str:
+        """Renames the journal, which must be closed, to a new .flushing file
+
+        Returns:
+            str: new path of the journal
+        """
+        flushing_path = f"{self.journal_path}.{time.time_ns():020d}.flushing"
+        os.replace(self.journal_path, flushing_path)
+        return flushing_path
+
+    def _replay_journal(self):
+        """Flushes the votes of the journals left by a previous run. The last journal is renamed like the ones
+        being flushed first, so that only the new journal opened by start is ever written
+        """
+        directory, name = os.path.split(os.path.abspath(self.journal_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.journal_path):
+            self._move_journal()
+        # the names contain the time they were moved, so the journals are replayed in order
+        paths = sorted(os.path.join(directory, file_name)
+                       for file_name in os.listdir(directory)
+                       if file_name.startswith(name + ".") and file_name.endswith(".flushing"))
+        if not paths:
+            return
+
+        with self._lock:
+            for path in paths:
+                with open(path, "r", encoding="utf-8") as journal:
+                    for line in journal:
+                        try:
+                            user_id, c_message_id, channel_id, new_vote = json.loads(line)
+                        except ValueError:  # the last line may be incomplete after a crash
+                            continue
+                        self._dirty[(user_id, c_message_id, channel_id)] = new_vote
+            self._flushing_paths.extend(paths)
+        if self.flush():
+            logger.info("Recovered the votes of %d journals", len(paths))
@@ -0,0 +1,55 @@
+"""Collects the latency of the callback queries, as perceived by the users"""
+import threading
+from modules.debug.latency_stats import LatencyStats
+
+
+class CallbackStats():
+    """Records, for each kind of callback, how long the user waited for the answer to the query (ack)
+    and how long it took to complete the whole callback, including the database and the edits (total).
+    Both are measured from the moment the handler received the update
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = {}  # data -> {ack, total, failed}
+
+    def record(self, data: str, ack_time: float, total_time: float, failed: bool = False):
+        """Records a callback that has been handled
+
+        Args:
+            data (str): callback_data of the query, like meme_vote_yes
+            ack_time (float): seconds before the query was answered
+            total_time (float): seconds before the callback was completed
+            failed (bool, optional): whether the callback raised an error. Defaults to False.
+        """
+        with self._lock:
+            entry = self._callbacks.get(data)
+            if entry is None:
+                entry = self._callbacks[data] = {'ack': LatencyStats(), 'total': LatencyStats(), 'failed': 0}
+            entry['ack'].add(ack_time)
+            entry['total'].add(total_time)
+            if failed:
+                entry['failed'] += 1
+
+    def snapshot(self) -> dict:
+        """Gets a copy of the statistics collected so far
+
+        Returns:
+            dict: {data: {ack: {count, total_time, avg_time, max_time, rows, buckets}, total: {...}, failed}}
+        """
+        with self._lock:
+            return {
+                data: {
+                    'ack': entry['ack'].snapshot(),
+                    'total': entry['total'].snapshot(),
+                    'failed': entry['failed']
+                } for data, entry in self._callbacks.items()
+            }
+
+    def reset(self):
+        """Discards all the statistics collected so far"""
+        with self._lock:
+            self._callbacks = {}
+
+
+callback_stats = CallbackStats()
@@ -0,0 +1,50 @@
+"""Latency histogram shared by the statistics of the queries and of the callbacks"""
+
+# upper bounds, in seconds, of the buckets of the histograms. The last bucket holds everything slower
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+
+class LatencyStats():
+    """Number, total and maximum duration of a kind of operation, with a histogram of the durations
+    and the number of rows involved. It is not thread safe: the owner must hold its own lock
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, duration: float, rows: int = 0):
+        """Adds an operation to the statistics
+
+        Args:
+            duration (float): seconds the operation took
+            rows (int, optional): rows returned or affected by the operation. Negative values are ignored. Defaults to 0.
+        """
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if rows > 0:
+            self.rows += rows
+        for i, upper_bound in enumerate(BUCKETS):
+            if duration <= upper_bound:
+                self.buckets[i] += 1
+                break
+
+    def snapshot(self) -> dict:
+        """Gets a copy of the statistics, adding the average time and the bounds of the buckets
+
+        Returns:
+            dict: {count, total_time, avg_time, max_time, rows, buckets}. \
+                buckets is a list of [upper bound, number of operations in the bucket]
+        """
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.count if self.count else 0.0,
+            'max_time': self.max_time,
+            'rows': self.rows,
+            'buckets': [[upper_bound, n] for upper_bound, n in zip(BUCKETS, self.buckets)]
+        }
@@ -1,11 +1,30 @@
 """Handles the logging of events"""
+import gzip
+import json
 import logging
-from modules.data.data_reader import get_abs_path
+import os
+import random
+from typing import Iterator
+from telegram import Message
+from modules.data.data_reader import config_map, get_abs_path
+from modules.debug.log_writer import LogWriter
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.info("Logger enabled")
 
+message_log_config = config_map['debug'].get('message_log', {})
+# json writes one compact record per line, that can be read back with read_message_log
+MESSAGE_LOG_FORMAT = message_log_config.get('format', "text")
+MESSAGE_LOG_PATH = get_abs_path("logs", "messages.jsonl" if MESSAGE_LOG_FORMAT == "json" else "messages.log")
+# the messages are written by a background thread, so that logging never slows down the handlers
+message_log = LogWriter(MESSAGE_LOG_PATH,
+                        max_queue=message_log_config.get('max_queue', 10000),
+                        max_bytes=message_log_config.get('max_bytes', 10 * 1024 * 1024),
+                        rotate_interval=message_log_config.get('rotate_interval', 0),
+                        backup_count=message_log_config.get('backup_count', 5),
+                        compress=message_log_config.get('compress', False))
+
 
 def log_message(update, context):
     """Log the message that caused the update
@@ -16,25 +35,121 @@ def log_message(update, context):
     """
     if update.message:
         try:
-            with open(get_abs_path("logs", "messages.log"), "a", encoding="utf8") as log_file:
-
-                user = update.message.from_user
-                chat = update.message.chat
-                message = f"\n___ID MESSAGE:  {str(update.message.message_id)} ____\n"\
-                        "___INFO USER___\n"\
-                        f"user_id:  {str(user.id)}\n"\
-                        f"user_name:  {str(user.username)}\n"\
-                        f"user_first_lastname: {str(user.first_name)} {str(user.last_name)}\n"\
-                        "___INFO CHAT___\n"\
-                        f"chat_id:  {str(chat.id)}\n"\
-                        f"chat_type:  {str(chat.type)}\n"\
-                        f"chat_title:  {str(chat.title)}\n"\
-                        "___TESTO___\n"\
-                        f"text:  {str(update.message.text)}\n"\
-                        f"date:  {str(update.message.date)}"\
-                        "\n_____________\n"
-                log_file.write("\n" + message)
+            if not is_sampled(update.message.chat.id):
+                return
+            if MESSAGE_LOG_FORMAT == "json":
+                message_log.write(format_json(update.message))
+            else:
+                message_log.write(format_text(update.message))
         except AttributeError as e:
             logger.warning(e)
-        except FileNotFoundError as e:
-            logger.error(e)
+
+
+def is_sampled(chat_id: int) -> bool:
+    """Randomly chooses whether a message of the chat should be logged, according to the sample rate of the chat
+
+    Args:
+        chat_id (int): id of the chat
+
+    Returns:
+        bool: whether the message should be logged
+    """
+    # read every time, so that the rates can be changed while the bot is running
+    sample_rates = config_map['debug'].get('message_log', {}).get('sample_rates', {})
+    rate = sample_rates.get(chat_id, sample_rates.get('default', 1))
+    return rate >= 1 or random.random() < rate
+
+
+def format_text(message: Message) -> str:
+    """Formats the message as a human readable block of text
+
+    Args:
+        message (Message): message to log
+
+    Returns:
+        str: record to write in the log
+    """
+    user = message.from_user
+    chat = message.chat
+    return f"\n\n___ID MESSAGE:  {str(message.message_id)} ____\n"\
+        "___INFO USER___\n"\
+        f"user_id:  {str(user.id)}\n"\
+        f"user_name:  {str(user.username)}\n"\
+        f"user_first_lastname: {str(user.first_name)} {str(user.last_name)}\n"\
+        "___INFO CHAT___\n"\
+        f"chat_id:  {str(chat.id)}\n"\
+        f"chat_type:  {str(chat.type)}\n"\
+        f"chat_title:  {str(chat.title)}\n"\
+        "___TESTO___\n"\
+        f"text:  {str(message.text)}\n"\
+        f"date:  {str(message.date)}"\
+        "\n_____________\n"
+
+
+def format_json(message: Message) -> str:
+    """Formats the message as a single line of json. The fields without a value are left out
+
+    Args:
+        message (Message): message to log
+
+    Returns:
+        str: record to write in the log
+    """
+    user = message.from_user
+    chat = message.chat
+    record = {
+        'message_id': message.message_id,
+        'user_id': user.id if user else None,
+        'user_name': user.username if user else None,
+        'first_name': user.first_name if user else None,
+        'last_name': user.last_name if user else None,
+        'chat_id': chat.id,
+        'chat_type': chat.type,
+        'chat_title': chat.title,
+        'text': message.text,
+        'date': int(message.date.timestamp()) if message.date else None
+    }
+    return json.dumps({key: value for key, value in record.items() if value is not None},
+                      ensure_ascii=False,
+                      separators=(",", ":")) + "\n"
+
+
+def read_message_log(path: str = MESSAGE_LOG_PATH,
+                     chat_id: int = None,
+                     user_id: int = None,
+                     since: int = None) -> Iterator[dict]:
+    """Reads the records of the json message log one at a time, oldest first, including the rotated files
+
+    Args:
+        path (str, optional): path of the log. Defaults to the current message log.
+        chat_id (int, optional): only yield the messages of this chat. Defaults to None.
+        user_id (int, optional): only yield the messages of this user. Defaults to None.
+        since (int, optional): only yield the messages sent after this unix timestamp. Defaults to None.
+
+    Yields:
+        Iterator[dict]: records of the log
+    """
+    paths = []
+    i = 1
+    while os.path.exists(f"{path}.{i}") or os.path.exists(f"{path}.{i}.gz"):
+        paths.append(f"{path}.{i}" if os.path.exists(f"{path}.{i}") else f"{path}.{i}.gz")
+        i += 1
+    paths.reverse()  # the higher the number, the older the file
+    if os.path.exists(path):
+        paths.append(path)
+
+    for log_path in paths:
+        opener = gzip.open if log_path.endswith(".gz") else open
+        with opener(log_path, "rt", encoding="utf8") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # e.g. the last line, if the bot stopped while writing it
+                    continue
+                if chat_id is not None and record.get('chat_id') != chat_id:
+                    continue
+                if user_id is not None and record.get('user_id') != user_id:
+                    continue
+                if since is not None and record.get('date', 0) < since:
+                    continue
+                yield record
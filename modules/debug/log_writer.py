@@ -0,0 +1,199 @@
+"""Writes log records to a file from a background thread"""
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter():
+    """Appends records to a file without blocking the caller: the records are queued and a background thread
+    writes them in batches, keeping the file open. If the queue is full the record is dropped (and counted),
+    unless block_timeout is set, in which case the caller waits up to block_timeout seconds for some space.
+    The file is rotated when it grows over max_bytes or gets older than rotate_interval: the old files are renamed
+    path.1, path.2, ... (path.1.gz, ... if compress is true), and only backup_count of them are kept
+
+    Args:
+        path (str): path of the log file
+        max_queue (int, optional): records waiting to be written after which new records are dropped. Defaults to 10000.
+        batch_size (int, optional): maximum number of records written at once. Defaults to 100.
+        flush_interval (float, optional): seconds after which the written records are flushed to disk. Defaults to 1.
+        max_bytes (int, optional): size after which the file is rotated. 0 means never. Defaults to 10 MiB.
+        rotate_interval (float, optional): seconds after which the file is rotated. 0 means never. Defaults to 0.
+        backup_count (int, optional): number of rotated files kept. Defaults to 5.
+        compress (bool, optional): whether the rotated files are compressed with gzip. Defaults to False.
+        block_timeout (float, optional): seconds a caller waits if the queue is full. 0 means drop at once. \
+            Defaults to 0.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_queue: int = 10000,
+                 batch_size: int = 100,
+                 flush_interval: float = 1,
+                 max_bytes: int = 10 * 1024 * 1024,
+                 rotate_interval: float = 0,
+                 backup_count: int = 5,
+                 compress: bool = False,
+                 block_timeout: float = 0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._opened_at = 0.0
+        self._stats_lock = threading.Lock()  # dropped is updated by the callers and the background thread
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def write(self, record: str) -> bool:
+        """Queues the record, to be written to the file as it is
+
+        Args:
+            record (str): text to append to the file
+
+        Returns:
+            bool: whether the record has been queued, False if it has been dropped
+        """
+        if self._thread is None:
+            self._start()
+        try:
+            if self.block_timeout > 0:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+
+    def close(self):
+        """Writes the records still in the queue, then stops the background thread and closes the file"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)  # wakes up the thread, which stops after writing everything before it
+            thread.join()
+
+    def stats(self) -> dict:
+        """Gets the statistics of the writer
+
+        Returns:
+            dict: {queued, written, dropped, rotations, errors}
+        """
+        with self._stats_lock:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'rotations': self.rotations,
+                'errors': self.errors
+            }
+
+    def _start(self):
+        """Starts the background thread, if it is not running"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log_writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        """Writes the queued records until close is called"""
+        last_flush = time.monotonic()
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            if batch:
+                self._write(batch)
+            if self._file is not None and (stopped or time.monotonic() - last_flush >= self.flush_interval):
+                self._file.flush()
+                last_flush = time.monotonic()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _next_batch(self) -> Tuple[List[str], bool]:
+        """Waits up to flush_interval for the next records in the queue, taking at most batch_size of them
+
+        Returns:
+            Tuple[List[str], bool]: records to write, possibly none, and whether close has been called
+        """
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return [], False
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:  # close has been called
+            return batch[:batch.index(None)], True
+        return batch, False
+
+    def _write(self, batch: list):
+        """Writes the records to the file, rotating it first if needed
+
+        Args:
+            batch (list): records to write
+        """
+        try:
+            if self._file is not None and self._should_rotate():
+                self._rotate()
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf8")
+                self._opened_at = time.monotonic()
+            self._file.write("".join(batch))
+            with self._stats_lock:
+                self.written += len(batch)
+        except OSError as e:
+            with self._stats_lock:
+                self.errors += 1
+                self.dropped += len(batch)
+            logger.error("Could not write %d records to %s: %s", len(batch), self.path, e)
+
+    def _should_rotate(self) -> bool:
+        """Checks whether the file is too big or too old
+
+        Returns:
+            bool: whether the file has to be rotated
+        """
+        if 0 < self.max_bytes <= self._file.tell():
+            return True
+        return 0 < self.rotate_interval <= time.monotonic() - self._opened_at
+
+    def _rotate(self):
+        """Closes the file and renames it path.1, shifting the older files and deleting the ones exceeding backup_count"""
+        self._file.close()
+        self._file = None
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}{suffix}"):
+                os.replace(f"{self.path}.{i}{suffix}", f"{self.path}.{i + 1}{suffix}")
+        if self.backup_count <= 0:
+            os.remove(self.path)
+        elif self.compress:
+            with open(self.path, "rb") as source, gzip.open(f"{self.path}.1.gz", "wb") as destination:
+                shutil.copyfileobj(source, destination)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, f"{self.path}.1")
+        with self._stats_lock:
+            self.rotations += 1
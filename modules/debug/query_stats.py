@@ -0,0 +1,99 @@
+"""Collects the timing of the queries run on the database"""
+import logging
+import re
+import threading
+from functools import lru_cache
+from modules.data.data_reader import config_map
+from modules.debug.latency_stats import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats():
+    """Records the latency and the number of rows of every query, grouped by statement shape,
+    and the time spent waiting for a connection.
+    A statement shape is the query with its whitespace collapsed and its literal values and placeholders replaced by ?,
+    so that the same query with different arguments is counted once.
+
+    Args:
+        enabled (bool, optional): whether anything is recorded. Defaults to True.
+        slow_query_threshold (float, optional): seconds after which a query is logged with its arguments. \
+            0 means never. Defaults to 0.
+    """
+    def __init__(self, enabled: bool = True, slow_query_threshold: float = 0):
+        self.enabled = enabled
+        self.slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self._queries = {}  # shape -> LatencyStats
+        self._acquire = LatencyStats()
+
+    def record_query(self, query: str, args, duration: float, rows: int):
+        """Records a query that has been run
+
+        Args:
+            query (str): query, with %s placeholders
+            args: arguments of the query
+            duration (float): seconds the query took
+            rows (int): number of rows returned or affected, or -1 if unknown
+        """
+        if not self.enabled:
+            return
+        shape = self.shape(query)
+        with self._lock:
+            entry = self._queries.get(shape)
+            if entry is None:
+                entry = self._queries[shape] = LatencyStats()
+            entry.add(duration, rows)
+        if 0 < self.slow_query_threshold <= duration:
+            logger.warning("Slow query (%.3fs, %d rows): %s, args: %.200r", duration, rows, shape, args)
+
+    def record_acquire(self, duration: float):
+        """Records the time spent waiting for a database connection
+
+        Args:
+            duration (float): seconds needed to get the connection
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._acquire.add(duration)
+
+    def snapshot(self) -> dict:
+        """Gets a copy of the statistics collected so far. The queries are sorted by total time, slowest first
+
+        Returns:
+            dict: {queries: {shape: {count, total_time, avg_time, max_time, rows, buckets}}, acquire: {...}}. \
+                buckets is a list of [upper bound, number of queries in the bucket]
+        """
+        with self._lock:
+            queries = sorted(self._queries.items(), key=lambda item: item[1].total_time, reverse=True)
+            return {
+                'queries': {shape: entry.snapshot() for shape, entry in queries},
+                'acquire': self._acquire.snapshot()
+            }
+
+    def reset(self):
+        """Discards all the statistics collected so far"""
+        with self._lock:
+            self._queries = {}
+            self._acquire = LatencyStats()
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def shape(query: str) -> str:
+        """Normalizes the query, so that the same statement with different values has the same shape
+
+        Args:
+            query (str): query to normalize
+
+        Returns:
+            str: shape of the query
+        """
+        query = re.sub(r"'(?:[^']|'')*'", "?", query)
+        query = re.sub(r"\b\d+(?:\.\d+)?\b", "?", query)
+        query = query.replace("%s", "?")
+        return re.sub(r"\s+", " ", query).strip()
+
+
+query_stats = QueryStats(enabled=config_map['debug'].get('query_stats', True),
+                         slow_query_threshold=config_map['debug'].get('slow_query_threshold', 0))
@@ -1,18 +1,36 @@
 """Commands for the meme bot"""
+import logging
+import time
 from typing import Tuple
-from telegram import Update, InlineKeyboardMarkup, ParseMode
+from telegram import Update, InlineKeyboardMarkup, ParseMode, TelegramError
 from telegram.ext import CallbackContext
 from modules.data.data_reader import config_map
 from modules.data.meme_data import MemeData
+from modules.debug.callback_stats import callback_stats
 from modules.utils.info_util import get_callback_info
+from modules.utils.keyed_lock import KeyedLock
+from modules.utils.keyboard_refresher import KeyboardRefresher
 from modules.utils.keyboard_util import update_approve_kb, update_vote_kb
 from modules.utils.post_util import send_post_to, show_admins_votes
 
+logger = logging.getLogger(__name__)
+
 STATE = {'posting': 1, 'confirm': 2, 'end': -1}
+# callbacks answered as soon as they are received, before their database work, with the text shown to the user
+EARLY_ANSWER_CALLBACKS = {
+    'meme_approve_yes': None,
+    'meme_approve_no': None,
+    'meme_vote_yes': "Hai premuto 👍",
+    'meme_vote_no': "Hai premuto 👎"
+}
+kb_refresher = KeyboardRefresher(window=config_map['meme'].get('kb_refresh_window', 1))
+post_locks = KeyedLock()  # (chat_id, message_id) of the posts whose votes are being handled
 
 
 def meme_callback(update: Update, context: CallbackContext) -> int:
-    """Passes the callback to the correct handler
+    """Passes the callback to the correct handler.
+    The votes are answered before being handled, so that the spinner of the user stops immediately,
+    and the user is notified if the vote could not be saved
 
     Args:
         update (Update): update event
@@ -21,27 +39,79 @@ def meme_callback(update: Update, context: CallbackContext) -> int:
     Returns:
         int: value passed to the handler, if requested
     """
+    received_at = time.monotonic()
     info = get_callback_info(update, context)
     data = info['data']
-    try:
-        message_text, reply_markup, output = globals()[f'{data[5:]}_callback'](update,
-                                                                               context)  # call the function based on its name
-    except KeyError:
-        message_text = reply_markup = output = None
+    answered_early = data in EARLY_ANSWER_CALLBACKS
+    if answered_early:  # the toast shows the button pressed: the keyboard, once edited, shows the result
+        info['bot'].answer_callback_query(callback_query_id=info['query_id'], text=EARLY_ANSWER_CALLBACKS[data])
+    ack_time = time.monotonic() - received_at
+
+    callback = globals().get(f'{data[5:]}_callback')  # the function based on the name of the callback
+    if callback is None:
         print("[error] (meme) meme_callback: the function corrisponding to this callback_data was not found")
         print(f"callback_data: {data}, Argument passed: {data[5:]}_callback")
+        return None
+
+    shown = KeyboardRefresher.render(update.callback_query.message.reply_markup)  # the handlers edit it in place
+    try:
+        message_text, reply_markup, output = callback(update, context)
+    except Exception:  # pylint: disable=broad-except
+        if not answered_early:  # the user is still waiting for the answer: let the dispatcher handle the error
+            raise
+        logger.exception("Failed to handle %s on message %s of chat %s", data, info['message_id'], info['chat_id'])
+        notify_failure(info)
+        callback_stats.record(data, ack_time, time.monotonic() - received_at, failed=True)
+        return None
+
+    edit_menu(info, message_text, reply_markup, shown)
+    if answered_early:
+        callback_stats.record(data, ack_time, time.monotonic() - received_at)
+    return output
+
 
+def edit_menu(info: dict, message_text: str, reply_markup: InlineKeyboardMarkup, shown: tuple):
+    """Edits the message of the callback with the text and reply_markup returned by the handler
+
+    Args:
+        info (dict): info of the callback, see get_callback_info
+        message_text (str): new text of the message, if any
+        reply_markup (InlineKeyboardMarkup): new reply_markup of the message, if any
+        shown (tuple): reply_markup shown before the callback, see KeyboardRefresher.render
+    """
     if message_text:  # if there is a valid text, edit the menu with the new text
         info['bot'].edit_message_text(chat_id=info['chat_id'],
                                       message_id=info['message_id'],
                                       text=message_text,
                                       reply_markup=reply_markup,
                                       parse_mode=ParseMode.MARKDOWN_V2)
+    elif reply_markup and info['data'].startswith("meme_vote_"):  # votes come in bursts: coalesce the edits of the same post
+        kb_refresher.schedule(bot=info['bot'],
+                              chat_id=info['chat_id'],
+                              message_id=info['message_id'],
+                              reply_markup=reply_markup,
+                              shown=shown)
     elif reply_markup:  # if there is a valid reply_markup, edit the menu with the new reply_markup
         info['bot'].edit_message_reply_markup(chat_id=info['chat_id'],
                                               message_id=info['message_id'],
                                               reply_markup=reply_markup)
-    return output
+
+
+def notify_failure(info: dict):
+    """Tells the user that the callback, already answered, could not be completed.
+    Users who never started the bot can't be notified
+
+    Args:
+        info (dict): info of the callback, see get_callback_info
+    """
+    if info['data'].startswith("meme_vote_"):
+        text = "Non è stato possibile registrare il tuo voto\nRiprova fra qualche istante"
+    else:
+        text = "Non è stato possibile registrare la tua valutazione del post\nRiprova fra qualche istante"
+    try:
+        info['bot'].send_message(chat_id=info['sender_id'], text=text)
+    except TelegramError as e:
+        logger.warning("Could not notify user %s of the failure: %s", info['sender_id'], e)
 
 
 # region handle meme_callback
@@ -145,27 +215,32 @@ def approve_yes_callback(update: Update, context: CallbackContext) -> Tuple[str,
         Tuple[str, InlineKeyboardMarkup, int]: text and replyMarkup that make up the reply, new conversation state
     """
     info = get_callback_info(update, context)
-    n_approve = MemeData.set_admin_vote(info['sender_id'], info['message_id'], info['chat_id'], True)
-
-    # The post passed the approval phase and is to be published
-    if n_approve >= config_map['meme']['n_votes']:
-        message = update.callback_query.message
+    # only one admin at a time can vote on the post, so that it can't be published twice
+    with post_locks.hold((info['chat_id'], info['message_id'])):
         user_id = MemeData.get_user_id(g_message_id=info['message_id'], group_id=info['chat_id'])
-        published_post = send_post_to(message=message, bot=info['bot'], destination="channel")
+        if user_id is None:  # the post has already been approved or rejected
+            return None, None, None
+        n_approve, n_reject = MemeData.set_admin_vote(info['sender_id'], info['message_id'], info['chat_id'], True)
+
+        # The post passed the approval phase and is to be published
+        if n_approve >= config_map['meme']['n_votes']:
+            message = update.callback_query.message
+            published_post = send_post_to(message=message, bot=info['bot'], destination="channel")
 
-        if config_map['meme']['comments']:  # if comments are enabled, save the user_id, so the user can be credited
-            context.bot_data[f"{published_post.chat_id},{published_post.message_id}"] = user_id
+            if config_map['meme']['comments']:  # if comments are enabled, save the user_id, so the user can be credited
+                MemeData.post_authors.put(published_post.chat_id, published_post.message_id, user_id)
 
-        info['bot'].send_message(chat_id=user_id, text="Il tuo ultimo post è stato approvato")  # notify the user
+            info['bot'].send_message(chat_id=user_id, text="Il tuo ultimo post è stato approvato")  # notify the user
 
-        # Shows the list of admins who approved the pending post and removes it form the db
-        show_admins_votes(chat_id=info['chat_id'], message_id=info['message_id'], bot=info['bot'], approve=True)
-        MemeData.remove_pending_meme(info['message_id'], info['chat_id'])
-        return None, None, None
+            # Shows the list of admins who approved the pending post and removes it form the db
+            show_admins_votes(chat_id=info['chat_id'], message_id=info['message_id'], bot=info['bot'], approve=True)
+            MemeData.remove_pending_meme(info['message_id'], info['chat_id'])
+            return None, None, None
 
     if n_approve != -1:  # the vote changed
         keyboard = update.callback_query.message.reply_markup.inline_keyboard
-        return None, update_approve_kb(keyboard, info['message_id'], info['chat_id'], approve=n_approve), None
+        return None, update_approve_kb(keyboard, info['message_id'], info['chat_id'], approve=n_approve,
+                                       reject=n_reject), None
 
     return None, None, None
 
@@ -183,23 +258,28 @@ def approve_no_callback(update: Update, context: CallbackContext) -> Tuple[str,
         Tuple[str, InlineKeyboardMarkup, int]: text and replyMarkup that make up the reply, new conversation state
     """
     info = get_callback_info(update, context)
-    n_reject = MemeData.set_admin_vote(info['sender_id'], info['message_id'], info['chat_id'], False)
-
-    # The post has been refused
-    if n_reject >= config_map['meme']['n_votes']:
+    # only one admin at a time can vote on the post, so that it can't be rejected twice
+    with post_locks.hold((info['chat_id'], info['message_id'])):
         user_id = MemeData.get_user_id(g_message_id=info['message_id'], group_id=info['chat_id'])
-        info['bot'].send_message(
-            chat_id=user_id,
-            text="Il tuo ultimo post è stato rifiutato\nPuoi controllare le regole con /rules")  # notify the user
+        if user_id is None:  # the post has already been approved or rejected
+            return None, None, None
+        n_approve, n_reject = MemeData.set_admin_vote(info['sender_id'], info['message_id'], info['chat_id'], False)
 
-        # Shows the list of admins who refused the pending post and removes it form the db
-        show_admins_votes(chat_id=info['chat_id'], message_id=info['message_id'], bot=info['bot'], approve=False)
-        MemeData.remove_pending_meme(info['message_id'], info['chat_id'])
-        return None, None, None
+        # The post has been refused
+        if n_reject >= config_map['meme']['n_votes']:
+            info['bot'].send_message(
+                chat_id=user_id,
+                text="Il tuo ultimo post è stato rifiutato\nPuoi controllare le regole con /rules")  # notify the user
+
+            # Shows the list of admins who refused the pending post and removes it form the db
+            show_admins_votes(chat_id=info['chat_id'], message_id=info['message_id'], bot=info['bot'], approve=False)
+            MemeData.remove_pending_meme(info['message_id'], info['chat_id'])
+            return None, None, None
 
     if n_reject != -1:  # the vote changed
         keyboard = update.callback_query.message.reply_markup.inline_keyboard
-        return None, update_approve_kb(keyboard, info['message_id'], info['chat_id'], reject=n_reject), None
+        return None, update_approve_kb(keyboard, info['message_id'], info['chat_id'], approve=n_approve,
+                                       reject=n_reject), None
 
     return None, None, None
 
@@ -216,20 +296,15 @@ def vote_yes_callback(update: Update, context: CallbackContext) -> Tuple[str, In
         Tuple[str, InlineKeyboardMarkup, int]: text and replyMarkup that make up the reply, new conversation state
     """
     info = get_callback_info(update, context)
-    n_upvotes, was_added = MemeData.set_user_vote(user_id=info['sender_id'],
-                                                  c_message_id=info['message_id'],
-                                                  channel_id=info['chat_id'],
-                                                  vote=True)
-
-    if n_upvotes != -1:  # the vote changed
-        if was_added:
-            info['bot'].answerCallbackQuery(callback_query_id=info['query_id'], text="Hai messo un 👍")
-        else:
-            info['bot'].answerCallbackQuery(callback_query_id=info['query_id'], text="Hai tolto il 👍")
-        keyboard = update.callback_query.message.reply_markup.inline_keyboard
-        return None, update_vote_kb(keyboard, info['message_id'], info['chat_id'], upvote=n_upvotes), None
+    # the concurrent votes on the post wait here, instead of holding a database connection while waiting for the lock
+    with post_locks.hold((info['chat_id'], info['message_id'])):
+        n_upvotes, n_downvotes, _ = MemeData.set_user_vote(user_id=info['sender_id'],
+                                                           c_message_id=info['message_id'],
+                                                           channel_id=info['chat_id'],
+                                                           vote=True)
 
-    return None, None, None
+    keyboard = update.callback_query.message.reply_markup.inline_keyboard
+    return None, update_vote_kb(keyboard, info['message_id'], info['chat_id'], upvote=n_upvotes, downvote=n_downvotes), None
 
 
 def vote_no_callback(update: Update, context: CallbackContext) -> Tuple[str, InlineKeyboardMarkup, int]:
@@ -244,20 +319,15 @@ def vote_no_callback(update: Update, context: CallbackContext) -> Tuple[str, Inl
         Tuple[str, InlineKeyboardMarkup, int]: text and replyMarkup that make up the reply, new conversation state
     """
     info = get_callback_info(update, context)
-    n_downvotes, was_added = MemeData.set_user_vote(user_id=info['sender_id'],
-                                                    c_message_id=info['message_id'],
-                                                    channel_id=info['chat_id'],
-                                                    vote=False)
-
-    if n_downvotes != -1:  # the vote changed
-        if was_added:
-            info['bot'].answerCallbackQuery(callback_query_id=info['query_id'], text="Hai messo un 👎")
-        else:
-            info['bot'].answerCallbackQuery(callback_query_id=info['query_id'], text="Hai tolto il 👎")
-        keyboard = update.callback_query.message.reply_markup.inline_keyboard
-        return None, update_vote_kb(keyboard, info['message_id'], info['chat_id'], downvote=n_downvotes), None
-
-    return None, None, None
+    # the concurrent votes on the post wait here, instead of holding a database connection while waiting for the lock
+    with post_locks.hold((info['chat_id'], info['message_id'])):
+        n_upvotes, n_downvotes, _ = MemeData.set_user_vote(user_id=info['sender_id'],
+                                                           c_message_id=info['message_id'],
+                                                           channel_id=info['chat_id'],
+                                                           vote=False)
+
+    keyboard = update.callback_query.message.reply_markup.inline_keyboard
+    return None, update_vote_kb(keyboard, info['message_id'], info['chat_id'], upvote=n_upvotes, downvote=n_downvotes), None
 
 
 # endregion
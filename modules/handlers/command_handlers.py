@@ -1,12 +1,14 @@
 """Commands for the meme bot"""
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 from telegram.ext import CallbackContext
-from modules.data.data_reader import read_md, config_map
+from modules.data.data_reader import config_map
+from modules.data.markdown_registry import markdown
 from modules.data.meme_data import MemeData
 from modules.utils.info_util import get_message_info, check_message_type
 from modules.utils.post_util import send_post_to
 
 STATE = {'posting': 1, 'confirm': 2, 'end': -1}
+FORWARD_AUTHOR_WAIT = 5  # seconds the forward of a post waits for its author to be saved
 
 
 # region cmd
@@ -18,7 +20,7 @@ def start_cmd(update: Update, context: CallbackContext):
         context (CallbackContext): context passed by the handler
     """
     info = get_message_info(update, context)
-    text = read_md("meme_start")
+    text = markdown.get("meme_start")
     info['bot'].send_message(chat_id=info['chat_id'],
                              text=text,
                              parse_mode=ParseMode.MARKDOWN_V2,
@@ -34,9 +36,9 @@ def help_cmd(update: Update, context: CallbackContext):
     """
     info = get_message_info(update, context)
     if info['chat_id'] == config_map['meme']['group_id']:  # if you are in the admin group
-        text = read_md("meme_instructions")
+        text = markdown.get("meme_instructions")
     else:  # you are NOT in the admin group
-        text = read_md("meme_help")
+        text = markdown.get("meme_help")
     info['bot'].send_message(chat_id=info['chat_id'],
                              text=text,
                              parse_mode=ParseMode.MARKDOWN_V2,
@@ -51,7 +53,7 @@ def rules_cmd(update: Update, context: CallbackContext):
         context (CallbackContext): context passed by the handler
     """
     info = get_message_info(update, context)
-    text = read_md("meme_rules")
+    text = markdown.get("meme_rules")
     info['bot'].send_message(chat_id=info['chat_id'],
                              text=text,
                              parse_mode=ParseMode.MARKDOWN_V2,
@@ -250,9 +252,10 @@ def forwarded_post_msg(update: Update, context: CallbackContext):
     forward_from_id = update.message.forward_from_message_id
 
     if info['chat_id'] == config_map['meme']['channel_group_id'] and forward_from_chat_id == config_map['meme']['channel_id']:
-        user_id = context.bot_data[f"{forward_from_chat_id},{forward_from_id}"]
+        # the forward may be handled before approve_yes_callback has saved the author, so it waits for it a little.
+        # None if unknown: the post is anonym
+        user_id = MemeData.post_authors.pop(forward_from_chat_id, forward_from_id, wait=FORWARD_AUTHOR_WAIT)
         send_post_to(message=update.message, bot=info['bot'], destination="channel_group", user_id=user_id)
-        del context.bot_data[f"{forward_from_chat_id},{forward_from_id}"]
 
 
 # endregion
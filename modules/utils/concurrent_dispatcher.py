@@ -0,0 +1,161 @@
+"""Dispatcher that handles many updates at the same time, keeping the order of the updates of each chat"""
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Hashable, Union
+from telegram import Update, TelegramError
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentDispatcher(Dispatcher):
+    """Dispatcher whose updates are scheduled by an asyncio event loop and handled by a pool of threads.
+    Updates with the same ordering key (see get_key) form a lane and are handled one at a time, in the order
+    they were received, while updates of different lanes run concurrently.
+    The handlers are the same of the standard dispatcher, added with add_handler
+
+    Args:
+        concurrency (int, optional): number of updates handled at the same time. Defaults to 8.
+        max_pending (int, optional): number of updates received but not yet handled after which \
+            the dispatcher stops reading new updates. Defaults to 1000.
+        args: positional arguments of the Dispatcher
+        kwargs: keyword arguments of the Dispatcher
+    """
+
+    def __init__(self, *args, concurrency: int = 8, max_pending: int = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._idle = threading.Condition()
+        self._n_pending = 0
+        self._lanes = {}  # key -> deque of updates, only used by the event loop thread
+        self._loop = None
+        self._loop_thread = None
+        self._executor = None
+        self.processed = 0
+        self.max_lanes = 0
+
+    @staticmethod
+    def get_key(update: Update) -> Hashable:
+        """Gets the ordering key of the update. The updates with the same key are handled in order.
+        Callback queries in groups and channels are ordered per message, so that the votes on different posts
+        don't wait for each other. Everything else is ordered per chat (or per user, if there is no chat)
+
+        Args:
+            update (Update): update to order
+
+        Returns:
+            Hashable: ordering key of the update
+        """
+        chat = update.effective_chat
+        if update.callback_query is not None and update.callback_query.message is not None and chat.type != chat.PRIVATE:
+            return chat.id, update.callback_query.message.message_id
+        if chat is not None:
+            return chat.id
+        if update.effective_user is not None:
+            return "user", update.effective_user.id
+        return "update", update.update_id
+
+    def start(self, ready: threading.Event = None):
+        """Starts the event loop and the threads that handle the updates, then reads the update queue
+
+        Args:
+            ready (threading.Event, optional): set once the dispatcher is ready. Defaults to None.
+        """
+        if self._loop is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="dispatcher")
+            self._loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._loop.run_forever, name="dispatcher_loop", daemon=True)
+            self._loop_thread.start()
+        super().start(ready)
+
+    def stop(self):
+        """Stops reading the update queue, waits for the updates already received to be handled
+        and stops the event loop
+        """
+        super().stop()
+        with self._idle:
+            self._idle.wait_for(lambda: self._n_pending == 0)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._executor.shutdown(wait=True)
+            self._loop = self._loop_thread = self._executor = None
+
+    def process_update(self, update: Union[str, Update, TelegramError]):
+        """Schedules the update in its lane. Errors and updates received before start are handled immediately.
+        Blocks if max_pending updates are waiting
+
+        Args:
+            update (Union[str, Update, TelegramError]): update to handle
+        """
+        if not isinstance(update, Update) or self._loop is None:
+            super().process_update(update)
+            return
+        self._pending.acquire()
+        with self._idle:
+            self._n_pending += 1
+        self._loop.call_soon_threadsafe(self._enqueue, update)
+
+    def stats(self) -> dict:
+        """Gets the statistics of the dispatcher
+
+        Returns:
+            dict: {processed, pending, lanes, max_lanes}
+        """
+        return {
+            'processed': self.processed,
+            'pending': self._n_pending,
+            'lanes': len(self._lanes),
+            'max_lanes': self.max_lanes
+        }
+
+    def _enqueue(self, update: Update):
+        """Adds the update to its lane, starting the lane if it was idle. Runs in the event loop
+
+        Args:
+            update (Update): update to handle
+        """
+        key = self.get_key(update)
+        lane = self._lanes.get(key)
+        if lane is not None:  # the lane is already running: the update will be handled after the others
+            lane.append(update)
+            return
+        self._lanes[key] = deque([update])
+        self.max_lanes = max(self.max_lanes, len(self._lanes))
+        self._loop.create_task(self._run_lane(key))
+
+    async def _run_lane(self, key: Hashable):
+        """Handles the updates of the lane one at a time, until it is empty. Runs in the event loop
+
+        Args:
+            key (Hashable): ordering key of the lane
+        """
+        lane = self._lanes[key]
+        while lane:
+            update = lane.popleft()
+            try:
+                await self._loop.run_in_executor(self._executor, self._handle, update)
+            finally:
+                self._pending.release()
+                with self._idle:
+                    self._n_pending -= 1
+                    self.processed += 1
+                    self._idle.notify_all()
+        del self._lanes[key]
+
+    def _handle(self, update: Update):
+        """Handles the update with the handlers of the dispatcher. Runs in a thread of the executor
+
+        Args:
+            update (Update): update to handle
+        """
+        try:
+            super().process_update(update)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Unhandled error while processing %s", update.update_id)
@@ -0,0 +1,206 @@
+"""Coalesces the edits of the inline keyboards of the posts that receive many votes at the same time"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class KeyboardRefresher():
+    """Debounces the edits of the inline keyboard of each message.
+    The first edit requested for a message starts a window: when it ends, only the latest keyboard requested
+    in the meantime is sent, and only if its buttons differ from the ones already shown.
+    The edits of the same message are sent one at a time, so an older keyboard never replaces a newer one.
+    An edit refused by the flood control, or lost because of the network, is retried later,
+    unless a newer keyboard has been requested in the meantime
+
+    Args:
+        window (float, optional): seconds an edit can be delayed. If 0, the edits are sent immediately. Defaults to 1.
+        max_messages (int, optional): number of messages whose shown keyboard is remembered. Defaults to 1000.
+        max_retries (int, optional): times an edit is retried after a network error. Defaults to 5.
+    """
+
+    def __init__(self, window: float = 1, max_messages: int = 1000, max_retries: int = 5):
+        self.window = window
+        self.max_messages = max_messages
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pending = {}  # (chat_id, message_id) -> (bot, reply_markup, rendered, retries)
+        self._publishing = set()  # messages with a timer running or an edit being sent
+        self._shown = OrderedDict()  # (chat_id, message_id) -> rendered keyboard currently shown
+        self.requested = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.retried = 0
+
+    @staticmethod
+    def render(reply_markup: Optional[InlineKeyboardMarkup]) -> Tuple[str]:
+        """Gets what the user sees of the keyboard, used to tell if an edit would change anything
+
+        Args:
+            reply_markup (Optional[InlineKeyboardMarkup]): keyboard to render
+
+        Returns:
+            Tuple[str]: text of all the buttons
+        """
+        if reply_markup is None:
+            return ()
+        return tuple(button.text for row in reply_markup.inline_keyboard for button in row)
+
+    def schedule(self,
+                 bot: Bot,
+                 chat_id: int,
+                 message_id: int,
+                 reply_markup: InlineKeyboardMarkup,
+                 shown: Optional[Tuple[str]] = None):
+        """Requests the edit of the keyboard of the message
+
+        Args:
+            bot (Bot): bot used to edit the message
+            chat_id (int): id of the chat of the message
+            message_id (int): id of the message
+            reply_markup (InlineKeyboardMarkup): new keyboard
+            shown (Optional[Tuple[str]], optional): rendering of the keyboard the message had when the update was sent, \
+                used if no edit of this message has been sent yet. Defaults to None.
+        """
+        key = (chat_id, message_id)
+        rendered = self.render(reply_markup)
+        with self._lock:
+            self.requested += 1
+            if shown is not None and key not in self._shown:
+                self._remember(key, shown)
+            if key in self._pending:  # an edit is already waiting: it will send this keyboard instead
+                self.coalesced += 1
+            self._pending[key] = (bot, reply_markup, rendered, 0)
+            if key in self._publishing:  # the keyboard will be sent after the edit in progress
+                return
+            self._publishing.add(key)
+
+        self._publish_after(key, self.window)
+
+    def stats(self) -> dict:
+        """Gets the statistics of the refresher
+
+        Returns:
+            dict: {requested, sent, coalesced, unchanged, failed, retried, saved}
+        """
+        with self._lock:
+            return {
+                'requested': self.requested,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'unchanged': self.unchanged,
+                'failed': self.failed,
+                'retried': self.retried,
+                'saved': self.coalesced + self.unchanged
+            }
+
+    def _publish_after(self, key: Tuple[int, int], delay: float):
+        """Publishes the keyboard of the message after delay seconds, or immediately if delay is 0
+
+        Args:
+            key (Tuple[int, int]): chat_id and message_id of the message
+            delay (float): seconds to wait
+        """
+        if delay > 0:
+            timer = threading.Timer(delay, self._publish, args=(key, ))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._publish(key)
+
+    def _publish(self, key: Tuple[int, int]):
+        """Sends the latest keyboard requested for the message, if it changes what is shown.
+        Then, if another keyboard has been requested or the edit has to be retried, schedules it
+
+        Args:
+            key (Tuple[int, int]): chat_id and message_id of the message
+        """
+        delay = 0
+        while delay == 0:
+            with self._lock:
+                bot, reply_markup, rendered, retries = self._pending.pop(key)
+                unchanged = self._shown.get(key) == rendered
+                if unchanged:
+                    self.unchanged += 1
+
+            retry_after = None if unchanged else self._edit(bot, key, reply_markup, rendered, retries)
+
+            with self._lock:
+                if retry_after is not None and key not in self._pending:  # a newer keyboard replaces this one
+                    self.retried += 1
+                    self._pending[key] = (bot, reply_markup, rendered, retries + 1)
+                if key not in self._pending:
+                    self._publishing.discard(key)
+                    return
+            delay = retry_after if retry_after is not None else self.window
+        self._publish_after(key, delay)
+
+    def _edit(self, bot: Bot, key: Tuple[int, int], reply_markup: InlineKeyboardMarkup, rendered: Tuple[str],
+              retries: int) -> Optional[float]:
+        """Edits the keyboard of the message
+
+        Args:
+            bot (Bot): bot used to edit the message
+            key (Tuple[int, int]): chat_id and message_id of the message
+            reply_markup (InlineKeyboardMarkup): new keyboard
+            rendered (Tuple[str]): rendering of the new keyboard
+            retries (int): times the edit has already been retried
+
+        Returns:
+            Optional[float]: seconds after which the edit should be retried, or None if it must not be retried
+        """
+        try:
+            bot.edit_message_reply_markup(chat_id=key[0], message_id=key[1], reply_markup=reply_markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                with self._lock:
+                    self.failed += 1
+                logger.warning("Could not edit the keyboard of %s: %s", key, e)
+                return None
+            with self._lock:
+                self.unchanged += 1
+                self._remember(key, rendered)
+            return None
+        except RetryAfter as e:  # flood control: the keyboard will be sent as soon as it is allowed
+            logger.info("Flood control on the keyboard of %s, retrying in %.1fs", key, e.retry_after)
+            return e.retry_after
+        except NetworkError as e:
+            if retries < self.max_retries:
+                logger.info("Could not edit the keyboard of %s, retrying: %s", key, e)
+                return max(self.window, 1) * 2**retries
+            with self._lock:
+                self.failed += 1
+            logger.warning("Could not edit the keyboard of %s: %s", key, e)
+            return None
+        except TelegramError as e:
+            with self._lock:
+                self.failed += 1
+            logger.warning("Could not edit the keyboard of %s: %s", key, e)
+            return None
+        except Exception:  # pylint: disable=broad-except
+            with self._lock:  # the next keyboards of the message must still be sent
+                self.failed += 1
+            logger.exception("Error while editing the keyboard of %s", key)
+            return None
+        with self._lock:
+            self.sent += 1
+            self._remember(key, rendered)
+        return None
+
+    def _remember(self, key: Tuple[int, int], rendered: Tuple[str]):
+        """Stores the keyboard shown by the message. Must be called holding the lock
+
+        Args:
+            key (Tuple[int, int]): chat_id and message_id of the message
+            rendered (Tuple[str]): rendering of the keyboard shown
+        """
+        self._shown[key] = rendered
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.max_messages:
+            self._shown.popitem(last=False)
@@ -0,0 +1,63 @@
+"""Locks identified by a key, like the (chat_id, message_id) of a post"""
+import threading
+from contextlib import contextmanager
+from typing import Hashable, Iterator
+
+
+class KeyedLock():
+    """Gives a separate lock to each key, so that the operations on the same key run one at a time
+    while the ones on different keys run concurrently.
+    A lock exists only while some thread holds it or waits for it, so the number of keys is not bounded
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}  # key -> [lock, number of threads holding or waiting for it]
+        self.contended = 0
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        """Holds the lock of the key for the duration of the with block
+
+        Args:
+            key (Hashable): key to lock
+
+        Yields:
+            Iterator[None]: nothing. The lock is released when the block ends
+        """
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            elif entry[1] > 0:
+                self.contended += 1
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def is_locked(self, key: Hashable) -> bool:
+        """Checks whether some thread is holding, or waiting for, the lock of the key
+
+        Args:
+            key (Hashable): key to check
+
+        Returns:
+            bool: whether the key is locked
+        """
+        with self._lock:
+            return key in self._locks
+
+    def stats(self) -> dict:
+        """Gets the statistics of the locks
+
+        Returns:
+            dict: {keys, contended}
+        """
+        with self._lock:
+            return {'keys': len(self._locks), 'contended': self.contended}
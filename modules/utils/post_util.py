@@ -4,6 +4,7 @@ from telegram import Message, Bot, InlineKeyboardMarkup
 from modules.data.data_reader import config_map
 from modules.data.meme_data import MemeData
 from modules.utils.keyboard_util import get_approve_kb, get_vote_kb
+from modules.utils.profile_cache import profile_cache
 
 
 def send_post_to(message: Message, bot: Bot, destination: str, user_id: int = None) -> Message:
@@ -102,7 +103,7 @@ def send_helper_message(user_id: int,
     """
     sign = anonym_name()
     if MemeData.is_credited(user_id=user_id):  # the user wants to be credited
-        username = bot.getChat(user_id).username
+        username = profile_cache.get(bot, user_id).username
         if username:
             sign = "@" + username
 
@@ -123,9 +124,8 @@ def show_admins_votes(chat_id: int, message_id: int, bot: Bot, approve: bool):
     """
     admins = MemeData.get_admin_list_votes(g_message_id=message_id, group_id=chat_id, approve=approve)
     text = "Approvato da:\n" if approve else "Rifiutato da:\n"
-    for admin in admins:
-        username = bot.get_chat(admin).username
-        text += f"@{username}\n" if username else f"{bot.get_chat(admin).first_name}\n"
+    for profile in profile_cache.get_many(bot, admins).values():  # the admins not in the cache are asked in parallel
+        text += f"@{profile.username}\n" if profile.username else f"{profile.first_name}\n"
 
     bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
     bot.send_message(chat_id=chat_id, text=text, reply_to_message_id=message_id)
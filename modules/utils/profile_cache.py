@@ -0,0 +1,168 @@
+"""In-memory copy of the username and first name of the users, to avoid asking Telegram for them"""
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable
+from telegram import Bot, Update, User
+from telegram.ext import CallbackContext
+from modules.data.data_reader import config_map
+
+logger = logging.getLogger(__name__)
+
+Profile = namedtuple("Profile", ("username", "first_name"))
+
+
+class ProfileCache():
+    """Keeps the profiles of the users most recently seen, so that showing their name doesn't need a getChat.
+    The profiles are refreshed for free with the users found in the incoming updates (see remember),
+    and asked to Telegram only when missing or older than ttl. Many missing profiles are asked in parallel,
+    and concurrent requests for the same profile share a single getChat.
+
+    Args:
+        max_size (int, optional): maximum number of profiles kept. The least recently used are removed first. \
+            Defaults to 10000.
+        ttl (float, optional): seconds after which a profile is asked again to Telegram. Defaults to 3600.
+        workers (int, optional): getChat sent at the same time. Defaults to 8.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600, workers: int = 8):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()  # user_id -> (Profile, time it was saved), least recently used first
+        self._in_flight: Dict[int, Future] = {}  # user_id -> getChat being sent
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def remember(self, update: Update, context: CallbackContext):  # pylint: disable=unused-argument
+        """Handler that saves the profile of the user who sent the update. It never stops the other handlers
+
+        Args:
+            update (Update): update event
+            context (CallbackContext): context passed by the handler
+        """
+        if isinstance(update, Update) and update.effective_user is not None:
+            self.put(update.effective_user)
+
+    def put(self, user: User):
+        """Saves the profile of the user
+
+        Args:
+            user (User): user, or chat of the user, with the username and first_name to save
+        """
+        with self._lock:
+            self.refreshes += 1
+            self._save(user.id, Profile(user.username, user.first_name))
+
+    def get(self, bot: Bot, user_id: int) -> Profile:
+        """Gets the profile of the user, asking it to Telegram if it is not in the cache
+
+        Args:
+            bot (Bot): bot used to ask the profile
+            user_id (int): id of the user
+
+        Returns:
+            Profile: username (None if the user has none) and first name of the user
+        """
+        return self.get_many(bot, (user_id, ))[user_id]
+
+    def get_many(self, bot: Bot, user_ids: Iterable[int]) -> Dict[int, Profile]:
+        """Gets the profiles of the users. The ones not in the cache are asked to Telegram in parallel
+
+        Args:
+            bot (Bot): bot used to ask the profiles
+            user_ids (Iterable[int]): ids of the users
+
+        Returns:
+            Dict[int, Profile]: profile of each user, in the same order of user_ids
+        """
+        profiles = {}
+        futures = {}
+        now = time.monotonic()
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._profiles.get(user_id)
+                if entry is not None and now - entry[1] < self.ttl:
+                    self.hits += 1
+                    self._profiles.move_to_end(user_id)
+                    profiles[user_id] = entry[0]
+                    continue
+                self.misses += 1
+                profiles[user_id] = None  # keeps the order of user_ids
+                future = self._in_flight.get(user_id)
+                if future is None:  # nobody else is asking for this profile
+                    future = self._in_flight[user_id] = self._get_executor().submit(self._fetch, bot, user_id)
+                futures[user_id] = future
+
+        for user_id, future in futures.items():
+            profiles[user_id] = future.result()
+        return profiles
+
+    def invalidate(self, user_id: int):
+        """Discards the profile of the user, so that it is asked to Telegram the next time it is used
+
+        Args:
+            user_id (int): id of the user
+        """
+        with self._lock:
+            self._profiles.pop(user_id, None)
+
+    def stats(self) -> dict:
+        """Gets the statistics of the cache
+
+        Returns:
+            dict: {size, hits, misses, refreshes}
+        """
+        with self._lock:
+            return {'size': len(self._profiles), 'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Gets the executor that sends the getChat, creating it the first time. Must be called holding the lock
+
+        Returns:
+            ThreadPoolExecutor: executor of the getChat
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="profile_cache")
+        return self._executor
+
+    def _fetch(self, bot: Bot, user_id: int) -> Profile:
+        """Asks the profile of the user to Telegram and saves it. Runs in a thread of the executor
+
+        Args:
+            bot (Bot): bot used to ask the profile
+            user_id (int): id of the user
+
+        Returns:
+            Profile: profile of the user
+        """
+        try:
+            chat = bot.get_chat(user_id)
+            profile = Profile(chat.username, chat.first_name)
+            with self._lock:
+                self._save(user_id, profile)
+            return profile
+        finally:
+            with self._lock:
+                del self._in_flight[user_id]
+
+    def _save(self, user_id: int, profile: Profile):
+        """Saves the profile, removing the least recently used ones if the cache is full. Must be called holding the lock
+
+        Args:
+            user_id (int): id of the user
+            profile (Profile): profile of the user
+        """
+        self._profiles[user_id] = (profile, time.monotonic())
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+
+profile_cache = ProfileCache(max_size=config_map['data'].get('profile_cache_size', 10000),
+                             ttl=config_map['data'].get('profile_cache_ttl', 3600))
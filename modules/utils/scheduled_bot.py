@@ -0,0 +1,308 @@
+"""Bot whose requests to the Telegram API are queued by priority and sent within the rate limits"""
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union
+from telegram import Bot
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# priority of each kind of request: the lower, the sooner it is sent. Requests not listed are sent immediately
+PRIORITIES = {
+    'answerCallbackQuery': 0,  # the user is waiting for the spinner to stop
+    'editMessageReplyMarkup': 1,
+    'editMessageText': 1,
+    'editMessageCaption': 1,
+    'getChat': 1,  # the handler is waiting for the result
+    'deleteMessage': 1,
+}
+NOTIFICATION_PRIORITY = 2  # every sendX request, like the user notifications and the posts
+N_PRIORITIES = 3
+
+
+class TokenBucket():
+    """Allows at most rate requests per second on average, with bursts of up to capacity requests
+
+    Args:
+        rate (float): tokens added each second
+        capacity (float): maximum number of tokens
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Gets how long to wait before a token is available
+
+        Args:
+            now (float): current time.monotonic()
+
+        Returns:
+            float: seconds to wait, 0 if a token is available
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Consumes a token. wait_time must have returned 0 just before"""
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Empties the bucket, so that no token is available for the specified time
+
+        Args:
+            now (float): current time.monotonic()
+            seconds (float): seconds without tokens
+        """
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated_at = now
+
+
+class ScheduledBot(Bot):
+    """Bot that queues the requests to the Telegram API, instead of sending them as soon as they are made.
+    The queued requests are sent by priority (callback answers, then edits and lookups, then new messages),
+    within a global rate limit and, for the new messages, a rate limit for each chat.
+    The edits are only subject to the global limit, so the keyboards of the voted posts are not delayed
+    by the messages sent to the same group.
+    A request rejected with a 429 error is queued again after the time asked by Telegram.
+    The methods keep blocking the caller until their request has been sent, and return the same results of Bot
+
+    Args:
+        global_rate (float, optional): requests sent each second. Defaults to 30.
+        chat_rate (float, optional): messages sent each second to a private chat. Defaults to 1.
+        chat_burst (int, optional): messages that can be sent at once to a private chat. Defaults to 3.
+        group_rate (float, optional): messages sent each second to a group or channel. Defaults to 20 / 60.
+        group_burst (int, optional): messages that can be sent at once to a group or channel. Defaults to 20.
+        max_retries (int, optional): times a request is retried after a 429 error. Defaults to 3.
+        senders (int, optional): requests sent at the same time. Defaults to 8.
+        args: positional arguments of the Bot
+        kwargs: keyword arguments of the Bot
+    """
+
+    def __init__(self,
+                 *args,
+                 global_rate: float = 30,
+                 chat_rate: float = 1,
+                 chat_burst: int = 3,
+                 group_rate: float = 20 / 60,
+                 group_burst: int = 20,
+                 max_retries: int = 3,
+                 senders: int = 8,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.senders = senders
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+        self._queues = [OrderedDict() for _ in range(N_PRIORITIES)]  # priority -> chat_id -> deque of requests
+        self._delayed = []  # heap of (time, sequence, request) waiting for their retry_after
+        self._sequence = 0
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    def stats(self) -> dict:
+        """Gets the statistics of the queue
+
+        Returns:
+            dict: {depth, depth_by_priority, delayed, max_depth, sent, retried, failed, avg_wait}
+        """
+        with self._cond:
+            depth_by_priority = [sum(len(requests) for requests in queue.values()) for queue in self._queues]
+            return {
+                'depth': sum(depth_by_priority),
+                'depth_by_priority': depth_by_priority,
+                'delayed': len(self._delayed),
+                'max_depth': self.max_depth,
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed,
+                'avg_wait': self.total_wait / self.sent if self.sent else 0.0
+            }
+
+    def _post(self,
+              endpoint: str,
+              data: dict = None,
+              timeout: float = None,
+              api_kwargs: dict = None) -> Union[bool, dict, None]:
+        """Queues the request, if it has a priority, and waits for it to be sent
+
+        Args:
+            endpoint (str): method of the Telegram API
+            data (dict, optional): parameters of the method. Defaults to None.
+            timeout (float, optional): timeout of the http request. Defaults to None.
+            api_kwargs (dict, optional): additional parameters of the method. Defaults to None.
+
+        Returns:
+            Union[bool, dict, None]: result of the request
+        """
+        priority = PRIORITIES.get(endpoint, NOTIFICATION_PRIORITY if endpoint.startswith("send") else None)
+        if priority is None:  # e.g. getUpdates, which must not wait behind the messages
+            return super()._post(endpoint, data, timeout=timeout, api_kwargs=api_kwargs)
+
+        chat_id = (data or {}).get('chat_id') if endpoint.startswith(("send", "edit")) else None
+        request = {
+            'endpoint': endpoint,
+            'args': (data, timeout, api_kwargs),
+            'priority': priority,
+            'chat_id': chat_id,
+            'chat_limited': endpoint.startswith("send"),  # whether the rate limit of the chat applies
+            'queued_at': time.monotonic(),
+            'retries': 0,
+            'future': Future()
+        }
+        with self._cond:
+            self._start()
+            self._enqueue(request)
+        return request['future'].result()
+
+    def _start(self):
+        """Starts the thread that sends the requests, if it is not running. Must be called holding the lock"""
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="bot_sender")
+            self._thread = threading.Thread(target=self._run, name="bot_scheduler", daemon=True)
+            self._thread.start()
+
+    def _enqueue(self, request: dict):
+        """Adds the request to the queue of its priority and chat. Must be called holding the lock
+
+        Args:
+            request (dict): request to send
+        """
+        queue = self._queues[request['priority']]
+        queue.setdefault(request['chat_id'], deque()).append(request)
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._cond.notify()
+
+    def _run(self):
+        """Sends the queued requests as soon as the rate limits allow it"""
+        while True:
+            with self._cond:
+                request, wait = self._next_request()
+                while request is None:
+                    self._cond.wait(wait)
+                    request, wait = self._next_request()
+            self._executor.submit(self._send, request)
+
+    def _next_request(self) -> tuple:
+        """Removes from the queues the first request that can be sent now. Must be called holding the lock
+
+        Returns:
+            tuple: the request, or None and the seconds to wait before trying again (None to wait for a new request)
+        """
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:  # the retry_after has passed
+            self._enqueue(heapq.heappop(self._delayed)[2])
+        wait = self._delayed[0][0] - now if self._delayed else None
+
+        global_wait = self._global_bucket.wait_time(now)
+        for queue in self._queues:
+            if not queue:
+                continue
+            if global_wait > 0:
+                return None, global_wait
+            for chat_id in list(queue):
+                requests = queue[chat_id]
+                chat_limited = chat_id is not None and requests[0]['chat_limited']
+                chat_wait = self._chat_bucket(chat_id).wait_time(now) if chat_limited else 0
+                if chat_wait > 0:  # this chat has to wait: try the next one
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                request = requests.popleft()
+                if requests:
+                    queue.move_to_end(chat_id)  # the other chats go first next time
+                else:
+                    del queue[chat_id]
+                self._depth -= 1
+                self._global_bucket.take()
+                if chat_limited:
+                    self._chat_buckets[chat_id].take()
+                return request, None
+        return None, wait
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        """Gets the bucket of the chat, creating it the first time. Must be called holding the lock
+
+        Args:
+            chat_id (Union[int, str]): id of the chat
+
+        Returns:
+            TokenBucket: bucket of the chat
+        """
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            if is_private:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > 10000:  # forget the chats not used for a long time
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _send(self, request: dict):
+        """Sends the request and completes its future. On a 429 error the request is queued again
+
+        Args:
+            request (dict): request to send
+        """
+        data, timeout, api_kwargs = request['args']
+        try:
+            result = super()._post(request['endpoint'], data, timeout=timeout, api_kwargs=api_kwargs)
+        except RetryAfter as e:
+            if request['retries'] < self.max_retries:
+                self._retry(request, e.retry_after)
+                return
+            with self._cond:
+                self.failed += 1
+            request['future'].set_exception(e)
+        except Exception as e:  # pylint: disable=broad-except
+            with self._cond:
+                self.failed += 1
+            request['future'].set_exception(e)
+        else:
+            with self._cond:
+                self.sent += 1
+                self.total_wait += time.monotonic() - request['queued_at']
+            request['future'].set_result(result)
+
+    def _retry(self, request: dict, retry_after: float):
+        """Queues the request again after retry_after seconds, and stops sending to its chat until then
+
+        Args:
+            request (dict): request rejected by Telegram
+            retry_after (float): seconds to wait, as asked by Telegram
+        """
+        logger.warning("Flood control on %s, retrying in %.1fs", request['endpoint'], retry_after)
+        with self._cond:
+            now = time.monotonic()
+            request['retries'] += 1
+            self.retried += 1
+            if request['chat_id'] is not None:
+                self._chat_bucket(request['chat_id']).pause(now, retry_after)
+            else:
+                self._global_bucket.pause(now, retry_after)
+            self._sequence += 1
+            heapq.heappush(self._delayed, (now + retry_after, self._sequence, request))
+            self._cond.notify()
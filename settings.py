@@ -63,9 +63,9 @@ def main():
 
     config_map['token'] = args['token']
     config_map['data']['remote'] = args['remote']
-    config_map['data']['db_url'] = args['database']
+    config_map['data']['db_url'] = args['database'] or ""
     config_map['webhook']['enabled'] = args['webhook']
-    config_map['webhook']['url'] = args['urlwebhook']
+    config_map['webhook']['url'] = args['urlwebhook'] or ""
 
     config_map['meme']['group_id'] = args['group_id']
     config_map['meme']['channel_id'] = args['channel_id']
@@ -96,8 +96,10 @@ async def db_results() -> dict:
     print("[info] initialized the db")
 
     DbManager.use_remote_db = True
+    DbManager.migrate("data", "db", "migrations")
     DbManager.query_from_file("data/db/db_test.sql")
     DbManager.use_remote_db = False
+    DbManager.migrate("data", "db", "migrations")
     DbManager.query_from_file("data/db/db_test.sql")
 
     with open("tests/db_results.yaml", 'r') as yaml_config:
@@ -0,0 +1,384 @@
+"""Test the handlers when many updates are handled at the same time"""
+import sqlite3
+import threading
+import time
+from queue import Queue
+from unittest.mock import MagicMock
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import TypeHandler
+from modules.data.data_reader import config_map
+from modules.data.db_manager import DbManager
+from modules.data.db_pool import BoundedPool
+from modules.data.meme_data import MemeData
+from modules.data.post_author_store import PostAuthorStore
+from modules.debug.callback_stats import callback_stats
+from modules.handlers.callback_handlers import approve_yes_callback, meme_callback
+from modules.utils.concurrent_dispatcher import ConcurrentDispatcher
+from modules.utils.keyboard_refresher import KeyboardRefresher
+from modules.utils.profile_cache import Profile, ProfileCache
+from modules.utils.scheduled_bot import ScheduledBot
+
+GROUP_ID = -4242
+G_MESSAGE_ID = 4242
+N_ADMINS = 8
+
+
+def test_concurrent_approvals(db_results, monkeypatch):
+    """Tests that a post approved by many admins at the same time is published exactly once
+    """
+    monkeypatch.setitem(config_map['meme'], 'n_votes', 2)
+    monkeypatch.setitem(config_map['meme'], 'comments', True)
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        MemeData.insert_pending_post(user_message=MagicMock(message_id=1, from_user=MagicMock(id=1)),
+                                     admin_message=MagicMock(message_id=G_MESSAGE_ID, chat_id=GROUP_ID))
+        bot = MagicMock()
+        barrier = threading.Barrier(N_ADMINS)
+
+        def approve(admin_id: int):
+            update = MagicMock()
+            update.callback_query.message.chat_id = GROUP_ID
+            update.callback_query.message.message_id = G_MESSAGE_ID
+            update.callback_query.message.text = "meme"
+            update.callback_query.from_user.id = admin_id
+            barrier.wait()  # all the admins vote at the same moment
+            approve_yes_callback(update, MagicMock(bot=bot, bot_data={}))
+
+        threads = [threading.Thread(target=approve, args=(admin_id, )) for admin_id in range(N_ADMINS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert bot.sendMessage.call_count == 1  # the post has been sent to the channel once
+        assert MemeData.get_user_id(g_message_id=G_MESSAGE_ID, group_id=GROUP_ID) is None
+
+
+def test_scheduled_bot():
+    """Tests that the ScheduledBot sends the callback answers first and retries the requests refused with a 429 error
+    """
+    sent = []
+    refused = []
+
+    def post(url: str, data: dict = None, timeout: float = None):  # pylint: disable=unused-argument
+        endpoint = url.rsplit('/', 1)[1]
+        if endpoint == "sendMessage" and not refused:
+            refused.append(data)
+            raise RetryAfter(0.1)
+        sent.append(endpoint)
+        return True
+
+    bot = ScheduledBot("123:token", request=MagicMock(post=post), chat_rate=100, chat_burst=1, senders=1)
+    threads = [threading.Thread(target=bot._post, args=("sendMessage", {'chat_id': 1})) for _ in range(3)]
+    threads += [threading.Thread(target=bot._post, args=("answerCallbackQuery", {})) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(sent) == ["answerCallbackQuery"] * 3 + ["sendMessage"] * 3
+    assert sent[-1] == "sendMessage"
+    assert bot.stats()['retried'] == 1
+    assert bot.stats()['depth'] == 0
+
+
+def test_scheduled_bot_edits():
+    """Tests that the edits are not subject to the rate limit of their chat, while the new messages are
+    """
+    sent = []
+
+    def post(url: str, data: dict = None, timeout: float = None):  # pylint: disable=unused-argument
+        sent.append(url.rsplit('/', 1)[1])
+        return True
+
+    bot = ScheduledBot("123:token", request=MagicMock(post=post), group_rate=0.01, group_burst=1, senders=1)
+    start = time.monotonic()
+    for _ in range(5):
+        bot._post("editMessageReplyMarkup", {'chat_id': -100})
+    bot._post("sendMessage", {'chat_id': -100})
+
+    assert time.monotonic() - start < 1
+    assert sent == ["editMessageReplyMarkup"] * 5 + ["sendMessage"]
+    thread = threading.Thread(target=bot._post, args=("sendMessage", {'chat_id': -100}), daemon=True)
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()  # the second message to the group waits for the rate limit
+
+
+def test_callback_answered_first(monkeypatch):
+    """Tests that a vote is answered before it is saved, and that the user is notified if it can't be saved
+    """
+    calls = []
+
+    def set_user_vote(**kwargs):  # pylint: disable=unused-argument
+        calls.append("set_user_vote")
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(MemeData, "set_user_vote", set_user_vote)
+    bot = MagicMock()
+    bot.answer_callback_query.side_effect = lambda **kwargs: calls.append("answer_callback_query")
+    update = MagicMock()
+    update.callback_query.data = "meme_vote_yes"
+    update.callback_query.from_user.id = 1
+    update.callback_query.message.reply_markup = None
+
+    assert meme_callback(update, MagicMock(bot=bot)) is None
+    assert calls == ["answer_callback_query", "set_user_vote"]
+    assert bot.answer_callback_query.call_args.kwargs['text'] == "Hai premuto 👍"
+    bot.send_message.assert_called_once()
+    assert bot.send_message.call_args.kwargs['chat_id'] == 1
+    assert "voto" in bot.send_message.call_args.kwargs['text']
+
+
+def test_approval_failure_notified(monkeypatch):
+    """Tests that an admin whose approval could not be saved is told so, and not that a vote failed
+    """
+
+    def get_user_id(**kwargs):  # pylint: disable=unused-argument
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(MemeData, "get_user_id", get_user_id)
+    bot = MagicMock()
+    update = MagicMock()
+    update.callback_query.data = "meme_approve_yes"
+    update.callback_query.from_user.id = 1
+
+    assert meme_callback(update, MagicMock(bot=bot)) is None
+    assert bot.answer_callback_query.call_args.kwargs['text'] is None
+    assert "valutazione" in bot.send_message.call_args.kwargs['text']
+    assert callback_stats.snapshot()['meme_vote_yes']['failed'] == 1
+
+
+def make_update(update_id: int, chat_id: int, chat_type: str = "private", callback_message_id: int = None) -> Update:
+    """Creates an update with a text message, or with a callback query on a message if callback_message_id is set
+
+    Args:
+        update_id (int): id of the update
+        chat_id (int): id of the chat
+        chat_type (str, optional): type of the chat. Defaults to "private".
+        callback_message_id (int, optional): id of the message of the callback query. Defaults to None.
+
+    Returns:
+        Update: the update
+    """
+    user = {'id': 1, 'is_bot': False, 'first_name': "test"}
+    message = {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': chat_type}, 'text': str(update_id)}
+    if callback_message_id is None:
+        return Update.de_json({'update_id': update_id, 'message': message}, None)
+    message['message_id'] = callback_message_id
+    callback_query = {'id': str(update_id), 'from': user, 'chat_instance': "1", 'data': "vote", 'message': message}
+    return Update.de_json({'update_id': update_id, 'callback_query': callback_query}, None)
+
+
+def test_lane_keys():
+    """Tests that the callbacks in groups are ordered per message, and everything else per chat
+    """
+    get_key = ConcurrentDispatcher.get_key
+
+    assert get_key(make_update(1, 10)) == 10
+    assert get_key(make_update(2, 10, callback_message_id=5)) == 10
+    assert get_key(make_update(3, -20, "supergroup")) == -20
+    assert get_key(make_update(4, -20, "supergroup", callback_message_id=5)) == (-20, 5)
+    assert get_key(make_update(5, -20, "supergroup", callback_message_id=6)) == (-20, 6)
+
+
+def test_lane_ordering():
+    """Tests that the updates of the same chat are handled in order, while different chats run concurrently
+    """
+    handled = []
+    running = []
+    overlaps = []
+    max_running = []
+    lock = threading.Lock()
+
+    def handle(update: Update, context):  # pylint: disable=unused-argument
+        chat_id = update.effective_chat.id
+        with lock:
+            if chat_id in running:  # only one update of a chat can run at a time
+                overlaps.append(update.update_id)
+            running.append(chat_id)
+            max_running.append(len(running))
+        time.sleep(0.01 * (update.update_id % 3))  # the updates take a different time to be handled
+        with lock:
+            handled.append((chat_id, update.update_id))
+            running.remove(chat_id)
+
+    dispatcher = ConcurrentDispatcher(MagicMock(), Queue(), workers=0, use_context=True, concurrency=4)
+    dispatcher.add_handler(TypeHandler(Update, handle))
+    ready = threading.Event()
+    thread = threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, daemon=True)
+    thread.start()
+    ready.wait()
+    for update_id in range(40):
+        dispatcher.update_queue.put(make_update(update_id, chat_id=update_id % 4))
+    dispatcher.stop()
+    thread.join()
+
+    assert len(handled) == 40
+    assert not overlaps
+    for chat_id in range(4):
+        assert [update_id for chat, update_id in handled if chat == chat_id] == list(range(chat_id, 40, 4))
+    assert max(max_running) > 1
+    assert dispatcher.stats()['pending'] == 0
+
+
+def test_post_author_wait(db_results):
+    """Tests that the forward of a post waits for its author, which is saved after the post is published
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.migrate("data", "db", "migrations")
+        store = PostAuthorStore()
+        timer = threading.Timer(0.1, store.put, kwargs={'channel_id': -1, 'c_message_id': 1, 'user_id': 10})
+        timer.start()
+
+        assert store.pop(-1, 1, wait=5) == 10
+        assert store.pop(-1, 2, wait=0.05) is None
+        timer.join()
+
+
+def make_keyboard(n_votes: int) -> InlineKeyboardMarkup:
+    """Creates the keyboard of a post with the number of votes
+
+    Args:
+        n_votes (int): number of votes shown
+
+    Returns:
+        InlineKeyboardMarkup: the keyboard
+    """
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text=f"👍 {n_votes}", callback_data="meme_vote_yes")]])
+
+
+def test_keyboard_refresher_coalesce():
+    """Tests that only the last keyboard requested during the window is sent
+    """
+    bot = MagicMock()
+    refresher = KeyboardRefresher(window=0.1)
+    for n_votes in range(3):
+        refresher.schedule(bot, chat_id=1, message_id=1, reply_markup=make_keyboard(n_votes))
+    time.sleep(0.3)
+
+    bot.edit_message_reply_markup.assert_called_once_with(chat_id=1, message_id=1, reply_markup=make_keyboard(2))
+    assert refresher.stats()['coalesced'] == 2
+
+
+def test_keyboard_refresher_retry():
+    """Tests that an edit that timed out is retried, and that a newer keyboard replaces the one refused
+    by the flood control
+    """
+    sent = []
+    refresher = KeyboardRefresher(window=0)
+
+    def edit(chat_id: int, message_id: int, reply_markup: InlineKeyboardMarkup):  # pylint: disable=unused-argument
+        if len(sent) == 0:
+            sent.append(None)
+            raise TimedOut()
+        if len(sent) == 1:
+            sent.append(None)
+            refresher.schedule(bot, chat_id=1, message_id=1, reply_markup=make_keyboard(2))  # a vote arrives
+            raise RetryAfter(0.1)
+        sent.append(reply_markup)
+
+    bot = MagicMock()
+    bot.edit_message_reply_markup.side_effect = edit
+    refresher.schedule(bot, chat_id=1, message_id=1, reply_markup=make_keyboard(1))
+    time.sleep(1.5)
+
+    assert sent == [None, None, make_keyboard(2)]
+    assert refresher.stats()['retried'] == 1
+    assert refresher.stats()['failed'] == 0
+
+
+def test_keyboard_refresher_order():
+    """Tests that with no window the edits of the same message are sent one at a time, in order
+    """
+    sent = []
+    editing = threading.Event()
+    release = threading.Event()
+
+    def edit(chat_id: int, message_id: int, reply_markup: InlineKeyboardMarkup):  # pylint: disable=unused-argument
+        editing.set()
+        release.wait()
+        sent.append(reply_markup)
+
+    bot = MagicMock()
+    bot.edit_message_reply_markup.side_effect = edit
+    refresher = KeyboardRefresher(window=0)
+    first = threading.Thread(target=refresher.schedule, args=(bot, 1, 1, make_keyboard(1)))
+    first.start()
+    editing.wait()
+    refresher.schedule(bot, 1, 1, make_keyboard(2))  # returns at once: it is sent after the first edit
+    refresher.schedule(bot, 1, 1, make_keyboard(3))
+    release.set()
+    first.join()
+
+    assert sent == [make_keyboard(1), make_keyboard(3)]
+
+
+def test_bounded_pool_check():
+    """Tests that checking an idle connection does not stop the other threads from using the pool,
+    and that a dead connection is replaced
+    """
+    checking = threading.Event()
+    release = threading.Event()
+
+    def check(conn: MagicMock) -> bool:  # pylint: disable=unused-argument
+        checking.set()
+        release.wait(2)
+        return False
+
+    pool = BoundedPool(connect=lambda: MagicMock(closed=False), check=check, max_size=2, timeout=1, check_after=0)
+    pool.release(pool.acquire())
+    result = {}
+    checker = threading.Thread(target=lambda: result.setdefault('conn', pool.acquire()))
+    checker.start()
+    checking.wait()
+    start = time.monotonic()
+    other = pool.acquire()
+    waited = time.monotonic() - start
+    pool.release(other, discard=True)
+    release.set()
+    checker.join()
+
+    assert waited < 1  # did not wait for the check to end
+    assert result['conn'] is not None
+    assert pool.stats()['size'] == 1
+    assert pool.stats()['idle'] == 0
+
+
+def test_profile_cache_get_many():
+    """Tests that the missing profiles are asked to Telegram in parallel, once each, even when asked by many threads,
+    and that the cache keeps only the most recently used ones
+    """
+    asked = []
+    asking = threading.Barrier(3)  # the getChat of users 1, 2 and 3 are sent at the same time
+
+    def get_chat(user_id: int) -> MagicMock:
+        asked.append(user_id)
+        asking.wait(timeout=5)
+        return MagicMock(username=f"user{user_id}", first_name=f"name{user_id}")
+
+    bot = MagicMock()
+    bot.get_chat.side_effect = get_chat
+    cache = ProfileCache(max_size=3, ttl=60, workers=4)
+    others = []
+    other = threading.Thread(target=lambda: others.append(cache.get_many(bot, (2, 3))))
+    other.start()
+    profiles = cache.get_many(bot, (3, 1, 2))
+    other.join()
+
+    assert sorted(asked) == [1, 2, 3]
+    assert list(profiles) == [3, 1, 2]
+    assert profiles[1] == Profile("user1", "name1")
+    assert others[0] == {2: profiles[2], 3: profiles[3]}
+
+    hits = cache.stats()['hits']
+    cache.get_many(bot, (1, 2))
+    cache.put(MagicMock(id=4, username=None, first_name="name4"))  # removes user 3, the least recently used
+    assert cache.get(bot, 4) == Profile(None, "name4")
+    assert cache.stats()['size'] == 3
+    assert cache.stats()['hits'] == hits + 3
+    asking = threading.Barrier(1)
+    assert cache.get(bot, 3) == profiles[3]
+    assert asked[3:] == [3]
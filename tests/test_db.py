@@ -1,7 +1,18 @@
 """Test all the modules related to data management"""
+import json
+import os
+import pytest
+from modules.data.async_db_manager import AsyncDbManager
 from modules.data.db_manager import DbManager
+from modules.data.meme_data import MemeData
+from modules.data.membership_cache import MembershipCache
+from modules.data.post_author_store import PostAuthorStore
+from modules.data.vote_buffer import VoteBuffer
+from modules.debug.query_stats import QueryStats
 
 TABLE_NAME = "test_table"
+CHANNEL_ID = -7
+GROUP_ID = -8
 
 
 def query_to_string(query_result: list) -> list:
@@ -30,6 +41,32 @@ def test_get_db(db_results):
         assert cur is not None
 
 
+def test_get_connection(db_results):
+    """Tests that the pooled connections are reused
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        checkouts = DbManager.pool_stats()['checkouts']
+        with DbManager.get_connection() as (conn1, cur):
+            assert cur is not None
+        with DbManager.get_connection() as (conn2, cur):
+            assert cur is not None
+
+        assert conn1 is conn2
+        assert DbManager.pool_stats()['checkouts'] == checkouts + 2
+
+
+def test_migrate(db_results):
+    """Tests that the migrate function applies each migration only once
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.migrate("data", "db", "migrations")
+
+        assert DbManager.migrate("data", "db", "migrations") == 0
+        assert DbManager.count_from(table_name="schema_version") > 0
+
+
 def test_query_from_string(db_results):
     """Tests the query_from_string function for the database
     """
@@ -119,3 +156,384 @@ def test_delete_from(db_results):
         assert count == 0
 
         DbManager.query_from_string("""DROP TABLE temp;""")
+
+
+def test_transaction(db_results):
+    """Tests the transaction function of the database
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        with DbManager.transaction() as tr:
+            tr.insert_into(table_name=TABLE_NAME, values=(10, "test_insert1", "none"))
+            tr.execute(f"UPDATE {TABLE_NAME} SET surname = %s WHERE id = %s", ("edited", 10))
+            count = tr.count_from(table_name=TABLE_NAME, where="surname = %s", where_args=("edited", ))
+
+        assert count == 1
+        assert DbManager.count_from(table_name=TABLE_NAME, where="id = %s", where_args=(10, )) == 1
+
+        try:
+            with DbManager.transaction() as tr:
+                tr.delete_from(table_name=TABLE_NAME, where="id = %s", where_args=(10, ))
+                raise ValueError("rollback")
+        except ValueError:
+            pass
+
+        assert DbManager.count_from(table_name=TABLE_NAME, where="id = %s", where_args=(10, )) == 1
+
+        DbManager.delete_from(table_name=TABLE_NAME, where="id = %s", where_args=(10, ))
+
+
+def test_nested_checkout(db_results):
+    """Tests that a DbManager call inside a transaction does not end it, and that closing the pool
+    does not close the connection of a transaction still running
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        with DbManager.transaction() as tr:
+            tr.insert_into(table_name=TABLE_NAME, values=(11, "test_nested", "none"))
+            assert len(list(DbManager.iter_select(table_name=TABLE_NAME))) > 0
+            tr.execute(f"UPDATE {TABLE_NAME} SET surname = %s WHERE id = %s", ("edited", 11))
+
+        assert DbManager.count_from(table_name=TABLE_NAME, where="surname = %s", where_args=("edited", )) == 1
+
+        if not remote:
+            with DbManager.transaction() as tr:
+                DbManager.get_pool().close_all()
+                tr.execute(f"UPDATE {TABLE_NAME} SET surname = %s WHERE id = %s", ("closed", 11))
+            assert DbManager.count_from(table_name=TABLE_NAME, where="surname = %s", where_args=("closed", )) == 1
+
+        DbManager.delete_from(table_name=TABLE_NAME, where="id = %s", where_args=(11, ))
+
+
+def test_row_modes(db_results):
+    """Tests the row modes and the scalar fetches of the database
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        where = "id = %s"
+        expected = db_results['select_from2'][0]
+
+        assert list(DbManager.select_from(table_name=TABLE_NAME, select="id, name", where=where, where_args=(1, ),
+                                          row_mode="tuple")[0]) == expected
+        row = DbManager.select_from(table_name=TABLE_NAME, select="id, name", where=where, where_args=(1, ),
+                                    row_mode="namedtuple")[0]
+        assert [row.id, row.name] == expected
+        assert DbManager.fetch_value(table_name=TABLE_NAME, select="name", where=where, where_args=(1, )) == expected[1]
+        assert DbManager.fetch_value(table_name=TABLE_NAME, select="name", where=where, where_args=(-1, ), default=0) == 0
+        assert len(DbManager.fetch_column(table_name=TABLE_NAME, select="id")) == DbManager.count_from(table_name=TABLE_NAME)
+
+
+def test_iter_select(db_results):
+    """Tests that iter_select streams the same rows as select_from, and can be stopped early
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        expected = DbManager.select_from(table_name=TABLE_NAME, select="id", row_mode="tuple")
+
+        assert list(DbManager.iter_select(table_name=TABLE_NAME, select="id", row_mode="tuple", batch_size=2)) == expected
+
+        rows = DbManager.iter_select(table_name=TABLE_NAME, select="id", batch_size=1)
+        next(rows)
+        rows.close()
+
+        assert DbManager.count_from(table_name=TABLE_NAME) == len(expected)
+
+
+@pytest.mark.asyncio
+async def test_async_db_manager(db_results):
+    """Tests that the AsyncDbManager gives the same results of the DbManager
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        expected = DbManager.select_from(table_name=TABLE_NAME, select="id", row_mode="tuple")
+
+        assert await AsyncDbManager.select_from(table_name=TABLE_NAME, select="id", row_mode="tuple") == expected
+        assert await AsyncDbManager.run_in_transaction(lambda tr: tr.count_from(table_name=TABLE_NAME)) == len(expected)
+        assert [row async for row in AsyncDbManager.iter_select(table_name=TABLE_NAME, select="id", row_mode="tuple",
+                                                                batch_size=2)] == expected
+
+
+def test_bulk_operations(db_results):
+    """Tests the insert_many and delete_many functions of the database
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        rows = [(id, f"test_bulk{id}", "none") for id in range(20, 45)]
+
+        assert DbManager.insert_many(table_name=TABLE_NAME, values_list=iter(rows), batch_size=10) == 25
+        assert DbManager.count_from(table_name=TABLE_NAME, where="name LIKE %s", where_args=("test_bulk%", )) == 25
+        assert DbManager.delete_many(table_name=TABLE_NAME,
+                                     columns=("id", "name"),
+                                     values_list=[row[:2] for row in rows] + [(99, "missing")],
+                                     batch_size=10) == 25
+        assert DbManager.count_from(table_name=TABLE_NAME, where="name LIKE %s", where_args=("test_bulk%", )) == 0
+
+
+def test_query_stats(db_results):
+    """Tests that the queries are recorded by statement shape
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        for id in (1, 2):
+            DbManager.select_from(table_name=TABLE_NAME, where="id = %s", where_args=(id, ))
+        stats = DbManager.query_stats()['queries'][f"SELECT * FROM {TABLE_NAME} WHERE id = ?"]
+
+        assert stats['count'] >= 2
+        assert stats['rows'] >= 2
+        assert sum(n for _, n in stats['buckets']) == stats['count']
+        assert QueryStats.shape("SELECT * FROM t WHERE type = 'a' and id = %s") == QueryStats.shape(
+            "SELECT * FROM t WHERE type = %s and id = 2")
+
+
+def test_membership_cache(db_results):
+    """Tests that the membership cache writes its changes through to the database, and only keeps the ones saved
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.query_from_string("DROP TABLE IF EXISTS temp_users;",
+                                    "CREATE TABLE temp_users(user_id BIGINT NOT NULL, PRIMARY KEY (user_id));")
+        cache = MembershipCache("temp_users")
+
+        assert not cache.contains(1)
+        assert not cache.add(1)
+        assert cache.add(1)
+        assert cache.contains(1)
+        assert DbManager.count_from(table_name="temp_users") == 1
+        assert cache.remove(1)
+        assert not cache.remove(1)
+        assert DbManager.count_from(table_name="temp_users") == 0
+        assert cache.stats()['misses'] == 1
+
+        DbManager.query_from_string("DROP TABLE temp_users;")
+        with pytest.raises(Exception):  # the write fails, so the cache must not change
+            cache.add(2)
+        assert not cache.contains(2)
+
+
+def test_post_author_store(db_results):
+    """Tests that the authors of the posts survive a restart and expire after the ttl
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.migrate("data", "db", "migrations")
+        store = PostAuthorStore(max_size=1)
+        store.put(channel_id=-1, c_message_id=1, user_id=10)
+        store.put(channel_id=-1, c_message_id=2, user_id=20)  # the first one is only in the database
+
+        assert store.pop(-1, 2) == 20
+        assert store.pop(-1, 2) is None
+        assert PostAuthorStore().pop(-1, 1) == 10  # read from the database, as after a restart
+
+        store.put(channel_id=-1, c_message_id=3, user_id=30)
+        assert PostAuthorStore(ttl=-1).cleanup() == 1
+        assert DbManager.count_from(table_name="post_author") == 0
+
+
+def get_votes() -> list:
+    """Gets the votes on the posts of CHANNEL_ID saved in the database
+
+    Returns:
+        list: (user_id, c_message_id, is_upvote) of each vote
+    """
+    rows = DbManager.select_from(select="user_id, c_message_id, is_upvote",
+                                 table_name="votes",
+                                 where="channel_id = %s",
+                                 where_args=(CHANNEL_ID, ),
+                                 row_mode="tuple")
+    return sorted((user_id, c_message_id, bool(is_upvote)) for user_id, c_message_id, is_upvote in rows)
+
+
+@pytest.fixture
+def published_posts(db_results) -> list:
+    """Publishes three posts in CHANNEL_ID, and deletes them and their votes at the end of the test
+
+    Yields:
+        list: values of remote to test
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.insert_many(table_name="published_meme",
+                              columns=("channel_id", "c_message_id"),
+                              values_list=[(CHANNEL_ID, 1), (CHANNEL_ID, 2), (CHANNEL_ID, 3)])
+    yield db_results['remote']
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.delete_from(table_name="votes", where="channel_id = %s", where_args=(CHANNEL_ID, ))
+        DbManager.delete_from(table_name="vote_tally", where="channel_id = %s", where_args=(CHANNEL_ID, ))
+        DbManager.delete_from(table_name="published_meme", where="channel_id = %s", where_args=(CHANNEL_ID, ))
+
+
+@pytest.fixture
+def pending_posts(db_results) -> list:
+    """Adds two pending posts in GROUP_ID, and deletes them and their votes at the end of the test
+
+    Yields:
+        list: values of remote to test
+    """
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.insert_many(table_name="pending_meme",
+                              columns=("user_id", "u_message_id", "g_message_id", "group_id"),
+                              values_list=[(1, 1, 1, GROUP_ID), (1, 2, 2, GROUP_ID)])
+    yield db_results['remote']
+    for remote in db_results['remote']:
+        DbManager.use_remote_db = remote
+        DbManager.delete_from(table_name="admin_votes", where="group_id = %s", where_args=(GROUP_ID, ))
+        DbManager.delete_from(table_name="admin_vote_tally", where="group_id = %s", where_args=(GROUP_ID, ))
+        DbManager.delete_from(table_name="pending_meme", where="group_id = %s", where_args=(GROUP_ID, ))
+
+
+def test_vote_buffer_replay(published_posts, tmp_path):
+    """Tests that the votes journaled by a previous run are written to the database when the buffer starts
+    """
+    for remote in published_posts:
+        DbManager.use_remote_db = remote
+        journal_path = str(tmp_path / f"votes_{remote}.journal")
+        with open(f"{journal_path}.{1:020d}.flushing", "w", encoding="utf-8") as journal:  # a flush never completed
+            journal.write(json.dumps([1, 1, CHANNEL_ID, True]) + "\n")
+        with open(journal_path, "w", encoding="utf-8") as journal:  # the journal of the run that crashed
+            journal.write(json.dumps([2, 1, CHANNEL_ID, False]) + "\n")
+            journal.write(json.dumps([1, 1, CHANNEL_ID, None]) + "\n")
+            journal.write("[3, 1")  # incomplete line
+
+        buffer = VoteBuffer(flush_interval=3600, journal_path=journal_path)
+        buffer.start()
+
+        assert get_votes() == [(2, 1, False)]
+        assert os.listdir(tmp_path) == [os.path.basename(journal_path)]
+        buffer.stop()
+
+
+def test_vote_buffer_failed_flush(published_posts, tmp_path, monkeypatch):
+    """Tests that the votes of a failed flush are written by the next one, and the journal is never lost
+    """
+    for remote in published_posts:
+        DbManager.use_remote_db = remote
+        journal_path = str(tmp_path / f"votes_{remote}.journal")
+        with open(journal_path, "w", encoding="utf-8") as journal:
+            journal.write(json.dumps([1, 1, CHANNEL_ID, True]) + "\n")
+        buffer = VoteBuffer(flush_interval=3600, journal_path=journal_path)
+        write = buffer._write
+        monkeypatch.setattr(buffer, "_write", lambda dirty, tallies: 1 / 0)
+
+        buffer.start()  # the database is not reachable at startup
+        assert get_votes() == []
+        assert buffer.vote(user_id=2, c_message_id=1, channel_id=CHANNEL_ID, vote=False) == (1, 1, True)
+
+        monkeypatch.setattr(buffer, "_write", write)
+        assert buffer.flush() == 2
+        assert get_votes() == [(1, 1, True), (2, 1, False)]
+        assert not any(file_name.endswith(".flushing") for file_name in os.listdir(tmp_path))
+
+        buffer.vote(user_id=3, c_message_id=1, channel_id=CHANNEL_ID, vote=True)
+        with open(journal_path, "r", encoding="utf-8") as journal:  # the live journal is still on disk
+            assert json.loads(journal.read()) == [3, 1, CHANNEL_ID, True]
+        buffer.stop()
+        assert get_votes() == [(1, 1, True), (2, 1, False), (3, 1, True)]
+        DbManager.delete_from(table_name="votes", where="channel_id = %s", where_args=(CHANNEL_ID, ))
+
+
+def test_vote_buffer_eviction(published_posts):
+    """Tests that only the posts without pending votes are evicted, and are reloaded from the database
+    """
+    for remote in published_posts:
+        DbManager.use_remote_db = remote
+        buffer = VoteBuffer(flush_interval=3600, max_posts=1)
+        buffer.vote(user_id=1, c_message_id=1, channel_id=CHANNEL_ID, vote=True)
+        buffer.vote(user_id=1, c_message_id=2, channel_id=CHANNEL_ID, vote=True)
+
+        assert buffer.stats()['posts'] == 2  # both have votes not yet flushed
+        assert buffer.flush() == 2
+        buffer.vote(user_id=1, c_message_id=3, channel_id=CHANNEL_ID, vote=False)
+        assert buffer.stats()['posts'] == 1
+        assert buffer.get_tally(1, CHANNEL_ID) is None
+        assert buffer.vote(user_id=2, c_message_id=1, channel_id=CHANNEL_ID, vote=True) == (2, 0, True)
+        assert buffer.vote(user_id=1, c_message_id=1, channel_id=CHANNEL_ID, vote=True) == (1, 0, False)
+
+        buffer.flush()
+        assert get_votes() == [(1, 2, True), (1, 3, False), (2, 1, True)]
+        DbManager.delete_from(table_name="votes", where="channel_id = %s", where_args=(CHANNEL_ID, ))
+
+
+def test_set_user_vote(published_posts):
+    """Tests that each vote runs two queries when the post has a tally, and that the votes toggle correctly
+    """
+    for remote in published_posts:
+        DbManager.use_remote_db = remote
+        DbManager.insert_into(table_name="vote_tally",
+                              columns=("c_message_id", "channel_id", "up", "down"),
+                              values=(1, CHANNEL_ID, 0, 0))
+
+        def vote(user_id: int, c_message_id: int, is_upvote: bool) -> tuple:
+            n_queries = sum(stats['count'] for stats in DbManager.query_stats()['queries'].values())
+            result = MemeData.set_user_vote(user_id, c_message_id, CHANNEL_ID, is_upvote)
+            return result, sum(stats['count'] for stats in DbManager.query_stats()['queries'].values()) - n_queries
+
+        assert vote(1, 1, True) == ((1, 0, True), 2)  # added
+        assert vote(2, 1, True) == ((2, 0, True), 2)
+        assert vote(1, 1, False) == ((1, 1, True), 2)  # changed
+        assert vote(1, 1, False) == ((1, 0, False), 2)  # removed
+        assert get_votes() == [(2, 1, True)]
+
+        assert vote(1, 2, False)[0] == (0, 1, True)  # the post has no tally yet: it is created by counting the votes
+        assert vote(1, 2, True)[0] == (1, 0, True)
+        assert DbManager.fetch_value(table_name="vote_tally",
+                                     select="up",
+                                     where="c_message_id = %s and channel_id = %s",
+                                     where_args=(2, CHANNEL_ID)) == 1
+
+
+def test_set_admin_vote(pending_posts):
+    """Tests that the admin votes return the tally of the post, or (-1, -1) when the vote is repeated
+    """
+    for remote in pending_posts:
+        DbManager.use_remote_db = remote
+
+        def get_admin_tally() -> tuple:
+            return DbManager.select_from(select="approve, reject",
+                                         table_name="admin_vote_tally",
+                                         where="g_message_id = %s and group_id = %s",
+                                         where_args=(1, GROUP_ID),
+                                         row_mode="tuple")[0]
+
+        assert MemeData.set_admin_vote(1, 1, GROUP_ID, True) == (1, 0)  # first vote
+        assert get_admin_tally() == (1, 0)
+        assert MemeData.set_admin_vote(1, 1, GROUP_ID, True) == (-1, -1)  # same vote
+        assert get_admin_tally() == (1, 0)
+        assert MemeData.set_admin_vote(1, 1, GROUP_ID, False) == (0, 1)  # changed
+        assert get_admin_tally() == (0, 1)
+        assert MemeData.set_admin_vote(2, 1, GROUP_ID, True) == (1, 1)
+        assert get_admin_tally() == (1, 1)
+
+
+def test_rebuild_vote_tally(published_posts, pending_posts):  # pylint: disable=unused-argument
+    """Tests that the tallies are recomputed from the votes, including the posts without votes
+    """
+    for remote in published_posts:
+        DbManager.use_remote_db = remote
+        DbManager.insert_many(table_name="votes",
+                              columns=("user_id", "c_message_id", "channel_id", "is_upvote"),
+                              values_list=[(1, 1, CHANNEL_ID, True), (2, 1, CHANNEL_ID, True),
+                                           (3, 1, CHANNEL_ID, False), (1, 2, CHANNEL_ID, False)])
+        DbManager.insert_many(table_name="admin_votes",
+                              columns=("admin_id", "g_message_id", "group_id", "is_upvote"),
+                              values_list=[(1, 1, GROUP_ID, True), (2, 1, GROUP_ID, True), (3, 1, GROUP_ID, False)])
+        DbManager.insert_into(table_name="vote_tally",  # out of sync
+                              columns=("c_message_id", "channel_id", "up", "down"),
+                              values=(1, CHANNEL_ID, 10, 10))
+        DbManager.insert_into(table_name="admin_vote_tally",
+                              columns=("g_message_id", "group_id", "approve", "reject"),
+                              values=(1, GROUP_ID, 0, 5))
+        n_posts = DbManager.count_from(table_name="published_meme") + DbManager.count_from(table_name="pending_meme")
+
+        assert MemeData.rebuild_vote_tally() == n_posts
+        assert sorted(DbManager.select_from(select="c_message_id, up, down",
+                                            table_name="vote_tally",
+                                            where="channel_id = %s",
+                                            where_args=(CHANNEL_ID, ),
+                                            row_mode="tuple")) == [(1, 2, 1), (2, 0, 1), (3, 0, 0)]
+        assert sorted(DbManager.select_from(select="g_message_id, approve, reject",
+                                            table_name="admin_vote_tally",
+                                            where="group_id = %s",
+                                            where_args=(GROUP_ID, ),
+                                            row_mode="tuple")) == [(1, 2, 1), (2, 0, 0)]
@@ -0,0 +1,125 @@
+"""Tests the message log, written by a background thread"""
+import argparse
+from datetime import datetime, timezone
+from functools import partial
+from telegram import Chat, Message, User
+import maintenance
+from modules.data.data_reader import config_map
+from modules.debug import log_manager
+from modules.debug.log_manager import format_json, is_sampled, read_message_log
+from modules.debug.log_writer import LogWriter
+
+
+def read_lines(path: str) -> list:
+    """Reads the lines of a log file
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        list: lines of the file
+    """
+    with open(path, encoding="utf8") as log_file:
+        return log_file.read().splitlines()
+
+
+def test_log_writer_rotation(tmp_path):
+    """Tests that the records are written in order, and that the file is rotated keeping only backup_count old files
+    """
+    path = str(tmp_path / "messages.log")
+    writer = LogWriter(path, batch_size=1, max_bytes=9, backup_count=2)
+    for i in range(4):
+        assert writer.write(f"record {i}\n")
+    writer.close()
+
+    assert read_lines(path) == ["record 3"]
+    assert read_lines(f"{path}.1") == ["record 2"]
+    assert read_lines(f"{path}.2") == ["record 1"]
+    assert not (tmp_path / "messages.log.3").exists()
+    assert writer.stats() == {'queued': 0, 'written': 4, 'dropped': 0, 'rotations': 3, 'errors': 0}
+
+
+def test_log_writer_errors(tmp_path):
+    """Tests that the records that cannot be written are counted as dropped
+    """
+    writer = LogWriter(str(tmp_path / "missing" / "messages.log"))
+    writer.write("record\n")
+    writer.close()
+
+    assert writer.stats()['errors'] == 1
+    assert writer.stats()['dropped'] == 1
+
+
+def make_message(message_id: int, chat_id: int, user_id: int) -> Message:
+    """Creates a message sent in a group
+
+    Args:
+        message_id (int): id of the message
+        chat_id (int): id of the group
+        user_id (int): id of the user, who has no username
+
+    Returns:
+        Message: message with the date equal to its id, as a unix timestamp
+    """
+    return Message(message_id=message_id,
+                   date=datetime.fromtimestamp(message_id, timezone.utc),
+                   chat=Chat(id=chat_id, type=Chat.GROUP, title="group"),
+                   from_user=User(id=user_id, first_name="name", is_bot=False),
+                   text=f"text {message_id}")
+
+
+def test_read_message_log(tmp_path):
+    """Tests that the json records are read back in order from the compressed rotated files, filtered as asked
+    """
+    path = str(tmp_path / "messages.jsonl")
+    writer = LogWriter(path, batch_size=1, max_bytes=1, backup_count=5, compress=True)
+    for i, (chat_id, user_id) in enumerate(((-1, 1), (-2, 1), (-1, 2), (-1, 1))):
+        writer.write(format_json(make_message(i + 1, chat_id, user_id)))
+    writer.close()
+    with open(path, "a", encoding="utf8") as log_file:  # a truncated line is skipped
+        log_file.write('{"message_id":5,')
+
+    records = list(read_message_log(path))
+    assert [record['message_id'] for record in records] == [1, 2, 3, 4]
+    assert records[0] == {
+        'message_id': 1,
+        'user_id': 1,
+        'first_name': "name",
+        'chat_id': -1,
+        'chat_type': Chat.GROUP,
+        'chat_title': "group",
+        'text': "text 1",
+        'date': 1
+    }
+    assert [record['message_id'] for record in read_message_log(path, chat_id=-1, user_id=1)] == [1, 4]
+    assert [record['message_id'] for record in read_message_log(path, since=3)] == [3, 4]
+
+
+def test_export_log(tmp_path, monkeypatch, capsys):
+    """Tests that maintenance.py exports the filtered records as csv
+    """
+    path = str(tmp_path / "messages.jsonl")
+    writer = LogWriter(path)
+    writer.write(format_json(make_message(1, -1, 1)))
+    writer.write(format_json(make_message(2, -2, 1)))
+    writer.close()
+    monkeypatch.setattr(maintenance, "read_message_log", partial(read_message_log, path))
+
+    maintenance.export_log(argparse.Namespace(chat=-2, user=None, since=None, csv=True))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "date,message_id,chat_id,chat_type,chat_title,user_id,user_name,first_name,last_name,text"
+    assert lines[1:] == ["2,2,-2,group,group,1,,name,,text 2"]
+
+
+def test_is_sampled(monkeypatch):
+    """Tests that each chat is logged according to its own sample rate, or the default one
+    """
+    monkeypatch.setitem(config_map['debug'], 'message_log', {'sample_rates': {-1: 1, -2: 0.5, 'default': 0}})
+    monkeypatch.setattr(log_manager.random, "random", lambda: 0.4)
+    assert is_sampled(-1)
+    assert is_sampled(-2)
+    assert not is_sampled(-3)
+    monkeypatch.setattr(log_manager.random, "random", lambda: 0.6)
+    assert not is_sampled(-2)
+    monkeypatch.setitem(config_map['debug'], 'message_log', {})
+    assert is_sampled(-3)
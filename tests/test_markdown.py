@@ -0,0 +1,50 @@
+"""Tests the in-memory copy of the markdown files"""
+import os
+import pytest
+from modules.data.markdown_registry import MarkdownRegistry
+
+
+def write_md(path, text: str, mtime: float):
+    """Writes the markdown file, setting its modification time
+
+    Args:
+        path (Path): path of the file
+        text (str): contents of the file
+        mtime (float): modification time of the file
+    """
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+def test_markdown_reload(tmp_path):
+    """Tests that the files are read once, and read again only when they change
+    """
+    write_md(tmp_path / "help.md", "help\n", 1)
+    write_md(tmp_path / "rules.md", "rules", 1)
+    write_md(tmp_path / "notes.txt", "notes", 1)
+    registry = MarkdownRegistry(dir_path=(str(tmp_path), ), check_interval=0)
+    assert registry.load() == 2
+    assert registry.get("help") == "help"
+
+    write_md(tmp_path / "help.md", "new help", 2)
+    assert registry.get("help") == "new help"
+    assert registry.get("rules") == "rules"
+    assert registry.reloads == 1
+
+    never_checked = MarkdownRegistry(dir_path=(str(tmp_path), ), check_interval=-1)
+    never_checked.load()
+    write_md(tmp_path / "help.md", "newer help", 3)
+    assert never_checked.get("help") == "new help"
+
+
+def test_markdown_missing(tmp_path):
+    """Tests that a file deleted while the bot is running is still sent as it was, while an unknown file is an error
+    """
+    write_md(tmp_path / "help.md", "help", 1)
+    registry = MarkdownRegistry(dir_path=(str(tmp_path), ), check_interval=0)
+    registry.load()
+    os.remove(tmp_path / "help.md")
+
+    assert registry.get("help") == "help"
+    with pytest.raises(FileNotFoundError):
+        registry.get("rules")
@@ -0,0 +1,61 @@
+"""Tests the validation and the reload of the settings"""
+import shutil
+import subprocess
+import sys
+from modules.data.data_reader import CONFIG_SCHEMA, get_abs_path, load_config, validate_config
+from modules.data.settings import Settings, settings
+
+
+def test_validate_config():
+    """Tests that the settings with the wrong type are reported, and the strings are converted to the schema type
+    """
+    config = {
+        'data': {
+            'db_url': None,
+            'remote': "true"
+        },
+        'debug': {
+            'local_log': False
+        },
+        'meme': {
+            'channel_group_id': "-100",
+            'channel_id': "abc",
+            'comments': True,
+            'group_id': 1.5,
+            'n_votes': 1
+        },
+        'token': "",
+        'webhook': None
+    }
+    errors = validate_config(config, CONFIG_SCHEMA)
+
+    assert config['data']['db_url'] == ""
+    assert config['data']['remote'] is True
+    assert config['meme']['channel_group_id'] == -100
+    assert sorted(errors) == [
+        "meme.channel_id must be int, not 'abc'", "meme.group_id must be int, not float", "meme.reset_on_load is missing",
+        "webhook must be a section"
+    ]
+
+
+def test_load_generated_config(tmp_path):
+    """Tests that the settings written by settings.py without a database url or a webhook url are valid
+    """
+    path = str(tmp_path / "settings.yaml")
+    shutil.copy(get_abs_path("config", "settings.yaml.dist"), path)
+    subprocess.run([sys.executable, get_abs_path("settings.py"), "token", "1", "2", "3", "-p", path], check=True)
+
+    config = load_config(path)
+
+    assert config['token'] == "token"
+    assert config['meme']['channel_group_id'] == 3
+    assert config['data']['db_url'] == ""
+    assert config['webhook']['url'] == ""
+
+
+def test_settings():
+    """Tests the attribute access and the names of the changed settings
+    """
+    assert settings.meme.n_votes == settings['meme']['n_votes']
+    assert settings.data.get('missing', 1) == 1
+    assert Settings.diff({'a': 1, 'b': {'c': 2, 'd': 3}}, {'a': 1, 'b': {'c': 4}, 'e': 5}) == {"b.c", "b.d", "e"}